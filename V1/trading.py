@@ -533,6 +533,199 @@ def fmt_time(ts: int | None = None) -> str:
     d = datetime.fromtimestamp(((ts or int(time.time() * 1000)))/1000.0)
     return d.strftime("%Y-%m-%d %H:%M:%S")
 
+# 信号规则：每个策略是一串按代价从低到高排列的检查项，检查项按名称在一次评估内共享结果；
+# 快照为按需计算的 LazySnapshot
+def _above_ema500(s) -> bool:
+    return s["cp"] > s["ema500"]
+
+def _below_ema500(s) -> bool:
+    return s["cp"] < s["ema500"]
+
+def _ohlc_above(name: str):
+    def check(s) -> bool:
+        e = s[name]
+        return s["o"] > e and s["c"] > e and s["h"] > e and s["l"] > e
+    return check
+
+def _ohlc_below(name: str):
+    def check(s) -> bool:
+        e = s[name]
+        return s["o"] < e and s["c"] < e and s["h"] < e and s["l"] < e
+    return check
+
+def _ema_stack_up(s) -> bool:
+    return s["ema500"] < s["ema200"] < s["ema100"] < s["ema60"] < s["ema25"] < s["ema7"]
+
+def _ema_stack_down(s) -> bool:
+    return s["ema500"] > s["ema200"] > s["ema100"] > s["ema60"] > s["ema25"] > s["ema7"]
+
+def _crossed_below(slow: str):
+    def check(s) -> bool:
+        return any(a < b for a, b in zip(s["ema7_hist"], s[slow + "_hist"]))
+    return check
+
+def _crossed_above(slow: str):
+    def check(s) -> bool:
+        return any(a > b for a, b in zip(s["ema7_hist"], s[slow + "_hist"]))
+    return check
+
+def _macd_up(s) -> bool:
+    return s["dif"] > s["dea"]
+
+def _macd_down(s) -> bool:
+    return s["dif"] < s["dea"]
+
+def _boll_up(s) -> bool:
+    return s["cp"] > s["up"]
+
+def _boll_down(s) -> bool:
+    return s["cp"] < s["down"]
+
+def _rsi_up(s) -> bool:
+    return s["rsi80"] > s["rsi200"] and s["rsi80"] > s["rsi500"]
+
+def _rsi_down(s) -> bool:
+    return s["rsi80"] < s["rsi200"] and s["rsi80"] < s["rsi500"]
+
+def _kdj_up(s) -> bool:
+    k, d, jv = s["k"], s["d"], s["j"]
+    return (k[-1] > d[-1] > jv[-1]) or all(k[-1 - i] > k[-2 - i] and jv[-1 - i] > jv[-2 - i] for i in range(1, 3))
+
+def _kdj_down(s) -> bool:
+    k, d, jv = s["k"], s["d"], s["j"]
+    return (k[-1] < d[-1] < jv[-1]) or all(k[-1 - i] < k[-2 - i] and jv[-1 - i] < jv[-2 - i] for i in range(1, 3))
+
+SIGNAL_CHECKS = {
+    "above_ema500": _above_ema500,
+    "below_ema500": _below_ema500,
+    "ohlc_above_ema500": _ohlc_above("ema500"),
+    "ohlc_below_ema500": _ohlc_below("ema500"),
+    "stack_up": _ema_stack_up,
+    "stack_down": _ema_stack_down,
+    "ema7_was_below_ema500": _crossed_below("ema500"),
+    "ema7_was_above_ema500": _crossed_above("ema500"),
+    "ema7_was_below_ema25": _crossed_below("ema25"),
+    "ema7_was_above_ema25": _crossed_above("ema25"),
+    "macd_up": _macd_up,
+    "macd_down": _macd_down,
+    "boll_up": _boll_up,
+    "boll_down": _boll_down,
+    "rsi_up": _rsi_up,
+    "rsi_down": _rsi_down,
+    "kdj_up": _kdj_up,
+    "kdj_down": _kdj_down,
+}
+
+class SignalRule:
+    __slots__ = ("side", "label", "checks", "blocked_by")
+
+    def __init__(self, side: str, label: str, checks: tuple[str, ...]):
+        for name in checks:
+            if name not in SIGNAL_CHECKS:
+                raise ValueError(f"unknown signal check: {name}")
+        self.side = side
+        self.label = label
+        self.checks = tuple((name, SIGNAL_CHECKS[name]) for name in checks)
+        self.blocked_by = "LONG_DIF_GT_DEA" if side == "LONG" else "SHORT_DIF_LT_DEA"
+
+class SignalRuleSet:
+    def __init__(self, rules: list[SignalRule]):
+        self.rules = tuple(rules)
+
+    def evaluate(self, s, last_dir: str | None = None) -> tuple[bool, ...]:
+        # 同一检查项只算一次；任一检查失败即放弃该规则，被 MACD 单次触发拦截的规则直接跳过
+        seen: dict[str, bool] = {}
+        out = []
+        for rule in self.rules:
+            ok = rule.blocked_by != last_dir
+            if ok:
+                for name, fn in rule.checks:
+                    r = seen.get(name)
+                    if r is None:
+                        r = seen[name] = bool(fn(s))
+                    if not r:
+                        ok = False
+                        break
+            out.append(ok)
+        return tuple(out)
+
+# 检查项顺序即求值顺序：先比价格与均线（最便宜、最常失败），KDJ 最后
+SECOND_RULES = SignalRuleSet([
+    SignalRule("LONG", "做多1", ("above_ema500", "stack_up", "ema7_was_below_ema500", "macd_up", "boll_up", "rsi_up", "kdj_up")),
+    SignalRule("LONG", "做多2", ("above_ema500", "stack_up", "ema7_was_below_ema25", "macd_up", "boll_up", "rsi_up")),
+    SignalRule("SHORT", "做空1", ("below_ema500", "stack_down", "ema7_was_above_ema500", "macd_down", "boll_down", "rsi_down", "kdj_down")),
+    SignalRule("SHORT", "做空2", ("below_ema500", "stack_down", "ema7_was_above_ema25", "macd_down", "boll_down", "rsi_down")),
+])
+
+MINUTE_RULES = SignalRuleSet([
+    SignalRule("LONG", "做多1", ("ohlc_above_ema500", "stack_up", "ema7_was_below_ema500", "macd_up", "boll_up", "rsi_up", "kdj_up")),
+    SignalRule("LONG", "做多2", ("ohlc_above_ema500", "stack_up", "ema7_was_below_ema25", "macd_up", "boll_up", "rsi_up")),
+    SignalRule("SHORT", "做空1", ("ohlc_below_ema500", "stack_down", "ema7_was_above_ema500", "macd_down", "boll_down", "rsi_down", "kdj_down")),
+    SignalRule("SHORT", "做空2", ("ohlc_below_ema500", "stack_down", "ema7_was_above_ema25", "macd_down", "boll_down", "rsi_down")),
+])
+
+def second_conditions(s, last_dir: str | None = None) -> tuple[bool, bool, bool, bool]:
+    return SECOND_RULES.evaluate(s, last_dir)
+
+def minute_conditions(s, last_dir: str | None = None) -> tuple[bool, bool, bool, bool]:
+    return MINUTE_RULES.evaluate(s, last_dir)
+
+_HIST_DEPTH = {7: 10, 25: 3, 500: 10}
+
+class LazySnapshot:
+    # 指标只在规则第一次访问时按整段序列计算，同一次评估内各规则共享
+    __slots__ = ("closes", "bars", "cache")
+
+    def __init__(self, closes: list[float], bars: dict | None = None):
+        self.closes = closes
+        self.bars = bars
+        idx = len(closes) - 1
+        self.cache = {"n": len(closes), "cp": closes[idx]}
+        if bars is not None:
+            for f in ("o", "h", "l", "c"):
+                self.cache[f] = bars[f][idx]
+
+    def __getitem__(self, name: str):
+        v = self.cache.get(name)
+        if v is None:
+            self.cache.update(_LAZY_PROVIDERS[name](self.closes))
+            v = self.cache[name]
+        return v
+
+def _lazy_ema(p: int):
+    def provide(closes):
+        e = ema(closes, p)
+        idx = len(closes) - 1
+        out = {f"ema{p}": e[idx]}
+        if p in _HIST_DEPTH:
+            out[f"ema{p}_hist"] = [e[idx - i] for i in range(1, min(_HIST_DEPTH[p], idx) + 1)]
+        return out
+    return provide
+
+def _lazy_rsi(p: int):
+    def provide(closes):
+        return {f"rsi{p}": rsi(closes, p)[-1]}
+    return provide
+
+def _lazy_macd(closes):
+    dif, dea = macd(closes, 60, 200, 60)
+    return {"dif": dif[-1], "dea": dea[-1]}
+
+def _lazy_boll(closes):
+    mid, up, down = boll(closes, 200, 1)
+    return {"mid": mid[-1], "up": up[-1], "down": down[-1]}
+
+def _lazy_kdj(closes):
+    k, d, jv = kdj_from_close(closes, 20, 80, 200)
+    return {"k": k[-4:], "d": d[-4:], "j": jv[-4:]}
+
+_LAZY_PROVIDERS = {"dif": _lazy_macd, "dea": _lazy_macd, "mid": _lazy_boll, "up": _lazy_boll, "down": _lazy_boll,
+                   "k": _lazy_kdj, "d": _lazy_kdj, "j": _lazy_kdj}
+for _p in (7, 25, 60, 100, 200, 500):
+    _LAZY_PROVIDERS[f"ema{_p}"] = _LAZY_PROVIDERS[f"ema{_p}_hist"] = _lazy_ema(_p)
+for _p in (80, 200, 500):
+    _LAZY_PROVIDERS[f"rsi{_p}"] = _lazy_rsi(_p)
+
 def ticker_loop():
     while True:
         try:
@@ -561,54 +754,8 @@ def ticker_loop():
                     if len(dq) < 600:
                         continue
                     closes = [x["p"] for x in dq]
-                    mid, up, down = boll(closes, 200, 1)
-                    ema7 = ema(closes, 7)
-                    ema25 = ema(closes, 25)
-                    ema60 = ema(closes, 60)
-                    ema100 = ema(closes, 100)
-                    ema200 = ema(closes, 200)
-                    ema500 = ema(closes, 500)
-                    dif, dea = macd(closes, 60, 200, 60)
-                    rsi80 = rsi(closes, 80)
-                    rsi200 = rsi(closes, 200)
-                    rsi500 = rsi(closes, 500)
-                    k, d, jv = kdj_from_close(closes, 20, 80, 200)
-                    idx = len(closes) - 1
-                    cp = closes[idx]
-                    cond_long1 = (
-                        cp > ema500[idx] and
-                        cp > up[idx] and
-                        (ema7[idx] > ema25[idx] > ema60[idx] > ema100[idx] > ema200[idx] > ema500[idx]) and
-                        any(ema7[idx - i] < ema500[idx - i] for i in range(1, min(10, idx)+1)) and
-                        dif[idx] > dea[idx] and
-                        (rsi80[idx] > rsi200[idx] and rsi80[idx] > rsi500[idx]) and
-                        ((k[idx] > d[idx] > jv[idx]) or all(k[idx - i] > k[idx - i - 1] and jv[idx - i] > jv[idx - i - 1] for i in range(1, min(3, idx))) )
-                    )
-                    cond_long2 = (
-                        cp > ema500[idx] and
-                        cp > up[idx] and
-                        (ema7[idx] > ema25[idx] > ema60[idx] > ema100[idx] > ema200[idx] > ema500[idx]) and
-                        any(ema7[idx - i] < ema25[idx - i] for i in range(1, min(3, idx)+1)) and
-                        dif[idx] > dea[idx] and
-                        (rsi80[idx] > rsi200[idx] and rsi80[idx] > rsi500[idx])
-                    )
-                    cond_short1 = (
-                        cp < ema500[idx] and
-                        cp < down[idx] and
-                        (ema7[idx] < ema25[idx] < ema60[idx] < ema100[idx] < ema200[idx] < ema500[idx]) and
-                        any(ema7[idx - i] > ema500[idx - i] for i in range(1, min(10, idx)+1)) and
-                        dif[idx] < dea[idx] and
-                        (rsi80[idx] < rsi200[idx] and rsi80[idx] < rsi500[idx]) and
-                        ((k[idx] < d[idx] < jv[idx]) or all(k[idx - i] < k[idx - i - 1] and jv[idx - i] < jv[idx - i - 1] for i in range(1, min(3, idx))) )
-                    )
-                    cond_short2 = (
-                        cp < ema500[idx] and
-                        cp < down[idx] and
-                        (ema7[idx] < ema25[idx] < ema60[idx] < ema100[idx] < ema200[idx] < ema500[idx]) and
-                        any(ema7[idx - i] > ema25[idx - i] for i in range(1, min(3, idx)+1)) and
-                        dif[idx] < dea[idx] and
-                        (rsi80[idx] < rsi200[idx] and rsi80[idx] < rsi500[idx])
-                    )
+                    cp = closes[-1]
+                    cond_long1, cond_long2, cond_short1, cond_short2 = second_conditions(LazySnapshot(closes), last_macd_dir.get(sym))
                     def pass_macd_once(dir_flag: str) -> bool:
                         last = last_macd_dir.get(sym)
                         if last == dir_flag:
@@ -660,57 +807,9 @@ def minute_eval_loop():
                 if not isinstance(kl, list) or len(kl) < 600:
                     continue
                 closes = [float(it[4]) for it in kl]
-                highs = [float(it[2]) for it in kl]
-                lows = [float(it[3]) for it in kl]
-                opens = [float(it[1]) for it in kl]
-                mid, up, down = boll(closes, 200, 1)
-                ema7 = ema(closes, 7)
-                ema25 = ema(closes, 25)
-                ema60 = ema(closes, 60)
-                ema100 = ema(closes, 100)
-                ema200 = ema(closes, 200)
-                ema500 = ema(closes, 500)
-                dif, dea = macd(closes, 60, 200, 60)
-                rsi80 = rsi(closes, 80)
-                rsi200 = rsi(closes, 200)
-                rsi500 = rsi(closes, 500)
-                k, d, jv = kdj_from_close(closes, 20, 80, 200)
-                idx = len(closes) - 1
-                cp = closes[idx]
-                cond_long1 = (
-                    opens[idx] > ema500[idx] and closes[idx] > ema500[idx] and highs[idx] > ema500[idx] and lows[idx] > ema500[idx] and
-                    cp > up[idx] and
-                    (ema7[idx] > ema25[idx] > ema60[idx] > ema100[idx] > ema200[idx] > ema500[idx]) and
-                    any(ema7[idx - i] < ema500[idx - i] for i in range(1, min(10, idx)+1)) and
-                    dif[idx] > dea[idx] and
-                    (rsi80[idx] > rsi200[idx] and rsi80[idx] > rsi500[idx]) and
-                    ((k[idx] > d[idx] > jv[idx]) or all(k[idx - i] > k[idx - i - 1] and jv[idx - i] > jv[idx - i - 1] for i in range(1, min(3, idx))) )
-                )
-                cond_long2 = (
-                    opens[idx] > ema500[idx] and closes[idx] > ema500[idx] and highs[idx] > ema500[idx] and lows[idx] > ema500[idx] and
-                    cp > up[idx] and
-                    (ema7[idx] > ema25[idx] > ema60[idx] > ema100[idx] > ema200[idx] > ema500[idx]) and
-                    any(ema7[idx - i] < ema25[idx - i] for i in range(1, min(3, idx)+1)) and
-                    dif[idx] > dea[idx] and
-                    (rsi80[idx] > rsi200[idx] and rsi80[idx] > rsi500[idx])
-                )
-                cond_short1 = (
-                    opens[idx] < ema500[idx] and closes[idx] < ema500[idx] and highs[idx] < ema500[idx] and lows[idx] < ema500[idx] and
-                    cp < down[idx] and
-                    (ema7[idx] < ema25[idx] < ema60[idx] < ema100[idx] < ema200[idx] < ema500[idx]) and
-                    any(ema7[idx - i] > ema500[idx - i] for i in range(1, min(10, idx)+1)) and
-                    dif[idx] < dea[idx] and
-                    (rsi80[idx] < rsi200[idx] and rsi80[idx] < rsi500[idx]) and
-                    ((k[idx] < d[idx] < jv[idx]) or all(k[idx - i] < k[idx - i - 1] and jv[idx - i] < jv[idx - i - 1] for i in range(1, min(3, idx))) )
-                )
-                cond_short2 = (
-                    opens[idx] < ema500[idx] and closes[idx] < ema500[idx] and highs[idx] < ema500[idx] and lows[idx] < ema500[idx] and
-                    cp < down[idx] and
-                    (ema7[idx] < ema25[idx] < ema60[idx] < ema100[idx] < ema200[idx] < ema500[idx]) and
-                    any(ema7[idx - i] > ema25[idx - i] for i in range(1, min(3, idx)+1)) and
-                    dif[idx] < dea[idx] and
-                    (rsi80[idx] < rsi200[idx] and rsi80[idx] < rsi500[idx])
-                )
+                bars = {"o": [float(it[1]) for it in kl], "h": [float(it[2]) for it in kl], "l": [float(it[3]) for it in kl], "c": closes}
+                cp = closes[-1]
+                cond_long1, cond_long2, cond_short1, cond_short2 = minute_conditions(LazySnapshot(closes, bars), last_macd_dir.get(sym))
                 def pass_macd_once(dir_flag: str) -> bool:
                     last = last_macd_dir.get(sym)
                     if last == dir_flag:
@@ -0,0 +1,535 @@
+import os
+import csv
+import json
+import time
+import argparse
+import concurrent.futures
+from datetime import datetime, timezone
+from collections import deque
+
+import trading
+from trading import np
+
+# 离线回测：用本地 K 线/逐笔文件重放 trading.py 的指标、开仓条件与平仓规则
+#
+# 第一阶段（多进程，按交易对）：向量化计算窗口指标，先用必要条件粗筛，再对候选点调用
+#   trading.minute_conditions / second_conditions 得到条件与成交量统计
+# 第二阶段（单进程，按时间顺序）：组合级模拟 try_open 的拒单规则与下单数量、
+#   止盈单（跟踪/限价）以及 risk_loop 的对冲平仓、盈利停滞、止损、EMA500 平仓
+#
+# K 线文件：data.binance.vision 的 1m CSV（有无表头均可）或 /fapi/v1/klines 返回的 JSON 数组，
+#   文件名以交易对开头，例如 BTCUSDT-1m-2024-01.csv
+# 逐笔文件（可选）：CSV 两列 时间戳(ms),价格，文件名同样以交易对开头；提供后按秒重采样并启用秒级条件
+#
+# 1m 条件在实盘于每分钟第 57 秒（trading.MINUTE_EVAL_MS，可用 --minute-eval-sec 调整）评估，此时当前 K 线尚未收盘：
+#   有逐笔数据时，当前 K 线的收盘/最高/最低价按评估时刻之前的秒级价格重建，指标只修正当前点；
+#   没有逐笔数据时只能用整根 K 线，收盘价比实盘多看约 60-57=3 秒。
+#   当前 K 线的成交量两种情况下都按已过去的时间折算（K 线文件没有分钟内的成交量分布）
+
+MINUTE_MS = 60_000
+MINUTE_EVAL_OFFSET_MS = trading.MINUTE_EVAL_MS
+MINUTE_WINDOW = 1000
+MIN_BARS = 600
+TICK_CHUNK = 200_000
+
+def _symbol_of(fname: str) -> str:
+    base = os.path.basename(fname)
+    for sep in ("-", "_", "."):
+        base = base.split(sep)[0]
+    return base.upper()
+
+def _group_files(folder: str | None, exts: tuple[str, ...]) -> dict[str, list[str]]:
+    out: dict[str, list[str]] = {}
+    if not folder:
+        return out
+    for name in sorted(os.listdir(folder)):
+        if not name.lower().endswith(exts):
+            continue
+        out.setdefault(_symbol_of(name), []).append(os.path.join(folder, name))
+    return out
+
+def _has_header(path: str) -> bool:
+    with open(path, "r", encoding="utf-8") as f:
+        first = f.readline().split(",")[0].strip()
+    return not first.lstrip("-").isdigit()
+
+def _read_table(path: str, ncols: int):
+    if path.lower().endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            rows = json.load(f)
+        return np.array([[float(x) for x in r[:ncols]] for r in rows if len(r) >= ncols], dtype=np.float64).reshape(-1, ncols)
+    return np.loadtxt(path, delimiter=",", usecols=range(ncols), skiprows=1 if _has_header(path) else 0, ndmin=2)
+
+def load_klines(paths: list[str]) -> dict:
+    # 合并多个文件，按开盘时间去重排序，并补齐缺失分钟（价格沿用上一收盘价，成交量为 0）
+    tables = [a for a in (_read_table(p, 8) for p in paths) if a.shape[0]]
+    if not tables:
+        return {}
+    arr = np.concatenate(tables)
+    t = arr[:, 0].astype(np.int64)
+    # 微秒时间戳（2025 年起的现货数据）统一为毫秒
+    t = np.where(t > 10**14, t // 1000, t)
+    t, first = np.unique(t, return_index=True)
+    arr = arr[first]
+    grid = np.arange(t[0], t[-1] + MINUTE_MS, MINUTE_MS, dtype=np.int64)
+    pos = np.searchsorted(t, grid, side="right") - 1
+    exact = t[pos] == grid
+    c = arr[pos, 4]
+    return {
+        "t": grid,
+        "o": np.where(exact, arr[pos, 1], c),
+        "h": np.where(exact, arr[pos, 2], c),
+        "l": np.where(exact, arr[pos, 3], c),
+        "c": c,
+        "q": np.where(exact, arr[pos, 7], 0.0),
+    }
+
+def load_ticks(paths: list[str], t0: int, t1: int) -> tuple:
+    # 重采样为每秒最后成交价（与 ticker_loop 每秒取一次价格对应），返回 (秒级时间戳 ms, 价格)
+    tables = [a for a in (_read_table(p, 2) for p in paths) if a.shape[0]]
+    if not tables:
+        return None, None
+    arr = np.concatenate(tables)
+    ts = arr[:, 0].astype(np.int64)
+    order = np.argsort(ts, kind="stable")
+    ts, px = ts[order], arr[order, 1]
+    start = max(t0, (ts[0] // 1000) * 1000)
+    grid = np.arange(start, t1, 1000, dtype=np.int64)
+    pos = np.searchsorted(ts, grid + 999, side="right") - 1
+    ok = pos >= 0
+    return grid[ok], px[pos[ok]]
+
+def snapshot_at(ind: dict, i: int, bars: dict | None = None) -> dict:
+    # windowed_indicators_np 结果在第 i 个点的快照，字段与 IndicatorEngine.last / batch_snapshot 一致
+    T = int(ind["n"][i]) - 1
+    s = {"n": T + 1, "cp": float(ind["cp"][i])}
+    for name in ("up", "down", "dif", "dea", "rsi80", "rsi200", "rsi500") + tuple(f"ema{p}" for p in trading.EMA_PERIODS):
+        s[name] = float(ind[name][i])
+    s["ema7_hist"] = [float(ind[f"ema7_h{j}"][i]) for j in range(1, min(10, T) + 1)]
+    s["ema25_hist"] = [float(ind[f"ema25_h{j}"][i]) for j in range(1, min(3, T) + 1)]
+    s["ema500_hist"] = [float(ind[f"ema500_h{j}"][i]) for j in range(1, min(10, T) + 1)]
+    lo = max(0, i - 3)
+    for f in ("k", "d", "j"):
+        # 带进行中 K 线时，之前各点取收盘值，只有当前点是评估时刻的值
+        prev = ind.get(f"{f}_close", ind[f])
+        s[f] = [float(x) for x in prev[lo:i]] + [float(ind[f][i])]
+    if bars is not None:
+        for f in ("o", "h", "l", "c"):
+            s[f] = float(bars[f][i])
+    return s
+
+def _prefilter(ind: dict, min_n: int, bars: dict | None = None):
+    # 四个条件共同的必要条件（均线排列、金叉/死叉回看、MACD、RSI、布林突破），只对命中点调用逐点的条件函数
+    e = [ind[f"ema{p}"] for p in trading.EMA_PERIODS]
+    cp = ind["cp"]
+    up = np.ones(cp.shape[0], dtype=bool)
+    down = np.ones(cp.shape[0], dtype=bool)
+    for a, b in zip(e, e[1:]):
+        up &= a > b
+        down &= a < b
+    up &= (ind["dif"] > ind["dea"]) & (ind["rsi80"] > ind["rsi200"]) & (ind["rsi80"] > ind["rsi500"]) & (cp > ind["up"])
+    down &= (ind["dif"] < ind["dea"]) & (ind["rsi80"] < ind["rsi200"]) & (ind["rsi80"] < ind["rsi500"]) & (cp < ind["down"])
+    crossed_up = np.zeros(cp.shape[0], dtype=bool)
+    crossed_down = np.zeros(cp.shape[0], dtype=bool)
+    for j in range(1, 11):
+        a, b = ind[f"ema7_h{j}"], ind[f"ema500_h{j}"]
+        crossed_up |= a < b
+        crossed_down |= a > b
+        if j <= 3:
+            a, b = ind[f"ema7_h{j}"], ind[f"ema25_h{j}"]
+            crossed_up |= a < b
+            crossed_down |= a > b
+    up &= crossed_up
+    down &= crossed_down
+    if bars is not None:
+        up &= bars["l"] > ind["ema500"]
+        down &= bars["h"] < ind["ema500"]
+    return np.nonzero((up | down) & (ind["n"] >= min_n))[0]
+
+def _vol_sums(q):
+    cs = np.concatenate([[0.0], np.cumsum(q)])
+    def window(i: int, n: int, extra: float = 0.0) -> float:
+        return float(cs[i] - cs[max(0, i - n)]) + extra
+    return window
+
+def partial_bars(bars: dict, ts, px, eval_ms: int) -> dict:
+    # 每根 K 线在开盘后 eval_ms 时的状态：收盘价取该时刻之前最后一秒的价格，最高/最低含开盘价；
+    # 这段时间内没有逐笔数据的 K 线沿用整根数据
+    t0 = int(bars["t"][0])
+    nb = bars["t"].shape[0]
+    rel = ts - t0
+    bi = rel // MINUTE_MS
+    keep = (rel >= 0) & (bi < nb) & (rel % MINUTE_MS + 1000 <= eval_ms)
+    bi, p = bi[keep], px[keep]
+    out = {"t": bars["t"], "o": bars["o"], "c": bars["c"].copy(), "h": bars["h"].copy(), "l": bars["l"].copy()}
+    if not bi.shape[0]:
+        return out
+    last = np.r_[bi[1:] != bi[:-1], True]
+    has = np.unique(bi)
+    out["c"][bi[last]] = p[last]
+    hi = np.full(nb, -np.inf)
+    lo = np.full(nb, np.inf)
+    np.maximum.at(hi, bi, p)
+    np.minimum.at(lo, bi, p)
+    out["h"][has] = np.maximum(hi[has], bars["o"][has])
+    out["l"][has] = np.minimum(lo[has], bars["o"][has])
+    return out
+
+def _minute_events(sym: str, bars: dict, eval_ms: int = MINUTE_EVAL_OFFSET_MS, live: dict | None = None) -> tuple[list[tuple], object]:
+    # live 为 partial_bars 的结果：按评估时刻的当前 K 线计算指标与条件；缺省时用整根 K 线（收盘价有前视）
+    if live is None:
+        live = bars
+        ind = trading.windowed_indicators_np(bars["c"], MINUTE_WINDOW)
+        ema500 = ind["ema500"]
+    else:
+        ind = trading.windowed_indicators_np(bars["c"], MINUTE_WINDOW, live["c"])
+        ema500 = ind["ema500_close"]
+    q = bars["q"]
+    frac = min(eval_ms, MINUTE_MS) / MINUTE_MS
+    window = _vol_sums(q)
+    events = []
+    for i in _prefilter(ind, MIN_BARS, live):
+        i = int(i)
+        conds = trading.minute_conditions(snapshot_at(ind, i, live))
+        if not any(conds):
+            continue
+        n = min(i + 1, MINUTE_WINDOW)
+        cur = float(q[i]) * frac
+        vstats = (n, cur, float(q[i - 1]) if i >= 1 else 0.0,
+                  window(i, 19, cur) / 20.0, window(i, 499, cur) / 500.0)
+        events.append((int(bars["t"][i]) + eval_ms, sym, float(live["c"][i]), conds, vstats, "1m"))
+    return events, ema500
+
+def _second_events(sym: str, bars: dict, ts, px) -> tuple[list[tuple], object]:
+    # 逐笔按秒重采样后分块计算（块之间重叠两个窗口长度，EMA/MACD/RSI 与整段计算完全一致）
+    W = trading.PRICE_MAXLEN
+    q = bars["q"]
+    window = _vol_sums(q)
+    t0 = int(bars["t"][0])
+    events = []
+    ema_at_bar_end = np.full(bars["t"].shape[0], np.nan)
+    start = 0
+    N = px.shape[0]
+    while start < N:
+        lo = max(0, start - 2 * W)
+        hi = min(N, start + TICK_CHUNK)
+        ind = trading.windowed_indicators_np(px[lo:hi], W)
+        # 块内位置 j 对应真实样本数：块起点之前的样本也在 PriceSeries 中
+        ind["n"] = np.minimum(np.arange(lo, hi) + 1, W)
+        seg_t = ts[lo:hi]
+        bar_idx = (seg_t - t0) // MINUTE_MS
+        keep = np.nonzero(np.arange(lo, hi) >= start)[0]
+        last_in_bar = keep[np.r_[bar_idx[keep][1:] != bar_idx[keep][:-1], True]]
+        valid = (bar_idx[last_in_bar] >= 0) & (bar_idx[last_in_bar] < ema_at_bar_end.shape[0])
+        ema_at_bar_end[bar_idx[last_in_bar][valid]] = ind["ema500"][last_in_bar][valid]
+        for j in _prefilter(ind, MIN_BARS):
+            j = int(j)
+            if lo + j < start:
+                continue
+            conds = trading.second_conditions(snapshot_at(ind, j))
+            if not any(conds):
+                continue
+            bi = int(bar_idx[j])
+            if bi < 1 or bi >= q.shape[0]:
+                continue
+            # 当前分钟未走完：成交量按已过去的秒数折算
+            cur = float(q[bi]) * (((int(seg_t[j]) - t0) % MINUTE_MS) // 1000 + 1) / 60.0
+            n = min(bi + 1, MINUTE_WINDOW)
+            vstats = (n, cur, float(q[bi - 1]), window(bi, 19, cur) / 20.0, window(bi, 499, cur) / 500.0)
+            events.append((int(seg_t[j]), sym, float(px[lo + j]), conds, vstats, "1s"))
+        start = hi
+    return events, ema_at_bar_end
+
+def scan_symbol(job: tuple) -> dict | None:
+    sym, kline_paths, tick_paths, eval_ms = job
+    bars = load_klines(kline_paths)
+    if not bars or bars["t"].shape[0] < MIN_BARS:
+        return None
+    ts = px = None
+    if tick_paths:
+        ts, px = load_ticks(tick_paths, int(bars["t"][0]), int(bars["t"][-1]) + MINUTE_MS)
+    live = partial_bars(bars, ts, px, eval_ms) if ts is not None and eval_ms < MINUTE_MS else None
+    events, ema500 = _minute_events(sym, bars, eval_ms, live)
+    if ts is not None and ts.shape[0] >= MIN_BARS:
+        sec_events, sec_ema = _second_events(sym, bars, ts, px)
+        events.extend(sec_events)
+        # risk_loop 在秒级价格够 500 个时用秒级 EMA500，否则用 1m K 线
+        ema500 = np.where(np.isnan(sec_ema), ema500, sec_ema)
+    return {"sym": sym, "bars": {k: bars[k] for k in ("t", "o", "h", "l", "c")}, "ema500": ema500, "events": events}
+
+class Position:
+    __slots__ = ("sym", "side", "label", "qty", "entry", "opened_t", "bar", "tp", "tp_price", "peak", "armed", "sl", "pcts", "unreal", "mark")
+
+    def __init__(self, sym: str, side: str, label: str, qty: float, entry: float, opened_t: int, bar: int, tp: str):
+        self.sym = sym
+        self.side = side
+        self.label = label
+        self.qty = qty
+        self.entry = entry
+        self.opened_t = opened_t
+        self.bar = bar
+        self.tp = tp
+        is_long = side == "LONG"
+        if tp == "limit_dyn":
+            self.tp_price = trading.adjust_price(sym, trading.limit_tp_target(entry, is_long))
+        else:
+            self.tp_price = trading.adjust_price(sym, trading.trailing_activation(entry, is_long))
+        self.peak = 0.0
+        self.armed = False
+        self.sl = trading.stop_loss_price(entry, qty, is_long)
+        self.pcts: deque = deque(maxlen=int(trading.STAGNATION_WINDOW_SEC * 1000 // MINUTE_MS) + 1)
+        self.unreal = 0.0
+        self.mark = entry
+
+    def pnl_at(self, price: float) -> float:
+        return (price - self.entry) * self.qty if self.side == "LONG" else (self.entry - price) * self.qty
+
+class Simulator:
+    def __init__(self, data: dict[str, dict], wallet: float, fee_taker: float, fee_maker: float, start_ms: int, end_ms: int):
+        self.data = data
+        self.wallet = wallet
+        self.fee_taker = fee_taker
+        self.fee_maker = fee_maker
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.open: dict[str, dict[str, Position]] = {}
+        self.cursor: dict[str, int] = {}
+        self.last_macd_dir: dict[str, str] = {}
+        self.last_attempt_at: dict[tuple[str, str], int] = {}
+        self.trades: list[dict] = []
+        self.rejects: dict[str, int] = {}
+        self.equity = [(start_ms, wallet)]
+
+    def _close(self, p: Position, price: float, t: int, reason: str, maker: bool = False, pop_dir: bool = True):
+        gross = p.pnl_at(price)
+        fee = p.qty * price * (self.fee_maker if maker else self.fee_taker)
+        self.wallet += gross - fee
+        self.trades.append({
+            "symbol": p.sym, "side": p.side, "label": p.label, "qty": p.qty,
+            "entry_time": p.opened_t, "entry": p.entry, "exit_time": t, "exit": price,
+            "pnl": gross, "fee": fee, "reason": reason,
+        })
+        self.equity.append((t, self.wallet))
+        book = self.open.get(p.sym, {})
+        book.pop(p.side, None)
+        if not book:
+            self.open.pop(p.sym, None)
+        if pop_dir:
+            self.last_macd_dir.pop(p.sym, None)
+
+    def _step_bar(self, sym: str, i: int):
+        # 一根 K 线内的顺序：交易所侧止盈单 -> 对冲平仓 -> 盈利停滞 -> 止损 -> EMA500
+        d = self.data[sym]
+        bars = d["bars"]
+        t_close = int(bars["t"][i]) + MINUTE_MS
+        o, h, l, c = (float(bars[f][i]) for f in ("o", "h", "l", "c"))
+        for p in list(self.open.get(sym, {}).values()):
+            if i <= p.bar:
+                continue
+            is_long = p.side == "LONG"
+            if p.tp == "limit_dyn":
+                if (h >= p.tp_price) if is_long else (l <= p.tp_price):
+                    self._close(p, p.tp_price, t_close, "限价止盈", maker=True, pop_dir=False)
+                    continue
+            else:
+                cb = trading.TRAIL_CALLBACK_RATE / 100.0
+                if p.armed:
+                    stop = p.peak * (1 - cb) if is_long else p.peak * (1 + cb)
+                    if (l <= stop) if is_long else (h >= stop):
+                        self._close(p, stop, t_close, "跟踪止盈", pop_dir=False)
+                        continue
+                    p.peak = max(p.peak, h) if is_long else min(p.peak, l)
+                elif (h >= p.tp_price) if is_long else (l <= p.tp_price):
+                    p.armed = True
+                    p.peak = h if is_long else l
+        book = self.open.get(sym, {})
+        if "LONG" in book and "SHORT" in book:
+            lp, sp = book["LONG"], book["SHORT"]
+            if max(lp.bar, sp.bar) < i:
+                trig, net, base = trading.pair_close_check(lp.qty, sp.qty, lp.pnl_at(c), sp.pnl_at(c), lp.qty * c, sp.qty * c)
+                if trig:
+                    self._close(lp, c, t_close, "对冲平仓")
+                    self._close(sp, c, t_close, "对冲平仓")
+                    return
+        e500 = float(d["ema500"][i])
+        for p in list(self.open.get(sym, {}).values()):
+            if i <= p.bar:
+                continue
+            is_long = p.side == "LONG"
+            unreal = p.pnl_at(c)
+            notional = p.qty * c
+            p.pcts.append(unreal / notional * 100.0 if notional > 1e-12 else 0.0)
+            p.unreal = unreal
+            p.mark = c
+            age = (t_close - p.opened_t) / 1000.0
+            if trading.stagnation_check(unreal, age, max(p.pcts), min(p.pcts)):
+                self._close(p, c, t_close, "盈利停滞")
+                continue
+            worst = l if is_long else h
+            if -p.pnl_at(worst) >= trading.ORDER_STOP_NOTIONAL:
+                px = min(o, p.sl) if is_long else max(o, p.sl)
+                self._close(p, px, t_close, "止损")
+                continue
+            if e500 == e500 and trading.ema500_exit(p.side, c, e500):
+                self._close(p, c, t_close, "EMA500")
+
+    def advance(self, sym: str, upto: int):
+        # 把该交易对的持仓逐根推进到 upto（不含）；无持仓时直接跳过
+        cur = self.cursor.get(sym, 0)
+        while cur < upto and sym in self.open:
+            self._step_bar(sym, cur)
+            cur += 1
+        self.cursor[sym] = max(cur, upto)
+
+    def advance_all(self, t: int):
+        for sym in list(self.open):
+            bars_t = self.data[sym]["bars"]["t"]
+            self.advance(sym, int(np.searchsorted(bars_t, t - MINUTE_MS, side="right")))
+
+    def _reject(self, reason: str):
+        self.rejects[reason] = self.rejects.get(reason, 0) + 1
+
+    def try_open(self, t: int, sym: str, price: float, side_dir: str, label: str, bar: int):
+        key = (sym, side_dir)
+        if self.last_attempt_at.get(key) and (t - self.last_attempt_at[key]) < 30_000:
+            return
+        self.last_attempt_at[key] = t
+        positions = [p for book in self.open.values() for p in book.values()]
+        if any(p.sym == sym and p.side == side_dir for p in positions):
+            self._reject("已存在同方向持仓")
+            return
+        total_nominal = sum(p.qty * p.mark for p in positions)
+        if self.wallet > 0 and total_nominal > self.wallet * 10.0:
+            self._reject("持仓名义价值超过钱包余额10倍")
+            return
+        qty = trading.adjust_qty(sym, trading.ORDER_NOTIONAL / max(price, 1e-12))
+        if qty <= 0:
+            self._reject("数量不满足最小/步长约束")
+            return
+        pos = [{"positionAmt": p.qty, "unRealizedProfit": p.unreal} for p in positions]
+        mode = trading.tp_mode(label, pos)
+        p = Position(sym, side_dir, label, qty, price, t, bar, mode)
+        self.wallet -= qty * price * self.fee_taker
+        self.open.setdefault(sym, {})[side_dir] = p
+        self.last_macd_dir[sym] = "LONG_DIF_GT_DEA" if side_dir == "LONG" else "SHORT_DIF_LT_DEA"
+
+    def run(self, events: list[tuple]):
+        for t, sym, price, conds, vstats, _ in events:
+            if t < self.start_ms or t >= self.end_ms:
+                continue
+            self.advance_all(t)
+            bars_t = self.data[sym]["bars"]["t"]
+            bar = int(np.searchsorted(bars_t, t, side="right")) - 1
+            self.advance(sym, bar)
+            signal = trading.pick_signal(conds, self.last_macd_dir.get(sym), lambda: vstats)
+            if signal:
+                self.try_open(t, sym, price, signal[0], signal[1], bar)
+        for sym in list(self.open):
+            bars_t = self.data[sym]["bars"]["t"]
+            self.advance(sym, int(np.searchsorted(bars_t, self.end_ms - MINUTE_MS, side="right")))
+        for sym in list(self.open):
+            for p in list(self.open.get(sym, {}).values()):
+                bars = self.data[sym]["bars"]
+                last = int(np.searchsorted(bars["t"], self.end_ms - MINUTE_MS, side="right")) - 1
+                self._close(p, float(bars["c"][max(last, 0)]), int(bars["t"][max(last, 0)]) + MINUTE_MS, "回测结束")
+
+def load_symbol_filters(path: str | None, syms) -> None:
+    # exchangeInfo 快照（/fapi/v1/exchangeInfo 原样保存）用于数量/价格精度；缺失时只按 8 位小数取整
+    info = {}
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            info = {s.get("symbol"): s for s in json.load(f).get("symbols", [])}
+    for sym in syms:
+        if sym in info:
+            trading.symbol_filters[sym] = trading.get_filters_from_symbol(info[sym])
+        else:
+            trading.symbol_filters[sym] = {"stepSize": 0.0, "tickSize": 0.0, "minQty": 0.0, "minNotional": 0.0, "quantityPrecision": 8, "pricePrecision": 8}
+
+def summarize(sim: Simulator, elapsed: float, n_syms: int, n_events: int) -> None:
+    trades = sim.trades
+    pnl = sum(x["pnl"] for x in trades)
+    fee = sum(x["fee"] for x in trades)
+    wins = sum(1 for x in trades if x["pnl"] - x["fee"] > 0)
+    peak = sim.equity[0][1]
+    mdd = 0.0
+    for _, eq in sim.equity:
+        peak = max(peak, eq)
+        mdd = max(mdd, peak - eq)
+    print("========== 回测结果 ==========")
+    print(f"交易对 {n_syms}  候选信号 {n_events}  用时 {elapsed:.1f}s")
+    print(f"成交 {len(trades)}  胜率 {(wins / len(trades) * 100.0) if trades else 0.0:.2f}%  毛盈亏 {pnl:.4f}  手续费 {fee:.4f}  净盈亏 {pnl - fee:.4f}  最大回撤 {mdd:.4f}")
+    by_label: dict[str, list] = {}
+    by_reason: dict[str, int] = {}
+    for x in trades:
+        by_label.setdefault(x["label"], []).append(x["pnl"] - x["fee"])
+        by_reason[x["reason"]] = by_reason.get(x["reason"], 0) + 1
+    for label, arr in sorted(by_label.items()):
+        print(f"  策略 {label}: {len(arr)} 笔  净盈亏 {sum(arr):.4f}")
+    for reason, n in sorted(by_reason.items(), key=lambda x: -x[1]):
+        print(f"  平仓 {reason}: {n}")
+    for reason, n in sorted(sim.rejects.items(), key=lambda x: -x[1]):
+        print(f"  拒绝开单 {reason}: {n}")
+
+def _parse_day(s: str | None, default: int) -> int:
+    if not s:
+        return default
+    return int(datetime.strptime(s, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+def main():
+    parser = argparse.ArgumentParser(description="离线回测：重放本地 1m K 线/逐笔数据")
+    parser.add_argument("--klines", required=True, help="1m K 线目录（CSV 或 JSON，文件名以交易对开头）")
+    parser.add_argument("--ticks", help="逐笔成交目录（CSV: 时间戳ms,价格），提供后启用秒级条件")
+    parser.add_argument("--symbols", help="逗号分隔的交易对，默认目录下全部")
+    parser.add_argument("--start", help="开始日期 YYYY-MM-DD（UTC），之前的数据只用于预热指标")
+    parser.add_argument("--end", help="结束日期 YYYY-MM-DD（UTC，不含）")
+    parser.add_argument("--exchange-info", help="exchangeInfo JSON 快照，用于数量/价格精度")
+    parser.add_argument("--wallet", type=float, default=100.0, help="初始钱包余额")
+    parser.add_argument("--fee-taker", type=float, default=0.0005)
+    parser.add_argument("--fee-maker", type=float, default=0.0002)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--out", help="逐笔成交输出 CSV")
+    parser.add_argument("--minute-eval-sec", type=float, default=MINUTE_EVAL_OFFSET_MS / 1000,
+                        help="1m 条件在每分钟第几秒评估（实盘为 57）；60 表示用收盘后的整根 K 线")
+    args = parser.parse_args()
+    if np is None:
+        raise SystemExit("回测需要 numpy: pip install numpy")
+    t_begin = time.perf_counter()
+    kfiles = _group_files(args.klines, (".csv", ".json"))
+    tfiles = _group_files(args.ticks, (".csv",))
+    syms = sorted(kfiles)
+    if args.symbols:
+        want = {s.strip().upper() for s in args.symbols.split(",") if s.strip()}
+        syms = [s for s in syms if s in want]
+    if not syms:
+        raise SystemExit("没有找到 K 线文件")
+    load_symbol_filters(args.exchange_info, syms)
+    eval_ms = int(min(max(args.minute_eval_sec, 1.0), 60.0) * 1000)
+    if eval_ms < MINUTE_MS and not tfiles:
+        print(f"未提供逐笔数据：1m 条件按整根 K 线评估，收盘价比实盘（第 {eval_ms / 1000:g} 秒）多看 {(MINUTE_MS - eval_ms) / 1000:g} 秒")
+    jobs = [(s, kfiles[s], tfiles.get(s, []), eval_ms) for s in syms]
+    data: dict[str, dict] = {}
+    events: list[tuple] = []
+    if args.workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as ex:
+            results = ex.map(scan_symbol, jobs, chunksize=max(1, len(jobs) // (args.workers * 4)))
+            results = [r for r in results if r]
+    else:
+        results = [r for r in map(scan_symbol, jobs) if r]
+    for r in results:
+        data[r["sym"]] = r
+        events.extend(r["events"])
+    events.sort(key=lambda e: (e[0], e[1]))
+    t_first = min(int(r["bars"]["t"][0]) for r in results) if results else 0
+    t_last = max(int(r["bars"]["t"][-1]) + MINUTE_MS for r in results) if results else 0
+    sim = Simulator(data, args.wallet, args.fee_taker, args.fee_maker, _parse_day(args.start, t_first), _parse_day(args.end, t_last))
+    sim.run(events)
+    summarize(sim, time.perf_counter() - t_begin, len(data), len(events))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8", newline="") as f:
+            w = csv.DictWriter(f, fieldnames=["symbol", "side", "label", "qty", "entry_time", "entry", "exit_time", "exit", "pnl", "fee", "reason"])
+            w.writeheader()
+            w.writerows(sim.trades)
+        print(f"✓ 成交明细已写入 {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,34 @@ import time
 import hmac
 import hashlib
 import threading
-from collections import deque
+import contextlib
+import heapq
+import itertools
+import struct
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import atexit
+from collections import deque, OrderedDict
+import concurrent.futures
+import multiprocessing
+from multiprocessing import shared_memory
 from datetime import datetime
+from array import array
 from urllib import parse
 import math
+import bisect
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import argparse
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import websockets
+except ImportError:
+    websockets = None
 
 API_URL = "https://fapi.binance.com"
 RECV_WINDOW = 60000
@@ -17,6 +39,50 @@ RECV_WINDOW = 60000
 ORDER_NOTIONAL = float(os.getenv("ORDER_NOTIONAL", "6"))# 每单下单金额（默认名义价值为6元，也就是保证金0.3元）
 ORDER_STOP_NOTIONAL = ORDER_NOTIONAL * 0.5 # 每单止损：每单下单金额*0.5 (例如默认名义价值下单6元，则止损为3元)
 MAX_OPEN_MARGIN_RATIO = float(os.getenv("MAX_OPEN_MARGIN_RATIO", "15"))# 开仓最大账户保证金率：默认为15%（接口：/fapi/v3/account 计算方式=totalMaintMargin ÷ totalMarginBalance × 100）
+INDICATOR_BACKEND = os.getenv("INDICATOR_BACKEND", "numpy").lower()# 分钟级批量指标计算后端：numpy（向量化，需安装 numpy）或 python（列表版本）
+
+WS_URL = os.getenv("BINANCE_WS_URL", "wss://fstream.binance.com")
+MARKET_FEED = os.getenv("MARKET_FEED", "rest").lower()# 行情来源：rest（每秒轮询 /fapi/v2/ticker/price）或 ws（组合流推送，需安装 websockets）
+STREAM_STALE_SEC = float(os.getenv("STREAM_STALE_SEC", "5"))
+STREAM_SUB_BATCH = 50
+STREAM_MAX_PER_CONN = 200# 每条推送连接最多订阅的流数量（交易所上限 200），超出时自动新开连接
+KLINE_CACHE_BARS = 1000
+KLINE_CACHE_TTL = float(os.getenv("KLINE_CACHE_TTL", "1"))# 1m K 线缓存有效期（秒），过期后只增量拉取尾部
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))# REST 连接池大小（应不小于并发线程数）
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.2"))
+USER_STREAM = os.getenv("USER_STREAM", "0") == "1"# 1=用户数据流维护持仓/订单状态（需安装 websockets），0=每次 REST 查询
+ACCOUNT_RECONCILE_SEC = float(os.getenv("ACCOUNT_RECONCILE_SEC", "10"))
+RISK_MIN_INTERVAL_MS = int(os.getenv("RISK_MIN_INTERVAL_MS", "200"))# 持仓交易对的新价格触发风控检查，两次检查的最小间隔（毫秒）
+RISK_PNL_SAMPLE_SEC = 1.0# 持仓盈亏历史（盈利停滞判断）的采样间隔，与风控检查频率无关
+RISK_POSITION_REFRESH_SEC = 1.0# 未启用用户数据流时 REST 持仓快照的刷新间隔，其间未实现盈亏按最新价本地计算
+ORDER_RECONCILE_SEC = float(os.getenv("ORDER_RECONCILE_SEC", "60"))
+LISTEN_KEY_KEEPALIVE_SEC = 30 * 60
+FILL_EVENT_TIMEOUT = float(os.getenv("FILL_EVENT_TIMEOUT", "0.5"))# 等待成交推送的超时（秒），超时后改为查询订单
+FILL_WAIT_TIMEOUT = float(os.getenv("FILL_WAIT_TIMEOUT", "10"))
+SERVER_STOP = os.getenv("SERVER_STOP", "0") == "1"# 1=开仓时在交易所同时挂 STOP_MARKET 止损单（止损价同 ORDER_STOP_NOTIONAL），进程停顿或断网时仍受保护
+BATCH_TP_REPRICE_PCT = 0.001# 开仓均价与信号价偏离超过此比例时，撤掉随开仓批量下的止盈单并按均价重下
+ORDER_GATEWAY_WORKERS = int(os.getenv("ORDER_GATEWAY_WORKERS", "4"))# 下单网关线程数（其中 1 个专用于风控平仓）
+REQUEST_WEIGHT_LIMIT = int(os.getenv("REQUEST_WEIGHT_LIMIT", "2400"))# 每分钟 IP 请求权重上限（与交易所限制一致，多进程共用 IP 时可调低）
+ORDER_COUNT_LIMIT = int(os.getenv("ORDER_COUNT_LIMIT", "1200"))
+MINUTE_EVAL_MS = 57_000
+MINUTE_PREWARM_MS = int(float(os.getenv("MINUTE_PREWARM_SEC", "50")) * 1000)# 分钟评估前预取 K 线的时刻（K 线内秒数），截止时只需增量补最后几根
+MINUTE_CUTOFF_MS = int(float(os.getenv("MINUTE_CUTOFF_SEC", "59.5")) * 1000)# 分钟评估硬截止（K 线内秒数），之后未完成的交易对本轮放弃
+LEVERAGE_CACHE_FILE = "leverage.json"
+LEVERAGE_BRACKET_TTL = 86400# 杠杆分层上限缓存有效期（秒）
+LEVERAGE_WORKERS = int(os.getenv("LEVERAGE_WORKERS", "8"))
+WARM_START = os.getenv("WARM_START", "1") == "1"# 1=启动及新增交易对时用快照/aggTrades 预热秒级价格序列，免去 600 秒积累
+WARM_START_SEC = 600
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", "4"))
+BACKFILL_MAX_PAGES = int(os.getenv("BACKFILL_MAX_PAGES", "3"))# 每个交易对 aggTrades 回补最多几页（每页 1000 笔、权重 20），从最新成交往前翻
+STATE_SNAPSHOT_FILE = "state.snap"
+STATE_SNAPSHOT_MAGIC = b"SCS1"
+STATE_SNAPSHOT_SEC = int(os.getenv("STATE_SNAPSHOT_SEC", "10"))# 运行状态（价格序列、MACD 标记、持仓盈亏历史）落盘间隔（秒）
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))# Prometheus 指标端口（/metrics），0=关闭
+LATENCY_TRACE = os.getenv("LATENCY_TRACE", "0") == "1"# 1=记录行情到下单各阶段的延迟直方图（写入 latency.json，web.py 的 /api/latency 读取）
+LATENCY_FILE = "latency.json"
+EVAL_WORKERS = int(os.getenv("EVAL_WORKERS", "0"))# 分钟级评估进程数：0=进程内线程评估，>0 启用多进程（K 线经共享内存传递，需安装 numpy）
 
 time_offset_ms = 0
 
@@ -34,9 +100,507 @@ def load_config(path: str) -> dict:
 def now_ms() -> int:
     return int(time.time() * 1000) + int(time_offset_ms)
 
-def api_get(path: str, params: dict | None = None, signed: bool = False, api_key: str | None = None, secret: str | None = None, timeout: float = 10.0):
+_http_local = threading.local()
+_http_session = None
+_http_session_lock = threading.Lock()
+http_stats: dict[tuple[str, str], dict] = {}
+http_stats_lock = threading.Lock()
+
+def http_session() -> requests.Session:
+    # 全进程共享一个连接池（keep-alive），避免每次请求重新 TCP+TLS 握手
+    global _http_session
+    s = _http_session
+    if s is not None:
+        return s
+    with _http_session_lock:
+        if _http_session is None:
+            s = requests.Session()
+            # 仅对幂等的 GET/DELETE 做读超时与 5xx 重试；下单 POST 只在连接未建立时重试，避免重复下单
+            retry = Retry(
+                total=HTTP_RETRIES,
+                connect=HTTP_RETRIES,
+                read=HTTP_RETRIES,
+                status=HTTP_RETRIES,
+                backoff_factor=HTTP_BACKOFF,
+                status_forcelist=(500, 502, 503, 504),
+                allowed_methods=frozenset({"GET", "DELETE"}),
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry, pool_block=False)
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            s.headers.update({"Connection": "keep-alive"})
+            _http_session = s
+        return _http_session
+
+def record_http(method: str, path: str, elapsed: float, ok: bool):
+    with http_stats_lock:
+        st = http_stats.get((method, path))
+        if st is None:
+            st = {"count": 0, "errors": 0, "total": 0.0, "max": 0.0, "last": 0.0}
+            http_stats[(method, path)] = st
+        st["count"] += 1
+        if not ok:
+            st["errors"] += 1
+        st["total"] += elapsed
+        st["last"] = elapsed
+        if elapsed > st["max"]:
+            st["max"] = elapsed
+    _http_local.last_latency = elapsed
+    m_rest_seconds.observe(elapsed, method, path)
+    if not ok:
+        m_rest_errors.inc(method, path)
+
+def get_http_stats() -> dict[str, dict]:
+    out = {}
+    with http_stats_lock:
+        for (method, path), st in http_stats.items():
+            n = st["count"]
+            out[f"{method} {path}"] = {
+                "count": n,
+                "errors": st["errors"],
+                "avg_ms": (st["total"] / n * 1000.0) if n else 0.0,
+                "max_ms": st["max"] * 1000.0,
+                "last_ms": st["last"] * 1000.0,
+            }
+    return out
+
+def last_http_latency() -> float:
+    return getattr(_http_local, "last_latency", 0.0)
+
+# 热路径延迟：从收到行情到止盈单下达，各阶段相对行情到达时刻的耗时（total）与相对上一阶段的耗时（step）
+# 按 HDR 风格的对数-线性分桶累计；未开启 LATENCY_TRACE 时各埋点只做一次布尔判断
+LATENCY_STAGES = ("indicators", "condition", "volume", "risk", "order_sent", "order_ack", "fill", "tp_placed")
+
+class LatencyHistogram:
+    # 每个 2 的幂区间分 64 格，相对误差 < 1.6%；单位微秒，上限约 2^31 微秒（35 分钟）
+    SUB_BITS = 7
+    HALF = 1 << (SUB_BITS - 1)
+    SIZE = (31 - SUB_BITS + 2) * HALF
+
+    __slots__ = ("counts", "n", "total", "max")
+
+    def __init__(self):
+        self.counts = array("q", bytes(8 * self.SIZE))
+        self.n = 0
+        self.total = 0
+        self.max = 0
+
+    def _index(self, us: int) -> int:
+        shift = max(0, us.bit_length() - self.SUB_BITS)
+        return min(self.SIZE - 1, shift * self.HALF + (us >> shift))
+
+    def _value(self, idx: int) -> int:
+        if idx < 2 * self.HALF:
+            return idx
+        shift = idx // self.HALF - 1
+        # 桶的上沿，保证百分位不被低估
+        return ((idx - shift * self.HALF + 1) << shift) - 1
+
+    def record(self, us: int):
+        us = max(0, us)
+        self.counts[self._index(us)] += 1
+        self.n += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, q: float) -> int:
+        if not self.n:
+            return 0
+        rank = max(1, math.ceil(self.n * q / 100.0))
+        acc = 0
+        for i, c in enumerate(self.counts):
+            if c:
+                acc += c
+                if acc >= rank:
+                    return min(self._value(i), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.n,
+            "mean_ms": (self.total / self.n / 1000.0) if self.n else 0.0,
+            "p50_ms": self.percentile(50) / 1000.0,
+            "p90_ms": self.percentile(90) / 1000.0,
+            "p99_ms": self.percentile(99) / 1000.0,
+            "p999_ms": self.percentile(99.9) / 1000.0,
+            "max_ms": self.max / 1000.0,
+        }
+
+latency_hist: dict[tuple[str, str, str], LatencyHistogram] = {}
+latency_lock = threading.Lock()
+tick_received_at: dict[str, float] = {}
+
+def record_latency(path: str, stage: str, kind: str, seconds: float):
+    key = (path, stage, kind)
+    with latency_lock:
+        h = latency_hist.get(key)
+        if h is None:
+            h = latency_hist[key] = LatencyHistogram()
+        h.record(int(seconds * 1_000_000))
+
+class LatencyTrace:
+    # 一条信号从行情到达（秒级）或本轮扫描开始（分钟级）起的各阶段时间戳
+    __slots__ = ("path", "t0", "last")
+
+    def __init__(self, path: str, t0: float):
+        self.path = path
+        self.t0 = t0
+        self.last = t0
+
+    def mark(self, stage: str):
+        now = time.perf_counter()
+        record_latency(self.path, stage, "total", now - self.t0)
+        record_latency(self.path, stage, "step", now - self.last)
+        self.last = now
+
+def latency_trace(path: str, t0: float | None) -> LatencyTrace | None:
+    if not LATENCY_TRACE or t0 is None:
+        return None
+    return LatencyTrace(path, t0)
+
+def get_latency_stats() -> dict:
+    out: dict[str, dict] = {}
+    with latency_lock:
+        items = [(k, h.summary()) for k, h in latency_hist.items()]
+    order = {s: i for i, s in enumerate(LATENCY_STAGES)}
+    for (path, stage, kind), summ in sorted(items, key=lambda x: (x[0][0], order.get(x[0][1], 99), x[0][2])):
+        out.setdefault(path, {}).setdefault(stage, {})[kind] = summ
+    return out
+
+def latency_dump_loop():
+    # web.py 在另一个进程，通过工作目录下的文件读取
+    path = os.path.join(os.getcwd(), LATENCY_FILE)
+    while True:
+        time.sleep(5)
+        try:
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"t": int(time.time() * 1000), "stages": get_latency_stats()}, f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except Exception:
+            pass
+
+# Prometheus 文本格式的指标：计数器 / 仪表 / 直方图，由 METRICS_PORT 上的 /metrics 输出
+def _fmt_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = []
+    for k, v in zip(names, values):
+        s = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{k}="{s}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _fmt_value(v: float) -> str:
+    if v == math.inf:
+        return "+Inf"
+    return repr(float(v))
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values: dict[tuple, object] = {}
+        self.lock = threading.Lock()
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1.0):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def render(self) -> list[str]:
+        with self.lock:
+            items = list(self.values.items())
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_value(v)}" for k, v in items]
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = (), collect=None):
+        super().__init__(name, doc, labels)
+        # collect() 在抓取时调用，返回 [(标签值元组, 数值)]，用于从现有状态直接读数
+        self.collect = collect
+
+    def set(self, value: float, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def render(self) -> list[str]:
+        if self.collect is not None:
+            try:
+                items = list(self.collect())
+            except Exception:
+                items = []
+        else:
+            with self.lock:
+                items = list(self.values.items())
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_value(v)}" for k, v in items]
+
+class Histogram(_Metric):
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            st = self.values.get(labels)
+            if st is None:
+                st = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            st[0][i] += 1
+            st[1] += value
+            st[2] += 1
+
+    def render(self) -> list[str]:
+        with self.lock:
+            items = [(k, (list(st[0]), st[1], st[2])) for k, st in self.values.items()]
+        out = []
+        for k, (counts, total, n) in items:
+            acc = 0
+            for b, c in zip(self.buckets, counts):
+                acc += c
+                le = 'le="' + _fmt_value(b) + '"'
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, k, le)} {acc}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, k)} {_fmt_value(total)}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, k)} {n}")
+        return out
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for m in self.metrics:
+            lines.extend(m.header())
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+m_loop_seconds = metrics.register(Histogram("scalping_loop_duration_seconds", "Duration of one iteration of a main loop.", ("loop",)))
+m_rest_seconds = metrics.register(Histogram("scalping_rest_request_duration_seconds", "REST request latency by endpoint.", ("method", "path")))
+m_rest_errors = metrics.register(Counter("scalping_rest_errors_total", "REST requests that failed or returned HTTP >= 400.", ("method", "path")))
+m_signals = metrics.register(Counter("scalping_signals_total", "Entry signals that passed conditions and volume checks.", ("label", "source")))
+m_orders = metrics.register(Counter("scalping_orders_total", "Entry attempts from try_open by result and reason.", ("result", "reason")))
+m_sweep_missed = metrics.register(Counter("scalping_minute_sweep_missed_total", "Symbols skipped by the minute sweep deadline or stale data.", ("reason",)))
+
+def _collect_price_fill():
+    return [((sym,), len(ps) / ps.maxlen) for sym, ps in prices.items()]
+
+def _collect_weight():
+    st = weight_governor.stats()
+    return [(("weight",), st.get("used", 0)), (("orders",), st.get("orders", 0))]
+
+metrics.register(Gauge("scalping_price_series_fill_ratio", "Filled fraction of each symbol's 1s price buffer.", ("symbol",), collect=_collect_price_fill))
+metrics.register(Gauge("scalping_symbols_selected", "Symbols currently selected for trading.", collect=lambda: [((), len(selected_symbols))]))
+metrics.register(Gauge("scalping_rate_limit_used", "Request weight and order count used in the current minute.", ("kind",), collect=_collect_weight))
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+def metrics_server_loop():
+    try:
+        srv = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), _MetricsHandler)
+    except OSError as e:
+        print(f"指标端口 {METRICS_HOST}:{METRICS_PORT} 启动失败: {e}")
+        return
+    srv.daemon_threads = True
+    srv.serve_forever()
+
+# 请求权重控制：按接口估算 IP 权重与下单计数，结合响应头 X-MBX-USED-WEIGHT-1M / X-MBX-ORDER-COUNT-1M
+# 维护当前分钟的用量；优先级 风控平仓 > 下单 > 行情 > 预热回补，低优先级在接近上限前先排队或直接放弃。
+# 回补只能用到较小的份额且宁可等到下一分钟，不和实时行情抢权重
+PRIO_RISK = 0
+PRIO_ORDER = 1
+PRIO_DATA = 2
+PRIO_BACKFILL = 3
+PRIO_NAMES = ("risk", "order", "data", "backfill")
+WEIGHT_SHARE = (1.0, 0.9, 0.7, 0.4)
+WEIGHT_MAX_WAIT = (65.0, 5.0, 2.0, 65.0)
+
+class RateLimitError(Exception):
+    pass
+
+class PositionsUnavailable(Exception):
+    # 持仓查询返回的不是列表（时间戳错误、限频等）：状态未知，不能当作空仓
+    pass
+
+_prio_local = threading.local()
+
+def set_thread_priority(prio: int | None):
+    _prio_local.prio = prio
+
+@contextlib.contextmanager
+def request_priority(prio: int):
+    prev = getattr(_prio_local, "prio", None)
+    _prio_local.prio = prio
+    try:
+        yield
+    finally:
+        _prio_local.prio = prev
+
+def request_weight(method: str, path: str, params: dict) -> tuple[int, int]:
+    has_sym = bool(params.get("symbol"))
+    if path == "/fapi/v1/klines":
+        lim = int(params.get("limit", 500) or 500)
+        if lim < 100:
+            return 1, 0
+        if lim < 500:
+            return 2, 0
+        if lim <= 1000:
+            return 5, 0
+        return 10, 0
+    if path in ("/fapi/v2/ticker/price", "/fapi/v1/ticker/price"):
+        return (1 if has_sym else 2), 0
+    if path == "/fapi/v1/ticker/24hr":
+        return (1 if has_sym else 40), 0
+    if path == "/fapi/v1/symbolConfig":
+        return 5, 0
+    if path == "/fapi/v1/aggTrades":
+        return 20, 0
+    if path == "/fapi/v1/openOrders":
+        return (1 if has_sym else 40), 0
+    if path in ("/fapi/v3/account", "/fapi/v3/positionRisk", "/fapi/v3/balance", "/fapi/v2/account", "/fapi/v2/positionRisk"):
+        return 5, 0
+    if path == "/fapi/v1/order":
+        return (0, 1) if method == "POST" else (1, 0)
+    if path == "/fapi/v1/batchOrders":
+        if method == "POST":
+            try:
+                n = len(json.loads(params.get("batchOrders", "[]")))
+            except Exception:
+                n = 5
+            return 5, max(n, 1)
+        return 1, 0
+    return 1, 0
+
+class WeightGovernor:
+    def __init__(self, limit: int, order_limit: int):
+        self.limit = limit
+        self.order_limit = order_limit
+        self.cond = threading.Condition()
+        self.window = 0
+        self.used = 0
+        self.orders = 0
+        self.ban_until = 0.0
+        self.delayed = [0] * len(PRIO_NAMES)
+        self.shed = [0] * len(PRIO_NAMES)
+        self.bans = 0
+
+    def _roll(self, ms: int):
+        w = ms // 60_000
+        if w != self.window:
+            self.window = w
+            self.used = 0
+            self.orders = 0
+            self.cond.notify_all()
+
+    def acquire(self, weight: int, orders: int, prio: int):
+        deadline = time.time() + WEIGHT_MAX_WAIT[prio]
+        cap = self.limit * WEIGHT_SHARE[prio]
+        ocap = self.order_limit * WEIGHT_SHARE[prio]
+        counted = False
+        with self.cond:
+            while True:
+                ms = now_ms()
+                self._roll(ms)
+                ban = self.ban_until - time.time()
+                if ban <= 0 and self.used + weight <= cap and (orders == 0 or self.orders + orders <= ocap):
+                    self.used += weight
+                    self.orders += orders
+                    return
+                wait = ban if ban > 0 else ((self.window + 1) * 60_000 - ms) / 1000.0
+                if time.time() + wait > deadline:
+                    self.shed[prio] += 1
+                    raise RateLimitError(f"请求权重不足，放弃 {PRIO_NAMES[prio]} 请求 (已用 {self.used}/{self.limit})")
+                if not counted:
+                    self.delayed[prio] += 1
+                    counted = True
+                self.cond.wait(min(max(wait, 0.01), 0.5))
+
+    def update(self, headers, status: int):
+        with self.cond:
+            self._roll(now_ms())
+            try:
+                w = headers.get("X-MBX-USED-WEIGHT-1M") or headers.get("X-MBX-USED-WEIGHT-1m")
+                if w is not None:
+                    self.used = max(self.used, int(w))
+            except Exception:
+                pass
+            try:
+                o = headers.get("X-MBX-ORDER-COUNT-1M") or headers.get("X-MBX-ORDER-COUNT-1m")
+                if o is not None:
+                    self.orders = max(self.orders, int(o))
+            except Exception:
+                pass
+            if status in (418, 429):
+                try:
+                    ra = float(headers.get("Retry-After") or 60)
+                except Exception:
+                    ra = 60.0
+                self.ban_until = max(self.ban_until, time.time() + ra)
+                self.used = max(self.used, self.limit)
+                self.bans += 1
+                print(f"触发频率限制 HTTP {status}，暂停请求 {ra:.0f} 秒")
+
+    def stats(self) -> dict:
+        with self.cond:
+            self._roll(now_ms())
+            return {
+                "used": self.used,
+                "limit": self.limit,
+                "remaining": max(0, self.limit - self.used),
+                "orders": self.orders,
+                "order_limit": self.order_limit,
+                "ban_remaining": max(0.0, self.ban_until - time.time()),
+                "bans": self.bans,
+                "delayed": dict(zip(PRIO_NAMES, self.delayed)),
+                "shed": dict(zip(PRIO_NAMES, self.shed)),
+            }
+
+weight_governor = WeightGovernor(REQUEST_WEIGHT_LIMIT, ORDER_COUNT_LIMIT)
+
+def get_rate_limit_stats() -> dict:
+    return weight_governor.stats()
+
+def api_request(method: str, path: str, params: dict | None = None, signed: bool = False, api_key: str | None = None, secret: str | None = None, timeout: float = 10.0):
     params = dict(params or {})
     headers = {}
+    prio = getattr(_prio_local, "prio", None)
+    if prio is None:
+        prio = PRIO_ORDER if signed else PRIO_DATA
+    weight, orders = request_weight(method, path, params)
+    weight_governor.acquire(weight, orders, prio)
     if signed:
         ts = now_ms()
         params.update({"timestamp": ts, "recvWindow": RECV_WINDOW})
@@ -46,38 +610,28 @@ def api_get(path: str, params: dict | None = None, signed: bool = False, api_key
     else:
         if api_key:
             headers["X-MBX-APIKEY"] = api_key
-    r = requests.get(f"{API_URL}{path}", params=params, headers=headers, timeout=timeout)
+    if LATENCY_TRACE:
+        trace = getattr(_http_local, "trace", None)
+        if trace:
+            trace.mark("order_sent")
+    t0 = time.perf_counter()
+    ok = False
+    try:
+        r = http_session().request(method, f"{API_URL}{path}", params=params, headers=headers, timeout=timeout)
+        ok = r.status_code < 400
+        weight_governor.update(r.headers, r.status_code)
+    finally:
+        record_http(method, path, time.perf_counter() - t0, ok)
     return r.json()
 
+def api_get(path: str, params: dict | None = None, signed: bool = False, api_key: str | None = None, secret: str | None = None, timeout: float = 10.0):
+    return api_request("GET", path, params, signed, api_key, secret, timeout)
+
 def api_post(path: str, params: dict | None = None, signed: bool = False, api_key: str | None = None, secret: str | None = None, timeout: float = 10.0):
-    params = dict(params or {})
-    headers = {}
-    if signed:
-        ts = now_ms()
-        params.update({"timestamp": ts, "recvWindow": RECV_WINDOW})
-        sig = _sign(params, secret or "")
-        params["signature"] = sig
-        headers["X-MBX-APIKEY"] = api_key or ""
-    else:
-        if api_key:
-            headers["X-MBX-APIKEY"] = api_key
-    r = requests.post(f"{API_URL}{path}", params=params, headers=headers, timeout=timeout)
-    return r.json()
+    return api_request("POST", path, params, signed, api_key, secret, timeout)
 
 def api_delete(path: str, params: dict | None = None, signed: bool = False, api_key: str | None = None, secret: str | None = None, timeout: float = 10.0):
-    params = dict(params or {})
-    headers = {}
-    if signed:
-        ts = now_ms()
-        params.update({"timestamp": ts, "recvWindow": RECV_WINDOW})
-        sig = _sign(params, secret or "")
-        params["signature"] = sig
-        headers["X-MBX-APIKEY"] = api_key or ""
-    else:
-        if api_key:
-            headers["X-MBX-APIKEY"] = api_key
-    r = requests.delete(f"{API_URL}{path}", params=params, headers=headers, timeout=timeout)
-    return r.json()
+    return api_request("DELETE", path, params, signed, api_key, secret, timeout)
 
 def sync_time():
     global time_offset_ms
@@ -91,10 +645,15 @@ def sync_time():
         pass
 
 # 全局状态
-selected_symbols = set()
+# 交易对集合与 symbol_filters/prices/indicators/symbol_quote_volume 均为写时复制：
+# 写入方在 universe_lock 内构造新对象后整体替换全局引用，读取方直接引用当前对象，无需加锁
+selected_symbols: frozenset[str] = frozenset()
 symbol_filters: dict[str, dict] = {}
-prices: dict[str, deque] = {}
+prices: dict[str, "PriceSeries"] = {}
+indicators: dict[str, "IndicatorEngine"] = {}
 last_macd_dir: dict[str, str] = {}
+symbol_quote_volume: dict[str, float] = {}
+minute_proximity: dict[str, float] = {}
 last_attempt_at: dict[tuple[str, str], float] = {}
 printed_start = False
 printed_data_acc = False
@@ -104,10 +663,12 @@ printed_trade_banner = False
 g_api_key = ""
 g_secret = ""
 
-lock = threading.Lock()
+universe_lock = threading.Lock()
+pending_installs: dict[str, tuple["PriceSeries", "IndicatorEngine", int]] = {}
 countdown_done = False
 countdown_start = None
-pos_pnl_history: dict[tuple[str, str], deque] = {}
+# 仅保存当前持仓：risk_loop 在持仓消失后删除对应键
+pos_pnl_history: dict[tuple[str, str], "PnlWindow"] = {}
 pos_first_seen: dict[tuple[str, str], float] = {}
 
 
@@ -133,28 +694,115 @@ def leverage_bracket_max(symbol: str) -> int:
         pass
     return 20
 
-def set_leverage_for_symbols():
-    info = fetch_exchange_info()
-    if not isinstance(info, dict):
-        print("获取 exchangeInfo 失败")
+# 杠杆设置：只处理选中的交易对；已生效的杠杆与杠杆分层上限缓存到 leverage.json（按 API Key 区分账户），
+# 启动时先用 /fapi/v1/symbolConfig 一次取回当前杠杆，已是目标值的跳过，其余并发设置，按行情优先级受权重控制
+leverage_lock = threading.Lock()
+leverage_applied: dict[str, int] = {}
+leverage_brackets: dict[str, int] = {}
+leverage_cache_loaded = False
+
+def _leverage_account() -> str:
+    return hashlib.sha256(g_api_key.encode()).hexdigest()[:12]
+
+def _load_leverage_cache():
+    global leverage_cache_loaded
+    leverage_cache_loaded = True
+    try:
+        with open(os.path.join(os.getcwd(), LEVERAGE_CACHE_FILE), "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception:
         return
-    syms = [s for s in info.get("symbols", []) if s.get("status") == "TRADING"]
-    for s in syms:
-        sym = s.get("symbol")
-        if not sym:
-            continue
-        target = 50 if sym in ("BTCUSDT", "ETHUSDT") else 20
+    if time.time() - float(data.get("brackets_at", 0) or 0) <= LEVERAGE_BRACKET_TTL:
+        leverage_brackets.update({k: int(v) for k, v in (data.get("brackets") or {}).items()})
+    if data.get("account") == _leverage_account():
+        leverage_applied.update({k: int(v) for k, v in (data.get("leverage") or {}).items()})
+
+def _save_leverage_cache():
+    path = os.path.join(os.getcwd(), LEVERAGE_CACHE_FILE)
+    tmp = path + ".tmp"
+    data = {
+        "account": _leverage_account(),
+        "leverage": dict(leverage_applied),
+        "brackets": dict(leverage_brackets),
+        "brackets_at": time.time() if leverage_brackets else 0,
+    }
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except Exception:
+        pass
+
+def _refresh_leverage_state():
+    # 账户当前杠杆以交易所为准（可能在网页端被改过）；接口不可用时沿用缓存
+    try:
+        arr = api_get("/fapi/v1/symbolConfig", signed=True, api_key=g_api_key, secret=g_secret)
+        if isinstance(arr, list):
+            for it in arr:
+                try:
+                    leverage_applied[it["symbol"]] = int(it["leverage"])
+                except Exception:
+                    continue
+    except Exception:
+        pass
+    if not leverage_brackets:
         try:
-            j = api_post("/fapi/v1/leverage", {"symbol": sym, "leverage": target}, signed=True, api_key=g_api_key, secret=g_secret)
-            if isinstance(j, dict) and j.get("leverage"):
-                continue
-            mx = leverage_bracket_max(sym)
-            tgt = min(target, mx)
-            j2 = api_post("/fapi/v1/leverage", {"symbol": sym, "leverage": tgt}, signed=True, api_key=g_api_key, secret=g_secret)
-            # 静默处理
-        except Exception as e:
+            arr = api_get("/fapi/v1/leverageBracket", signed=True, api_key=g_api_key, secret=g_secret)
+            if isinstance(arr, list):
+                for it in arr:
+                    mx = max((int(b.get("initialLeverage", 0) or 0) for b in it.get("brackets", [])), default=0)
+                    if it.get("symbol") and mx:
+                        leverage_brackets[it["symbol"]] = mx
+        except Exception:
             pass
-    print("✓ 杠杆设置完成")
+
+def leverage_target(sym: str) -> int:
+    target = 50 if sym in ("BTCUSDT", "ETHUSDT") else 20
+    mx = leverage_brackets.get(sym)
+    return min(target, mx) if mx else target
+
+def _apply_leverage(sym: str) -> bool:
+    tgt = leverage_target(sym)
+    # 杠杆决定交易对能否发布，按下单优先级发出，不和行情请求一起被限流丢弃
+    with request_priority(PRIO_ORDER):
+        j = api_post("/fapi/v1/leverage", {"symbol": sym, "leverage": tgt}, signed=True, api_key=g_api_key, secret=g_secret)
+        if not (isinstance(j, dict) and j.get("leverage")):
+            mx = leverage_bracket_max(sym)
+            leverage_brackets[sym] = mx
+            tgt = min(tgt, mx)
+            j = api_post("/fapi/v1/leverage", {"symbol": sym, "leverage": tgt}, signed=True, api_key=g_api_key, secret=g_secret)
+    if isinstance(j, dict) and j.get("leverage"):
+        leverage_applied[sym] = int(j["leverage"])
+        return True
+    return False
+
+def _safe_call(fn, *args):
+    try:
+        return fn(*args)
+    except Exception:
+        return False
+
+def set_leverage_for_symbols(syms=None) -> set[str]:
+    # 返回仍未达到目标杠杆的交易对；已是目标的不发请求，可每轮对全部候选调用
+    syms = sorted(selected_symbols if syms is None else syms)
+    if not syms:
+        return set()
+    t0 = time.perf_counter()
+    with leverage_lock:
+        if not leverage_cache_loaded:
+            _load_leverage_cache()
+            _refresh_leverage_state()
+        todo = [s for s in syms if leverage_applied.get(s) != leverage_target(s)]
+        failed = 0
+        if todo:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=LEVERAGE_WORKERS, thread_name_prefix="leverage") as ex:
+                for ok in ex.map(lambda s: _safe_call(_apply_leverage, s), todo):
+                    failed += 0 if ok else 1
+        _save_leverage_cache()
+        missing = {s for s in todo if leverage_applied.get(s) != leverage_target(s)}
+    if todo:
+        print(f"✓ 杠杆设置完成: 设置 {len(todo) - failed}  已是目标跳过 {len(syms) - len(todo)}  失败 {failed}  用时 {time.perf_counter() - t0:.1f}s")
+    return missing
 
 def get_filters_from_symbol(symbol_obj: dict) -> dict:
     filters = symbol_obj.get("filters", [])
@@ -184,24 +832,42 @@ def get_filters_from_symbol(symbol_obj: dict) -> dict:
         "pricePrecision": int(symbol_obj.get("pricePrecision", symbol_obj.get("quotePrecision", 0)) or 0),
     }
 
+def publish_universe(entries: list[tuple[str, dict, float]]) -> set[str]:
+    # 新的交易对集合整体替换；已有交易对沿用原价格序列，新交易对建空序列。返回新增的交易对
+    global selected_symbols, symbol_filters, symbol_quote_volume, prices, indicators
+    with universe_lock:
+        before = selected_symbols
+        new_prices = dict(prices)
+        new_inds = dict(indicators)
+        for sym, _, _ in entries:
+            if sym not in new_prices:
+                new_prices[sym] = PriceSeries()
+                new_inds[sym] = IndicatorEngine()
+        prices = new_prices
+        indicators = new_inds
+        symbol_filters = {sym: flt for sym, flt, _ in entries}
+        symbol_quote_volume = {sym: qv for sym, _, qv in entries}
+        # 最后发布交易对集合，读取方看到某个交易对时其序列与过滤器已就绪
+        selected_symbols = frozenset(sym for sym, _, _ in entries)
+    return set(selected_symbols) - before
+
 def filter_symbols_once():
     info = fetch_exchange_info()
     if not isinstance(info, dict):
-        with lock:
-            selected_symbols.clear()
-            symbol_filters.clear()
-            for sym in ("BTCUSDT", "ETHUSDT"):
-                selected_symbols.add(sym)
-                symbol_filters[sym] = {
-                    "stepSize": 0.0,
-                    "tickSize": 0.0,
-                    "minQty": 0.0,
-                    "minNotional": 0.0,
-                    "quantityPrecision": 0,
-                    "pricePrecision": 0,
-                }
-                if sym not in prices:
-                    prices[sym] = deque(maxlen=1500)
+        default_flt = {
+            "stepSize": 0.0,
+            "tickSize": 0.0,
+            "minQty": 0.0,
+            "minNotional": 0.0,
+            "quantityPrecision": 0,
+            "pricePrecision": 0,
+        }
+        try:
+            failed = set_leverage_for_symbols({"BTCUSDT", "ETHUSDT"})
+        except Exception:
+            failed = {"BTCUSDT", "ETHUSDT"}
+        publish_universe([(sym, dict(default_flt), 0.0) for sym in ("BTCUSDT", "ETHUSDT")
+                          if sym not in failed or sym in selected_symbols])
         print(f"✓ 使用默认交易对: {len(selected_symbols)}")
         return
     raw = []
@@ -232,15 +898,16 @@ def filter_symbols_once():
             vol_map[sym] = qv
     raw2 = [(sym, flt, vol_map.get(sym, 0.0)) for sym, flt in raw if vol_map.get(sym, 0.0) >= 30000000]
     raw2.sort(key=lambda x: x[2], reverse=True)
-    with lock:
-        selected_symbols.clear()
-        symbol_filters.clear()
-        for sym, flt, _ in raw2:
-            selected_symbols.add(sym)
-            symbol_filters[sym] = flt
-            if sym not in prices:
-                prices[sym] = deque(maxlen=1500)
+    # 每轮对全部候选补设未达目标的杠杆（上一轮失败的会重试）；新交易对设好杠杆才对外发布，避免以默认杠杆开仓
+    try:
+        failed = set_leverage_for_symbols({sym for sym, _, _ in raw2})
+    except Exception:
+        failed = {sym for sym, _, _ in raw2}
+    raw2 = [e for e in raw2 if e[0] not in failed or e[0] in selected_symbols]
+    added = publish_universe(raw2)
     print(f"✓ 符合条件的交易对数量: {len(selected_symbols)}")
+    if WARM_START and warm_started and added:
+        threading.Thread(target=warm_start, args=(sorted(added), {}), daemon=True).start()
 
 def symbol_filter_loop():
     while True:
@@ -250,17 +917,291 @@ def symbol_filter_loop():
             pass
         time.sleep(600)
 
+# 运行状态快照：秒级价格、MACD 单次触发标记、开仓冷却、持仓盈亏历史与首次出现时间
+# 定期整体写入 state.snap（临时文件 + fsync + 原子替换，带 CRC 校验），启动时恢复；
+# 价格序列另用 aggTrades 按秒重采样回补快照到当前时刻的空档（每秒取该秒结束前最后一笔成交价，与 ticker_loop 每秒取价一致）
+warm_started = False
+state_restored = False
+restored_prices: dict[str, tuple[array, array]] = {}
+state_snapshot_lock = threading.Lock()
+
+def _snapshot_path() -> str:
+    return os.path.join(os.getcwd(), STATE_SNAPSHOT_FILE)
+
+def _pack_str(buf: bytearray, s: str):
+    b = s.encode()
+    buf += struct.pack("<H", len(b))
+    buf += b
+
+def _unpack_str(data: bytes, off: int) -> tuple[str, int]:
+    (n,) = struct.unpack_from("<H", data, off)
+    off += 2
+    return data[off:off + n].decode(), off + n
+
+def save_state_snapshot(path: str | None = None):
+    if not state_restored:
+        # 尚未恢复就退出时不覆盖旧快照
+        return
+    # 序列按 seqlock 取一致副本，字典只做浅拷贝，不阻塞 1 秒写入线程
+    rings = [(sym,) + ps.snapshot() for sym, ps in prices.items()]
+    macd = dict(last_macd_dir)
+    attempts = dict(last_attempt_at)
+    hist = [(k,) + w.export() for k, w in list(pos_pnl_history.items())]
+    first_seen = dict(pos_first_seen)
+    buf = bytearray()
+    buf += struct.pack("<dI", time.time(), len(rings))
+    for sym, ts, px in rings:
+        _pack_str(buf, sym)
+        buf += struct.pack("<I", len(ts))
+        buf += ts.tobytes()
+        buf += px.tobytes()
+    buf += struct.pack("<I", len(macd))
+    for sym, d in macd.items():
+        _pack_str(buf, sym)
+        _pack_str(buf, d)
+    for tbl in (attempts, first_seen):
+        buf += struct.pack("<I", len(tbl))
+        for (sym, side), v in tbl.items():
+            _pack_str(buf, sym)
+            _pack_str(buf, side)
+            buf += struct.pack("<d", v)
+    buf += struct.pack("<I", len(hist))
+    for (sym, side), tv, pv in hist:
+        _pack_str(buf, sym)
+        _pack_str(buf, side)
+        buf += struct.pack("<I", len(tv))
+        buf += tv.tobytes()
+        buf += pv.tobytes()
+    path = path or _snapshot_path()
+    tmp = path + ".tmp"
+    with state_snapshot_lock:
+        with open(tmp, "wb") as f:
+            f.write(STATE_SNAPSHOT_MAGIC)
+            f.write(struct.pack("<I", zlib.crc32(buf)))
+            f.write(buf)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+def load_state_snapshot(path: str | None = None) -> dict | None:
+    path = path or _snapshot_path()
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    if data[:4] != STATE_SNAPSHOT_MAGIC or len(data) < 8:
+        return None
+    (crc,) = struct.unpack_from("<I", data, 4)
+    data = data[8:]
+    if zlib.crc32(data) != crc:
+        return None
+    out = {"prices": {}, "macd": {}, "attempts": {}, "first_seen": {}, "hist": {}}
+    try:
+        saved_at, count = struct.unpack_from("<dI", data, 0)
+        out["saved_at"] = saved_at
+        off = 12
+        for _ in range(count):
+            sym, off = _unpack_str(data, off)
+            (n,) = struct.unpack_from("<I", data, off)
+            off += 4
+            ts = array("q")
+            ts.frombytes(data[off:off + 8 * n])
+            off += 8 * n
+            px = array("d")
+            px.frombytes(data[off:off + 8 * n])
+            off += 8 * n
+            out["prices"][sym] = (ts, px)
+        (count,) = struct.unpack_from("<I", data, off)
+        off += 4
+        for _ in range(count):
+            sym, off = _unpack_str(data, off)
+            d, off = _unpack_str(data, off)
+            out["macd"][sym] = d
+        for name in ("attempts", "first_seen"):
+            (count,) = struct.unpack_from("<I", data, off)
+            off += 4
+            for _ in range(count):
+                sym, off = _unpack_str(data, off)
+                side, off = _unpack_str(data, off)
+                (v,) = struct.unpack_from("<d", data, off)
+                off += 8
+                out[name][(sym, side)] = v
+        (count,) = struct.unpack_from("<I", data, off)
+        off += 4
+        for _ in range(count):
+            sym, off = _unpack_str(data, off)
+            side, off = _unpack_str(data, off)
+            (n,) = struct.unpack_from("<I", data, off)
+            off += 4
+            tv = array("d")
+            tv.frombytes(data[off:off + 8 * n])
+            off += 8 * n
+            pv = array("d")
+            pv.frombytes(data[off:off + 8 * n])
+            off += 8 * n
+            out["hist"][(sym, side)] = (tv, pv)
+    except (struct.error, UnicodeDecodeError):
+        return None
+    return out
+
+def restore_state_snapshot(path: str | None = None):
+    # 启动时、各线程开始写入之前调用；快照超过价格序列容量的时长则视为过期，只保留冷却时间
+    global state_restored, restored_prices
+    snap = load_state_snapshot(path)
+    state_restored = True
+    if snap is None:
+        return
+    age = time.time() - snap["saved_at"]
+    last_attempt_at.update(snap["attempts"])
+    if age > PRICE_MAXLEN:
+        print(f"状态快照已过期（{age:.0f} 秒前），仅恢复开仓冷却")
+        return
+    restored_prices = snap["prices"]
+    last_macd_dir.update(snap["macd"])
+    pos_first_seen.update(snap["first_seen"])
+    for key, (tv, pv) in snap["hist"].items():
+        w = PnlWindow()
+        for t, p in zip(tv, pv):
+            w.append(t, p)
+        pos_pnl_history[key] = w
+    print(f"✓ 已恢复状态快照（{age:.0f} 秒前）: 价格 {len(restored_prices)}  MACD 标记 {len(snap['macd'])}  持仓历史 {len(snap['hist'])}")
+
+def state_snapshot_loop():
+    while True:
+        time.sleep(STATE_SNAPSHOT_SEC)
+        try:
+            save_state_snapshot()
+        except Exception:
+            pass
+
+def fetch_agg_prices(sym: str, start_ms: int, end_ms: int, max_pages: int | None = None) -> tuple[list[int], list[float]]:
+    # 返回 [start_ms, end_ms) 内每个整秒的价格；首笔成交之前的秒不输出。
+    # 从最新成交按 fromId 往前翻，最多 max_pages 页：页数不够时保留离现在最近的一段；
+    # 中途某页失败时已取到的页照常使用，一页都没取到才抛出
+    trades: list[tuple[int, float]] = []
+    params = {"symbol": sym, "limit": 1000}
+    pages = BACKFILL_MAX_PAGES if max_pages is None else max_pages
+    for _ in range(max(1, pages)):
+        try:
+            arr = api_get("/fapi/v1/aggTrades", params)
+        except Exception:
+            if trades:
+                break
+            raise
+        if not isinstance(arr, list) or not arr:
+            break
+        page = []
+        for it in arr:
+            try:
+                page.append((int(it["T"]), float(it["p"])))
+            except Exception:
+                continue
+        trades[:0] = page
+        first_id = int(arr[0]["a"])
+        if len(arr) < 1000 or int(arr[0].get("T", 0)) < start_ms or first_id <= 0:
+            break
+        params = {"symbol": sym, "fromId": max(0, first_id - 1000), "limit": 1000}
+        if first_id < 1000:
+            # 最早一页不满 1000 笔，截掉与已取页重叠的部分
+            params["limit"] = first_id
+    ts_out: list[int] = []
+    px_out: list[float] = []
+    i = 0
+    last_px = None
+    sec = (start_ms // 1000 + 1) * 1000
+    while sec < end_ms:
+        while i < len(trades) and trades[i][0] < sec:
+            last_px = trades[i][1]
+            i += 1
+        if last_px is not None:
+            ts_out.append(sec)
+            px_out.append(last_px)
+        sec += 1000
+    return ts_out, px_out
+
+def install_history(sym: str, hist_t, hist_p) -> int:
+    # 历史样本放在已有实时样本之前，在本线程重建序列与增量指标，交给 ticker_loop 替换（序列只有一个写入方）
+    cur = prices.get(sym)
+    live = list(zip(*(x.tolist() for x in cur.snapshot()))) if cur is not None and len(cur) else []
+    first_live = live[0][0] if live else None
+    merged = [(t, p) for t, p in zip(hist_t, hist_p) if first_live is None or t < first_live]
+    merged = (merged + live)[-PRICE_MAXLEN:]
+    if not merged:
+        return 0
+    ps = PriceSeries()
+    eng = IndicatorEngine()
+    for t, p in merged:
+        ps.append(t, p)
+    eng.extend([p for _, p in merged])
+    with universe_lock:
+        pending_installs[sym] = (ps, eng, merged[-1][0])
+    return len(ps)
+
+def apply_pending_installs():
+    # 由 ticker_loop 调用：把重建期间新到的样本补进新序列，再写时复制替换 prices/indicators
+    global prices, indicators
+    with universe_lock:
+        if not pending_installs:
+            return
+        new_prices = dict(prices)
+        new_inds = dict(indicators)
+        for sym, (ps, eng, last_t) in pending_installs.items():
+            cur = new_prices.get(sym)
+            if cur is not None:
+                for t, p in zip(*cur.snapshot()):
+                    if t > last_t:
+                        ps.append(t, p)
+                        eng.push(p)
+            new_prices[sym] = ps
+            new_inds[sym] = eng
+        pending_installs.clear()
+        prices = new_prices
+        indicators = new_inds
+
+def warm_start(syms, snapshot: dict | None = None):
+    global warm_started
+    t0 = time.perf_counter()
+    snap = restored_prices if snapshot is None else snapshot
+    now = now_ms()
+    stats = {"snapshot": 0, "backfill": 0, "failed": 0}
+    stats_lock = threading.Lock()
+    def warm_one(sym: str):
+        kind = "backfill"
+        hist_t: list[int] = []
+        hist_p: list[float] = []
+        s = snap.get(sym)
+        if s is not None and len(s[0]) and now - s[0][-1] <= PRICE_MAXLEN * 1000:
+            kind = "snapshot"
+            hist_t, hist_p = s[0].tolist(), s[1].tolist()
+            start = hist_t[-1]
+        else:
+            start = now - WARM_START_SEC * 1000
+        try:
+            with request_priority(PRIO_BACKFILL):
+                gap_t, gap_p = fetch_agg_prices(sym, start, now)
+        except Exception:
+            gap_t, gap_p = [], []
+            if kind == "backfill":
+                kind = "failed"
+        n = install_history(sym, hist_t + gap_t, hist_p + gap_p)
+        with stats_lock:
+            stats[kind if n else "failed"] += 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=BACKFILL_WORKERS, thread_name_prefix="warm") as ex:
+        list(ex.map(warm_one, list(syms)))
+    if snapshot is None:
+        restored_prices.clear()
+    warm_started = True
+    print(f"✓ 价格序列预热: 快照 {stats['snapshot']}  回补 {stats['backfill']}  失败 {stats['failed']}  用时 {time.perf_counter() - t0:.1f}s")
+
 def get_series_stats() -> tuple[int, int]:
-    with lock:
-        if not selected_symbols:
-            return 0, 0
-        mx = 0
-        n = 0
-        for sym in selected_symbols:
-            dq = prices.get(sym)
-            mx = max(mx, len(dq) if dq else 0)
-            n += 1
-        return mx, n
+    syms = selected_symbols
+    series = prices
+    mx = 0
+    for sym in syms:
+        dq = series.get(sym)
+        mx = max(mx, len(dq) if dq else 0)
+    return mx, len(syms)
 
 def countdown_loop():
     global countdown_done
@@ -389,106 +1330,1148 @@ def kdj_from_close(series: list[float], n: int, k_period: int, d_period: int):
     j = [3 * a - 2 * b for a, b in zip(k, d)]
     return k, d, j
 
-def get_account_info():
-    j = api_get("/fapi/v3/account", signed=True, api_key=g_api_key, secret=g_secret)
-    return j if isinstance(j, dict) else {}
+# 增量指标引擎：每个交易对维护与 prices 窗口对齐的累加状态，新 tick 到达时 O(1) 更新，
+# 结果与上面的批量函数（以窗口首元素为种子）一致
+PRICE_MAXLEN = 1500
+EMA_PERIODS = (7, 25, 60, 100, 200, 500)
+RSI_PERIODS = (80, 200, 500)
+MACD_FAST, MACD_SLOW, MACD_SIGNAL = 60, 200, 60
+BOLL_PERIOD = 200
+KDJ_N, KDJ_K, KDJ_D = 20, 80, 200
 
-def get_positions():
-    arr = api_get("/fapi/v3/positionRisk", signed=True, api_key=g_api_key, secret=g_secret)
-    return arr if isinstance(arr, list) else []
+class _Ring:
+    __slots__ = ("size", "buf", "n", "head")
 
-def current_margin_ratio() -> float:
-    acc = get_account_info()
-    try:
-        tmm = float(acc.get("totalMaintMargin", 0) or 0)
-        tmb = float(acc.get("totalMarginBalance", 0) or 0)
-        if tmb <= 0:
-            return 0.0
-        return tmm / tmb * 100.0
-    except Exception:
-        return 0.0
+    def __init__(self, size: int):
+        self.size = size
+        self.buf = array("d", bytes(8 * size))
+        self.n = 0
+        self.head = 0
 
-def adjust_qty(sym: str, qty: float) -> float:
-    flt = symbol_filters.get(sym, {})
-    step = float(flt.get("stepSize", 0) or 0)
-    min_qty = float(flt.get("minQty", 0) or 0)
-    if step and qty > 0:
-        qty = math.floor(qty / step) * step
-    if qty < min_qty:
-        return 0.0
-    # 避免科学计数法/浮点误差
-    qp = int(flt.get("quantityPrecision", 0) or 0)
-    qty = float(f"{qty:.{max(qp, 0)}f}")
-    return qty
+    def append(self, x: float):
+        self.buf[self.head] = x
+        self.head += 1
+        if self.head == self.size:
+            self.head = 0
+        if self.n < self.size:
+            self.n += 1
 
-def adjust_price(sym: str, price: float) -> float:
-    flt = symbol_filters.get(sym, {})
-    tick = float(flt.get("tickSize", 0) or 0)
-    pp = int(flt.get("pricePrecision", 0) or 0)
-    if tick and price > 0:
-        price = round(price / tick) * tick
-    price = float(f"{price:.{max(pp, 0)}f}")
-    return price
+    def __len__(self) -> int:
+        return self.n
 
-def fmt_price(sym: str, price: float) -> float:
-    pp = int(symbol_filters.get(sym, {}).get("pricePrecision", 0) or 0)
-    return float(f"{price:.{max(pp, 0)}f}")
+    def __getitem__(self, i: int) -> float:
+        if i < 0:
+            i += self.n
+        return self.buf[(self.head - self.n + i) % self.size]
 
-def place_market(sym: str, side: str, position_side: str, qty: float) -> dict:
-    p = {"symbol": sym, "side": side, "type": "MARKET", "positionSide": position_side, "quantity": qty}
-    j = api_post("/fapi/v1/order", p, signed=True, api_key=g_api_key, secret=g_secret)
-    return j if isinstance(j, dict) else {"error": j}
+# 价格序列：时间戳(int64)与价格(float64)分列存储的环形缓冲；每个值同时写入 i 和 i+maxlen，
+# 因此任意时刻最近 n 个值在底层数组中都是连续的，可直接给出按时间顺序的零拷贝视图
+class PriceSeries:
+    # 单写入方（ticker_loop）；seq 为序号锁，写入期间为奇数，读取方据此重试以取得一致副本
+    __slots__ = ("maxlen", "t", "p", "n", "head", "seq")
 
-def query_order(sym: str, order_id: int | None = None, client_id: str | None = None) -> dict:
-    p = {"symbol": sym}
-    if order_id is not None:
-        p["orderId"] = order_id
-    if client_id:
-        p["origClientOrderId"] = client_id
-    j = api_get("/fapi/v1/order", p, signed=True, api_key=g_api_key, secret=g_secret)
-    return j if isinstance(j, dict) else {}
+    def __init__(self, maxlen: int = PRICE_MAXLEN):
+        self.maxlen = maxlen
+        self.t = array("q", bytes(16 * maxlen))
+        self.p = array("d", bytes(16 * maxlen))
+        self.n = 0
+        self.head = 0
+        self.seq = 0
 
-def wait_fill_avg_price(sym: str, order_id: int | None, client_id: str | None) -> float:
-    for _ in range(30):
-        j = query_order(sym, order_id, client_id)
-        try:
-            ap = float(j.get("avgPrice", 0) or 0)
-        except Exception:
-            ap = 0.0
-        if ap > 0:
-            return ap
-        time.sleep(1)
-    return 0.0
+    def append(self, ts: int, price: float):
+        self.seq += 1
+        i = self.head
+        j = i + self.maxlen
+        self.t[i] = ts
+        self.t[j] = ts
+        self.p[i] = price
+        self.p[j] = price
+        i += 1
+        self.head = 0 if i == self.maxlen else i
+        if self.n < self.maxlen:
+            self.n += 1
+        self.seq += 1
 
-def place_tp_trailing(sym: str, position_side: str, entry: float, qty: float, is_long: bool):
-    if is_long:
-        activation = entry * 1.02
-        side = "SELL"
-    else:
-        activation = entry * 0.98
-        side = "BUY"
-    activation = adjust_price(sym, activation)
-    p = {
-        "symbol": sym,
-        "side": side,
-        "type": "TRAILING_STOP_MARKET",
-        "positionSide": position_side,
-        "quantity": qty,
-        "activationPrice": activation,
-        "callbackRate": 0.5,
-    }
-    j = api_post("/fapi/v1/order", p, signed=True, api_key=g_api_key, secret=g_secret)
-    return j
+    def __len__(self) -> int:
+        return self.n
 
-def place_tp_limit_or_market(sym: str, position_side: str, entry: float, qty: float, is_long: bool, use_market: bool = True):
-    if is_long:
-        target = entry * 1.01
-        side = "SELL"
-    else:
-        target = entry * 0.99
-        side = "BUY"
-    target = adjust_price(sym, target)
-    if use_market:
+    def _span(self) -> tuple[int, int]:
+        s = (self.head - self.n) % self.maxlen
+        return s, s + self.n
+
+    def view(self) -> tuple[memoryview, memoryview]:
+        # 零拷贝视图，仅在下一次 append 之前有效；只供写入线程自身使用，其他线程用 snapshot()/closes()
+        s, e = self._span()
+        return memoryview(self.t)[s:e], memoryview(self.p)[s:e]
+
+    def snapshot(self) -> tuple[array, array]:
+        while True:
+            seq = self.seq
+            if seq & 1:
+                time.sleep(0)
+                continue
+            s, e = self._span()
+            ts = self.t[s:e]
+            px = self.p[s:e]
+            if self.seq == seq:
+                return ts, px
+
+    def closes(self) -> array:
+        while True:
+            seq = self.seq
+            if seq & 1:
+                time.sleep(0)
+                continue
+            s, e = self._span()
+            px = self.p[s:e]
+            if self.seq == seq:
+                return px
+
+    def last(self) -> tuple[int, float] | None:
+        if not self.n:
+            return None
+        i = self.head + self.maxlen - 1
+        return self.t[i], self.p[i]
+
+_pow_cache: dict[tuple[float, int], list[float]] = {}
+_geo_cache: dict[tuple[float, float, int], list[float]] = {}
+
+def _pow_table(c: float, n: int) -> list[float]:
+    key = (c, n)
+    tbl = _pow_cache.get(key)
+    if tbl is None:
+        tbl = [1.0] * n
+        for i in range(1, n):
+            tbl[i] = tbl[i - 1] * c
+        _pow_cache[key] = tbl
+    return tbl
+
+def _geo_table(q: float, r: float, n: int) -> list[float]:
+    # S(T) = sum_{j=1..T} q^(T-j) * r^j
+    key = (q, r, n)
+    tbl = _geo_cache.get(key)
+    if tbl is None:
+        tbl = [0.0] * n
+        rp = 1.0
+        for i in range(1, n):
+            rp *= r
+            tbl[i] = tbl[i - 1] * q + rp
+        _geo_cache[key] = tbl
+    return tbl
+
+class _RollingSum:
+    __slots__ = ("ring", "s", "s2")
+
+    def __init__(self, period: int):
+        self.ring = _Ring(period)
+        self.s = 0.0
+        self.s2 = 0.0
+
+    def push(self, x: float):
+        r = self.ring
+        if r.n == r.size:
+            y = r.buf[r.head]
+            self.s -= y
+            self.s2 -= y * y
+        r.append(x)
+        self.s += x
+        self.s2 += x * x
+        if r.head == 0:
+            # 每轮重新求和，消除浮点累计误差
+            self.s = math.fsum(r.buf)
+            self.s2 = math.fsum(v * v for v in r.buf)
+
+    def mean(self) -> float:
+        return self.s / self.ring.n
+
+    def std(self) -> float:
+        n = self.ring.n
+        m = self.s / n
+        return math.sqrt(max((self.s2 / n) - (m * m), 0.0))
+
+class IndicatorEngine:
+    def __init__(self, maxlen: int = PRICE_MAXLEN):
+        self.maxlen = maxlen
+        self.count = 0
+        self.px = _Ring(maxlen)
+        # 全局累加量 A(t)=Σ k(1-k)^(t-i) x_i；窗口内 ema(j) = A(j) + (1-k)^j (x0 - A(0))
+        self.ema_k = {p: 2 / (p + 1) for p in EMA_PERIODS}
+        self.ema_acc = {p: _Ring(maxlen) for p in EMA_PERIODS}
+        self.ema_pow = {p: _pow_table(1 - self.ema_k[p], maxlen) for p in EMA_PERIODS}
+        gk = 2 / (MACD_SIGNAL + 1)
+        self.macd_k = gk
+        self.macd_acc = _Ring(maxlen)
+        self.macd_pow = _pow_table(1 - gk, maxlen)
+        self.macd_geo_fast = _geo_table(1 - gk, 1 - self.ema_k[MACD_FAST], maxlen)
+        self.macd_geo_slow = _geo_table(1 - gk, 1 - self.ema_k[MACD_SLOW], maxlen)
+        self.gain_acc = {p: _Ring(maxlen) for p in RSI_PERIODS}
+        self.loss_acc = {p: _Ring(maxlen) for p in RSI_PERIODS}
+        self.rsi_pow = {p: _pow_table(1 - 1 / p, maxlen) for p in RSI_PERIODS}
+        self.boll = _RollingSum(BOLL_PERIOD)
+        self.hh: deque = deque()
+        self.ll: deque = deque()
+        self.rsv = _RollingSum(KDJ_K)
+        self.kk = _RollingSum(KDJ_D)
+        self.kdj_hist: deque = deque(maxlen=4)
+        self.last: dict | None = None
+
+    def _ema_at(self, p: int, j: int) -> float:
+        acc = self.ema_acc[p]
+        return acc[j] + self.ema_pow[p][j] * (self.px[0] - acc[0])
+
+    def _rsi_at_last(self, p: int) -> float:
+        T = len(self.px) - 1
+        if T <= 0:
+            return 50.0
+        x0 = self.px[0]
+        x1 = self.px[1]
+        g1 = max(x1 - x0, 0.0)
+        l1 = max(x0 - x1, 0.0)
+        c = self.rsi_pow[p][T - 1]
+        ga = self.gain_acc[p]
+        la = self.loss_acc[p]
+        avg_gain = ga[T] + c * (g1 - ga[1])
+        avg_loss = la[T] + c * (l1 - la[1])
+        rs = (avg_gain / avg_loss) if avg_loss > 1e-12 else 999999.0
+        return 100.0 - (100.0 / (1.0 + rs))
+
+    def push(self, x: float, snapshot: bool = True):
+        prev = self.px[-1] if self.px.n else None
+        t = self.count
+        self.count += 1
+        self.px.append(x)
+        for p in EMA_PERIODS:
+            acc = self.ema_acc[p]
+            k = self.ema_k[p]
+            acc.append((acc[-1] if acc.n else 0.0) * (1 - k) + k * x)
+        d = self.ema_acc[MACD_FAST][-1] - self.ema_acc[MACD_SLOW][-1]
+        ma = self.macd_acc
+        ma.append((ma[-1] if ma.n else 0.0) * (1 - self.macd_k) + self.macd_k * d)
+        change = 0.0 if prev is None else x - prev
+        gain = max(change, 0.0)
+        loss = max(-change, 0.0)
+        for p in RSI_PERIODS:
+            ga = self.gain_acc[p]
+            la = self.loss_acc[p]
+            ga.append((ga[-1] if ga.n else 0.0) * (1 - 1 / p) + gain / p)
+            la.append((la[-1] if la.n else 0.0) * (1 - 1 / p) + loss / p)
+        self.boll.push(x)
+        hh = self.hh
+        ll = self.ll
+        while hh and hh[-1][1] <= x:
+            hh.pop()
+        hh.append((t, x))
+        while ll and ll[-1][1] >= x:
+            ll.pop()
+        ll.append((t, x))
+        while hh[0][0] <= t - KDJ_N:
+            hh.popleft()
+        while ll[0][0] <= t - KDJ_N:
+            ll.popleft()
+        h = hh[0][1]
+        l = ll[0][1]
+        self.rsv.push(50.0 if h == l else (x - l) / (h - l) * 100.0)
+        kv = self.rsv.mean()
+        self.kk.push(kv)
+        dv = self.kk.mean()
+        self.kdj_hist.append((kv, dv, 3 * kv - 2 * dv))
+        if snapshot:
+            self.last = self._snapshot()
+
+    def extend(self, xs):
+        # 批量灌入历史（预热用），只在最后生成一次快照
+        for x in xs:
+            self.push(x, snapshot=False)
+        if self.px.n:
+            self.last = self._snapshot()
+
+    def _snapshot(self) -> dict:
+        T = len(self.px) - 1
+        out = {"n": T + 1, "cp": self.px[-1]}
+        for p in EMA_PERIODS:
+            out[f"ema{p}"] = self._ema_at(p, T)
+        out["ema7_hist"] = [self._ema_at(7, T - i) for i in range(1, min(10, T) + 1)]
+        out["ema25_hist"] = [self._ema_at(25, T - i) for i in range(1, min(3, T) + 1)]
+        out["ema500_hist"] = [self._ema_at(500, T - i) for i in range(1, min(10, T) + 1)]
+        x0 = self.px[0]
+        u = x0 - self.ema_acc[MACD_FAST][0]
+        v = x0 - self.ema_acc[MACD_SLOW][0]
+        ma = self.macd_acc
+        out["dif"] = out[f"ema{MACD_FAST}"] - out[f"ema{MACD_SLOW}"]
+        out["dea"] = (ma[T] - self.macd_pow[T] * ma[0]) + self.macd_k * (u * self.macd_geo_fast[T] - v * self.macd_geo_slow[T])
+        for p in RSI_PERIODS:
+            out[f"rsi{p}"] = self._rsi_at_last(p)
+        mid = self.boll.mean()
+        sd = self.boll.std()
+        out["mid"] = mid
+        out["up"] = mid + sd
+        out["down"] = mid - sd
+        out["k"] = [a for a, _, _ in self.kdj_hist]
+        out["d"] = [b for _, b, _ in self.kdj_hist]
+        out["j"] = [c for _, _, c in self.kdj_hist]
+        return out
+
+# 向量化批量指标：输入为 (交易对 × 时间) 的二维数组，一次计算全部交易对，语义与上面的列表版本一致
+def _np_ema_alpha(arr, alpha: float):
+    x = np.asarray(arr, dtype=np.float64)
+    out = np.empty_like(x)
+    if x.shape[1] == 0:
+        return out
+    c = 1.0 - alpha
+    if c <= 0.0:
+        out[:] = x
+        return out
+    # 分块前缀和：块内 e_j = c^(j+1) * (s + alpha * Σ x_i c^-(i+1))，块长保证 c^-L 不溢出
+    L = max(1, min(x.shape[1], int(300.0 / -math.log10(c))))
+    state = x[:, 0].copy()
+    for s0 in range(0, x.shape[1], L):
+        blk = x[:, s0:s0 + L]
+        n = blk.shape[1]
+        j = np.arange(1, n + 1, dtype=np.float64)
+        up = c ** j
+        acc = np.cumsum(blk / up, axis=1) * alpha
+        acc += state[:, None]
+        out[:, s0:s0 + n] = acc * up
+        state = out[:, s0 + n - 1]
+    return out
+
+def ema_np(arr, period: int):
+    x = np.atleast_2d(np.asarray(arr, dtype=np.float64))
+    if x.shape[1] == 0 or period <= 0:
+        return np.empty((x.shape[0], 0))
+    return _np_ema_alpha(x, 2 / (period + 1))
+
+def _np_window_sum(x, period: int):
+    cs = np.cumsum(x, axis=1)
+    out = cs.copy()
+    out[:, period:] -= cs[:, :-period]
+    return out
+
+def _np_window_len(T: int, period: int):
+    return np.minimum(np.arange(1, T + 1, dtype=np.float64), float(period))
+
+def sma_np(arr, period: int):
+    x = np.atleast_2d(np.asarray(arr, dtype=np.float64))
+    return _np_window_sum(x, period) / _np_window_len(x.shape[1], period)
+
+def rolling_std_np(arr, period: int):
+    x = np.atleast_2d(np.asarray(arr, dtype=np.float64))
+    if x.shape[1] == 0:
+        return x.copy()
+    # 按首列平移后再求方差，减少大价格下的相消误差
+    y = x - x[:, :1]
+    n = _np_window_len(x.shape[1], period)
+    mean = _np_window_sum(y, period) / n
+    var = _np_window_sum(y * y, period) / n - mean * mean
+    return np.sqrt(np.maximum(var, 0.0))
+
+def boll_np(arr, period: int, width: float = 1.0):
+    mid = sma_np(arr, period)
+    sd = rolling_std_np(arr, period)
+    return mid, mid + width * sd, mid - width * sd
+
+def macd_np(arr, fast: int, slow: int, signal: int):
+    dif = ema_np(arr, fast) - ema_np(arr, slow)
+    dea = ema_np(dif, signal)
+    return dif, dea
+
+def rsi_np(arr, period: int):
+    x = np.atleast_2d(np.asarray(arr, dtype=np.float64))
+    out = np.full(x.shape, 50.0)
+    if x.shape[1] < 2:
+        return out
+    change = np.diff(x, axis=1)
+    avg_gain = _np_ema_alpha(np.maximum(change, 0.0), 1.0 / period)
+    avg_loss = _np_ema_alpha(np.maximum(-change, 0.0), 1.0 / period)
+    safe = np.where(avg_loss > 1e-12, avg_loss, 1.0)
+    rs = np.where(avg_loss > 1e-12, avg_gain / safe, 999999.0)
+    out[:, 1:] = 100.0 - (100.0 / (1.0 + rs))
+    return out
+
+def _np_rolling_extreme(x, n: int, op):
+    # 倍增法滚动极值：窗口不足 n 时等价于从序列开头取极值
+    T = x.shape[1]
+    out = x.copy()
+    w = 1
+    while w * 2 <= n:
+        nxt = out.copy()
+        if w < T:
+            op(out[:, w:], out[:, :-w], out=nxt[:, w:])
+        out = nxt
+        w *= 2
+    rest = n - w
+    if rest > 0 and rest < T:
+        res = out.copy()
+        op(out[:, rest:], out[:, :-rest], out=res[:, rest:])
+        out = res
+    return out
+
+def kdj_from_close_np(arr, n: int, k_period: int, d_period: int):
+    x = np.atleast_2d(np.asarray(arr, dtype=np.float64))
+    if x.shape[1] == 0:
+        e = np.empty((x.shape[0], 0))
+        return e, e, e
+    hh = _np_rolling_extreme(x, n, np.maximum)
+    ll = _np_rolling_extreme(x, n, np.minimum)
+    rng = hh - ll
+    rsv = np.where(rng == 0, 50.0, (x - ll) / np.where(rng == 0, 1.0, rng) * 100.0)
+    k = sma_np(rsv, k_period)
+    d = sma_np(k, d_period)
+    return k, d, 3 * k - 2 * d
+
+def check_np_backend(n_syms: int = 4, length: int = 1000, tol: float = 1e-6) -> float:
+    # 用随机序列对比列表版本，返回最大相对偏差
+    import random
+    rows = []
+    for _ in range(n_syms):
+        x = random.uniform(0.01, 50000.0)
+        row = []
+        for _ in range(length):
+            x *= 1 + random.gauss(0, 0.002)
+            row.append(x)
+        rows.append(row)
+    arr = np.array(rows)
+    pairs = []
+    for p in EMA_PERIODS:
+        pairs.append((ema_np(arr, p), [ema(r, p) for r in rows]))
+    for p in RSI_PERIODS:
+        pairs.append((rsi_np(arr, p), [rsi(r, p) for r in rows]))
+    dif, dea = macd_np(arr, MACD_FAST, MACD_SLOW, MACD_SIGNAL)
+    ref = [macd(r, MACD_FAST, MACD_SLOW, MACD_SIGNAL) for r in rows]
+    pairs.append((dif, [a for a, _ in ref]))
+    pairs.append((dea, [b for _, b in ref]))
+    mid, up, down = boll_np(arr, BOLL_PERIOD, 1)
+    ref = [boll(r, BOLL_PERIOD, 1) for r in rows]
+    pairs.append((mid, [a for a, _, _ in ref]))
+    pairs.append((up, [b for _, b, _ in ref]))
+    k, d, j = kdj_from_close_np(arr, KDJ_N, KDJ_K, KDJ_D)
+    ref = [kdj_from_close(r, KDJ_N, KDJ_K, KDJ_D) for r in rows]
+    pairs.append((k, [a for a, _, _ in ref]))
+    pairs.append((j, [c for _, _, c in ref]))
+    refs = [_calc_indicators_py(r) for r in rows]
+    for name, got in _calc_indicators_tail_np(arr, SNAPSHOT_TAIL).items():
+        pairs.append((got, [r[name][-SNAPSHOT_TAIL:] for r in refs]))
+    worst = 0.0
+    for got, want in pairs:
+        w = np.array(want)
+        worst = max(worst, float(np.max(np.abs(got - w) / np.maximum(np.abs(w), 1.0))))
+    if worst > tol:
+        print(f"向量化指标校验偏差过大: {worst:.3e}，回退到列表计算")
+    return worst
+
+def use_np_backend() -> bool:
+    return np is not None and INDICATOR_BACKEND == "numpy"
+
+def _calc_indicators_py(closes: list[float]) -> dict:
+    mid, up, down = boll(closes, BOLL_PERIOD, 1)
+    out = {f"ema{p}": ema(closes, p) for p in EMA_PERIODS}
+    out.update({f"rsi{p}": rsi(closes, p) for p in RSI_PERIODS})
+    out["dif"], out["dea"] = macd(closes, MACD_FAST, MACD_SLOW, MACD_SIGNAL)
+    out["mid"], out["up"], out["down"] = mid, up, down
+    out["k"], out["d"], out["j"] = kdj_from_close(closes, KDJ_N, KDJ_K, KDJ_D)
+    return out
+
+# batch_snapshot 最多回看 10 根（ema*_hist），实盘扫描只需要序列末尾这么多个点
+SNAPSHOT_TAIL = 11
+
+_impulse_cache: dict[tuple, "np.ndarray"] = {}
+
+def _np_impulse(key: tuple, fn, T: int):
+    # 线性指标对单位脉冲 e_0、e_1 的响应；e_0 是种子项，e_1 之后系统时不变，任意长度的权重都能由这两行拼出
+    resp = _impulse_cache.get(key)
+    if resp is None or resp.shape[1] < T:
+        resp = _impulse_cache[key] = fn(np.eye(2, max(T, 1000)))
+    return resp
+
+def _np_tail_weights(resp, T: int, L: int):
+    # (T × L) 权重：长度为 T 的序列末尾 L 个点的指标值 = x @ W
+    t = np.arange(T - L, T)
+    k = t[None, :] - np.arange(T)[:, None] + 1
+    w = resp[1][np.clip(k, 0, resp.shape[1] - 1)]
+    w[0] = resp[0][t]
+    return w
+
+def _calc_indicators_tail_np(arr, L: int) -> dict:
+    # 只算末尾 L 个点：EMA、DEA 和 RSI 的平滑均值都是输入的线性组合，权重拼成一个矩阵后一次乘法算完；
+    # BOLL/KDJ 只依赖有限长度的回看，截取末段再算。300 个交易对 × 1000 根约 20 ms（整段计算约 130 ms）
+    T = arr.shape[1]
+
+    def tails(x, specs):
+        n = x.shape[1]
+        w = np.hstack([_np_tail_weights(_np_impulse(key, fn, n), n, L) for key, fn in specs])
+        return np.split(x @ w, len(specs), axis=1)
+
+    periods = tuple(EMA_PERIODS) + (MACD_FAST, MACD_SLOW)
+    specs = [(("ema", p), lambda e, p=p: ema_np(e, p)) for p in periods]
+    specs.append((("dea",), lambda e: macd_np(e, MACD_FAST, MACD_SLOW, MACD_SIGNAL)[1]))
+    *emas, dea = tails(arr, specs)
+    res = {f"ema{p}": v for p, v in zip(EMA_PERIODS, emas)}
+    res["dif"] = emas[-2] - emas[-1]
+    res["dea"] = dea
+    change = np.diff(arr, axis=1)
+    moves = np.vstack((np.maximum(change, 0.0), np.maximum(-change, 0.0)))
+    avgs = tails(moves, [(("wilder", p), lambda e, p=p: _np_ema_alpha(e, 1.0 / p)) for p in RSI_PERIODS])
+    for p, avg in zip(RSI_PERIODS, avgs):
+        avg_gain, avg_loss = avg[:arr.shape[0]], avg[arr.shape[0]:]
+        safe = np.where(avg_loss > 1e-12, avg_loss, 1.0)
+        rs = np.where(avg_loss > 1e-12, avg_gain / safe, 999999.0)
+        res[f"rsi{p}"] = 100.0 - (100.0 / (1.0 + rs))
+    seg = arr[:, max(0, T - L - BOLL_PERIOD + 1):]
+    res["mid"], res["up"], res["down"] = (v[:, -L:] for v in boll_np(seg, BOLL_PERIOD, 1))
+    seg = arr[:, max(0, T - L - (KDJ_N + KDJ_K + KDJ_D - 3)):]
+    res["k"], res["d"], res["j"] = (v[:, -L:] for v in kdj_from_close_np(seg, KDJ_N, KDJ_K, KDJ_D))
+    return res
+
+def calc_indicators_batch(rows: list[list[float]], tail: int | None = None) -> list[dict]:
+    # tail 给定时只返回每个序列末尾 tail 个点（batch_snapshot 会按长度对齐下标）
+    if not use_np_backend():
+        return [_calc_indicators_py(r) for r in rows]
+    out: list[dict | None] = [None] * len(rows)
+    # 按长度分组拼成二维数组（新上线的交易对 K 线可能不足 1000 根）
+    groups: dict[int, list[int]] = {}
+    for i, r in enumerate(rows):
+        groups.setdefault(len(r), []).append(i)
+    for T, idxs in groups.items():
+        arr = np.array([rows[i] for i in idxs], dtype=np.float64)
+        if tail and T > tail + 1:
+            res = _calc_indicators_tail_np(arr, tail)
+        else:
+            res = {f"ema{p}": ema_np(arr, p) for p in EMA_PERIODS}
+            res.update({f"rsi{p}": rsi_np(arr, p) for p in RSI_PERIODS})
+            res["dif"], res["dea"] = macd_np(arr, MACD_FAST, MACD_SLOW, MACD_SIGNAL)
+            res["mid"], res["up"], res["down"] = boll_np(arr, BOLL_PERIOD, 1)
+            res["k"], res["d"], res["j"] = kdj_from_close_np(arr, KDJ_N, KDJ_K, KDJ_D)
+        for row, i in enumerate(idxs):
+            out[i] = {name: v[row] for name, v in res.items()}
+    return out
+
+def windowed_indicators_np(closes, window: int, partial=None) -> dict:
+    # 逐点给出“以最近 window 个点为窗口、窗口首元素为种子”时的指标值（与 IndicatorEngine 的快照一致），
+    # 用全局累加量 + 种子修正一次性向量化算出整段序列，供回测使用。
+    # partial 给定时，第 i 个点的指标按 closes[:i] + [partial[i]] 计算（进行中 K 线在评估时刻的价格），
+    # 各指标只有最后一步依赖当前点，在整段结果上做一步修正即可
+    x = np.asarray(closes, dtype=np.float64)
+    dx = None if partial is None else np.asarray(partial, dtype=np.float64) - x
+    N = x.shape[0]
+    idx = np.arange(N)
+    s = np.maximum(0, idx - window + 1)
+    T = idx - s
+    xs = x[s]
+
+    def acc_zero(v, alpha: float):
+        e = _np_ema_alpha(v[None, :], alpha)[0]
+        with np.errstate(under="ignore"):
+            return e - (1.0 - alpha) ** (idx + 1.0) * v[0]
+
+    out = {"n": T + 1, "cp": x}
+    acc = {}
+    for p in EMA_PERIODS:
+        k = 2 / (p + 1)
+        c = 1.0 - k
+        A = acc_zero(x, k)
+        acc[p] = A
+        seed = xs - A[s]
+        out[f"ema{p}"] = A + c ** T * seed
+        if dx is not None:
+            out[f"ema{p}_close"] = out[f"ema{p}"]
+            out[f"ema{p}"] = out[f"ema{p}"] + np.where(T >= 1, k, 1.0) * dx
+        if p in (7, 25, 500):
+            depth = 3 if p == 25 else 10
+            for i in range(1, depth + 1):
+                j = np.maximum(idx - i, 0)
+                out[f"ema{p}_h{i}"] = A[j] + c ** np.maximum(T - i, 0) * seed
+    gk = 2 / (MACD_SIGNAL + 1)
+    q = 1.0 - gk
+    B = acc_zero(acc[MACD_FAST] - acc[MACD_SLOW], gk)
+    geo_f = np.array(_geo_table(q, 1 - 2 / (MACD_FAST + 1), window))
+    geo_s = np.array(_geo_table(q, 1 - 2 / (MACD_SLOW + 1), window))
+    u = xs - acc[MACD_FAST][s]
+    v = xs - acc[MACD_SLOW][s]
+    out["dea"] = (B - q ** T * B[s]) + gk * (u * geo_f[T] - v * geo_s[T])
+    if dx is not None:
+        out["dea"] = out["dea"] + gk * (2 / (MACD_FAST + 1) - 2 / (MACD_SLOW + 1)) * np.where(T >= 1, dx, 0.0)
+    out["dif"] = out[f"ema{MACD_FAST}"] - out[f"ema{MACD_SLOW}"]
+    change = np.concatenate([[0.0], np.diff(x)])
+    gain = np.maximum(change, 0.0)
+    loss = np.maximum(-change, 0.0)
+    if dx is not None:
+        dgain = np.maximum(change + dx, 0.0) - gain
+        dloss = np.maximum(-(change + dx), 0.0) - loss
+    s1 = np.minimum(s + 1, N - 1)
+    for p in RSI_PERIODS:
+        c = 1.0 - 1.0 / p
+        G = acc_zero(gain, 1.0 / p)
+        L = acc_zero(loss, 1.0 / p)
+        cp = c ** np.maximum(T - 1, 0)
+        ag = G + cp * (gain[s1] - G[s1])
+        al = L + cp * (loss[s1] - L[s1])
+        if dx is not None:
+            f = np.where(T >= 2, 1.0 / p, 1.0)
+            ag = ag + f * dgain
+            al = al + f * dloss
+        safe = np.where(al > 1e-12, al, 1.0)
+        rs = np.where(al > 1e-12, ag / safe, 999999.0)
+        out[f"rsi{p}"] = np.where(T >= 1, 100.0 - (100.0 / (1.0 + rs)), 50.0)
+    if dx is None:
+        mid, up, down = boll_np(x, BOLL_PERIOD, 1)
+        out["mid"], out["up"], out["down"] = mid[0], up[0], down[0]
+        kk, dd, jj = kdj_from_close_np(x, KDJ_N, KDJ_K, KDJ_D)
+        out["k"], out["d"], out["j"] = kk[0], dd[0], jj[0]
+        return out
+    # BOLL：窗口和与平方和中只替换当前点
+    y = (x - x[0])[None, :]
+    n = _np_window_len(N, BOLL_PERIOD)
+    s1 = _np_window_sum(y, BOLL_PERIOD)[0] + dx
+    s2 = _np_window_sum(y * y, BOLL_PERIOD)[0] + (y[0] + dx) ** 2 - y[0] ** 2
+    mean = s1 / n
+    sd = np.sqrt(np.maximum(s2 / n - mean * mean, 0.0))
+    out["mid"] = mean + x[0]
+    out["up"], out["down"] = out["mid"] + sd, out["mid"] - sd
+    # KDJ：当前点的 RSV 用“前 KDJ_N-1 个收盘价的极值”与当前价重算，K、D 的滑动均值各修正一项；
+    # 之前各点的 K/D/J 仍按收盘价，放在 k_close/d_close/j_close 里供快照取回看值（EMA 同样保留 ema*_close）
+    kk, dd, jj = (v[0] for v in kdj_from_close_np(x, KDJ_N, KDJ_K, KDJ_D))
+    cur = x + dx
+
+    def rsv(hh, ll, v):
+        rng = hh - ll
+        return np.where(rng == 0, 50.0, (v - ll) / np.where(rng == 0, 1.0, rng) * 100.0)
+
+    prev = max(KDJ_N - 1, 1)
+    hh = np.maximum(np.concatenate([[-np.inf], _np_rolling_extreme(x[None, :], prev, np.maximum)[0][:-1]]), cur)
+    ll = np.minimum(np.concatenate([[np.inf], _np_rolling_extreme(x[None, :], prev, np.minimum)[0][:-1]]), cur)
+    old = rsv(_np_rolling_extreme(x[None, :], KDJ_N, np.maximum)[0], _np_rolling_extreme(x[None, :], KDJ_N, np.minimum)[0], x)
+    dk = (rsv(hh, ll, cur) - old) / _np_window_len(N, KDJ_K)
+    out["k_close"], out["d_close"], out["j_close"] = kk, dd, jj
+    out["k"] = kk + dk
+    out["d"] = dd + dk / _np_window_len(N, KDJ_D)
+    out["j"] = 3 * out["k"] - 2 * out["d"]
+    out["cp"] = cur
+    return out
+
+# 信号规则：每个策略是一串按代价从低到高排列的检查项，检查项按名称在一次评估内共享结果；
+# 快照可以是 IndicatorEngine.last / batch_snapshot 的字典，也可以是按需计算的 LazySnapshot
+def _above_ema500(s) -> bool:
+    return s["cp"] > s["ema500"]
+
+def _below_ema500(s) -> bool:
+    return s["cp"] < s["ema500"]
+
+def _ohlc_above(name: str):
+    def check(s) -> bool:
+        e = s[name]
+        return s["o"] > e and s["c"] > e and s["h"] > e and s["l"] > e
+    return check
+
+def _ohlc_below(name: str):
+    def check(s) -> bool:
+        e = s[name]
+        return s["o"] < e and s["c"] < e and s["h"] < e and s["l"] < e
+    return check
+
+def _ema_stack_up(s) -> bool:
+    return s["ema500"] < s["ema200"] < s["ema100"] < s["ema60"] < s["ema25"] < s["ema7"]
+
+def _ema_stack_down(s) -> bool:
+    return s["ema500"] > s["ema200"] > s["ema100"] > s["ema60"] > s["ema25"] > s["ema7"]
+
+def _crossed_below(slow: str):
+    def check(s) -> bool:
+        return any(a < b for a, b in zip(s["ema7_hist"], s[slow + "_hist"]))
+    return check
+
+def _crossed_above(slow: str):
+    def check(s) -> bool:
+        return any(a > b for a, b in zip(s["ema7_hist"], s[slow + "_hist"]))
+    return check
+
+def _macd_up(s) -> bool:
+    return s["dif"] > s["dea"]
+
+def _macd_down(s) -> bool:
+    return s["dif"] < s["dea"]
+
+def _boll_up(s) -> bool:
+    return s["cp"] > s["up"]
+
+def _boll_down(s) -> bool:
+    return s["cp"] < s["down"]
+
+def _rsi_up(s) -> bool:
+    return s["rsi80"] > s["rsi200"] and s["rsi80"] > s["rsi500"]
+
+def _rsi_down(s) -> bool:
+    return s["rsi80"] < s["rsi200"] and s["rsi80"] < s["rsi500"]
+
+def _kdj_up(s) -> bool:
+    k, d, jv = s["k"], s["d"], s["j"]
+    return (k[-1] > d[-1] > jv[-1]) or all(k[-1 - i] > k[-2 - i] and jv[-1 - i] > jv[-2 - i] for i in range(1, 3))
+
+def _kdj_down(s) -> bool:
+    k, d, jv = s["k"], s["d"], s["j"]
+    return (k[-1] < d[-1] < jv[-1]) or all(k[-1 - i] < k[-2 - i] and jv[-1 - i] < jv[-2 - i] for i in range(1, 3))
+
+SIGNAL_CHECKS = {
+    "above_ema500": _above_ema500,
+    "below_ema500": _below_ema500,
+    "ohlc_above_ema500": _ohlc_above("ema500"),
+    "ohlc_below_ema500": _ohlc_below("ema500"),
+    "ohlc_above_ema100": _ohlc_above("ema100"),
+    "ohlc_below_ema100": _ohlc_below("ema100"),
+    "stack_up": _ema_stack_up,
+    "stack_down": _ema_stack_down,
+    "ema7_was_below_ema500": _crossed_below("ema500"),
+    "ema7_was_above_ema500": _crossed_above("ema500"),
+    "ema7_was_below_ema25": _crossed_below("ema25"),
+    "ema7_was_above_ema25": _crossed_above("ema25"),
+    "macd_up": _macd_up,
+    "macd_down": _macd_down,
+    "boll_up": _boll_up,
+    "boll_down": _boll_down,
+    "rsi_up": _rsi_up,
+    "rsi_down": _rsi_down,
+    "kdj_up": _kdj_up,
+    "kdj_down": _kdj_down,
+}
+
+class SignalRule:
+    __slots__ = ("side", "label", "checks", "blocked_by")
+
+    def __init__(self, side: str, label: str, checks: tuple[str, ...]):
+        for name in checks:
+            if name not in SIGNAL_CHECKS:
+                raise ValueError(f"unknown signal check: {name}")
+        self.side = side
+        self.label = label
+        self.checks = tuple((name, SIGNAL_CHECKS[name]) for name in checks)
+        self.blocked_by = "LONG_DIF_GT_DEA" if side == "LONG" else "SHORT_DIF_LT_DEA"
+
+class SignalRuleSet:
+    def __init__(self, rules: list[SignalRule]):
+        self.rules = tuple(rules)
+
+    def evaluate(self, s, last_dir: str | None = None) -> tuple[bool, ...]:
+        return self.evaluate_progress(s, last_dir)[0]
+
+    def evaluate_progress(self, s, last_dir: str | None = None) -> tuple[tuple[bool, ...], float]:
+        # 同一检查项只算一次；任一检查失败即放弃该规则，被 MACD 单次触发拦截的规则直接跳过。
+        # 第二个返回值为各规则已通过检查项比例的最大值，用来衡量离触发有多近
+        seen: dict[str, bool] = {}
+        out = []
+        best = 0.0
+        for rule in self.rules:
+            ok = rule.blocked_by != last_dir
+            if ok:
+                passed = 0
+                for name, fn in rule.checks:
+                    r = seen.get(name)
+                    if r is None:
+                        r = seen[name] = bool(fn(s))
+                    if not r:
+                        ok = False
+                        break
+                    passed += 1
+                best = max(best, passed / len(rule.checks))
+            out.append(ok)
+        return tuple(out), best
+
+# 检查项顺序即求值顺序：先比价格与均线（最便宜、最常失败），KDJ 最后
+SECOND_RULES = SignalRuleSet([
+    SignalRule("LONG", "做多1", ("above_ema500", "stack_up", "ema7_was_below_ema500", "macd_up", "boll_up", "rsi_up", "kdj_up")),
+    SignalRule("LONG", "做多2", ("above_ema500", "stack_up", "ema7_was_below_ema25", "macd_up", "boll_up", "rsi_up")),
+    SignalRule("SHORT", "做空1", ("below_ema500", "stack_down", "ema7_was_above_ema500", "macd_down", "boll_down", "rsi_down", "kdj_down")),
+    SignalRule("SHORT", "做空2", ("below_ema500", "stack_down", "ema7_was_above_ema25", "macd_down", "boll_down", "rsi_down")),
+])
+
+MINUTE_RULES = SignalRuleSet([
+    SignalRule("LONG", "做多1", ("ohlc_above_ema500", "stack_up", "ema7_was_below_ema500", "macd_up", "boll_up", "rsi_up", "kdj_up")),
+    SignalRule("LONG", "做多2", ("ohlc_above_ema100", "stack_up", "ema7_was_below_ema25", "macd_up", "boll_up", "rsi_up")),
+    SignalRule("SHORT", "做空1", ("ohlc_below_ema500", "stack_down", "ema7_was_above_ema500", "macd_down", "boll_down", "rsi_down", "kdj_down")),
+    SignalRule("SHORT", "做空2", ("ohlc_below_ema100", "stack_down", "ema7_was_above_ema25", "macd_down", "boll_down", "rsi_down")),
+])
+
+def second_conditions(s, last_dir: str | None = None) -> tuple[bool, bool, bool, bool]:
+    return SECOND_RULES.evaluate(s, last_dir)
+
+def minute_conditions(s, last_dir: str | None = None) -> tuple[bool, bool, bool, bool]:
+    return MINUTE_RULES.evaluate(s, last_dir)
+
+_HIST_DEPTH = {7: 10, 25: 3, 500: 10}
+
+class LazySnapshot:
+    # 与快照字典同样的字段，但指标只在规则第一次访问时按整段序列计算（列表版本）
+    __slots__ = ("closes", "bars", "cache")
+
+    def __init__(self, closes: list[float], bars: dict | None = None):
+        self.closes = closes
+        self.bars = bars
+        idx = len(closes) - 1
+        self.cache = {"n": len(closes), "cp": closes[idx]}
+        if bars is not None:
+            for f in ("o", "h", "l", "c"):
+                self.cache[f] = bars[f][idx]
+
+    def __getitem__(self, name: str):
+        v = self.cache.get(name)
+        if v is None:
+            self.cache.update(_LAZY_PROVIDERS[name](self.closes))
+            v = self.cache[name]
+        return v
+
+def _lazy_ema(p: int):
+    def provide(closes):
+        e = ema(closes, p)
+        idx = len(closes) - 1
+        out = {f"ema{p}": e[idx]}
+        if p in _HIST_DEPTH:
+            out[f"ema{p}_hist"] = [e[idx - i] for i in range(1, min(_HIST_DEPTH[p], idx) + 1)]
+        return out
+    return provide
+
+def _lazy_rsi(p: int):
+    def provide(closes):
+        return {f"rsi{p}": rsi(closes, p)[-1]}
+    return provide
+
+def _lazy_macd(closes):
+    dif, dea = macd(closes, MACD_FAST, MACD_SLOW, MACD_SIGNAL)
+    return {"dif": dif[-1], "dea": dea[-1]}
+
+def _lazy_boll(closes):
+    mid, up, down = boll(closes, BOLL_PERIOD, 1)
+    return {"mid": mid[-1], "up": up[-1], "down": down[-1]}
+
+def _lazy_kdj(closes):
+    k, d, jv = kdj_from_close(closes, KDJ_N, KDJ_K, KDJ_D)
+    return {"k": k[-4:], "d": d[-4:], "j": jv[-4:]}
+
+_LAZY_PROVIDERS = {"dif": _lazy_macd, "dea": _lazy_macd, "mid": _lazy_boll, "up": _lazy_boll, "down": _lazy_boll,
+                   "k": _lazy_kdj, "d": _lazy_kdj, "j": _lazy_kdj}
+for _p in EMA_PERIODS:
+    _LAZY_PROVIDERS[f"ema{_p}"] = _LAZY_PROVIDERS[f"ema{_p}_hist"] = _lazy_ema(_p)
+for _p in RSI_PERIODS:
+    _LAZY_PROVIDERS[f"rsi{_p}"] = _lazy_rsi(_p)
+
+def batch_snapshot(ind: dict, bars: dict, idx: int) -> dict:
+    s = {"n": idx + 1, "cp": bars["c"][idx], "o": bars["o"][idx], "h": bars["h"][idx], "l": bars["l"][idx], "c": bars["c"][idx]}
+    # 指标可能只算了末尾若干点（calc_indicators_batch 的 tail），按长度差换算下标
+    x = idx - (len(bars["c"]) - len(ind["k"]))
+    for name in ("up", "down", "dif", "dea", "rsi80", "rsi200", "rsi500") + tuple(f"ema{p}" for p in EMA_PERIODS):
+        s[name] = ind[name][x]
+    s["ema7_hist"] = [ind["ema7"][x - i] for i in range(1, min(10, idx) + 1)]
+    s["ema25_hist"] = [ind["ema25"][x - i] for i in range(1, min(3, idx) + 1)]
+    s["ema500_hist"] = [ind["ema500"][x - i] for i in range(1, min(10, idx) + 1)]
+    lo = max(0, x - 3)
+    s["k"] = list(ind["k"][lo:x + 1])
+    s["d"] = list(ind["d"][lo:x + 1])
+    s["j"] = list(ind["j"][lo:x + 1])
+    return s
+
+def volume_stats(vols) -> tuple[int, float, float, float, float]:
+    n = len(vols)
+    if n == 0:
+        return 0, 0.0, 0.0, 0.0, 0.0
+    return n, vols[-1], (vols[-2] if n >= 2 else 0.0), sum(vols[-20:]) / 20.0, sum(vols[-500:]) / 500.0
+
+def pick_signal(conds, last_dir: str | None, get_vol_stats):
+    # 成交量确认 + MACD 同向只触发一次；成交量只在有条件成立时才获取
+    cond_long1, cond_long2, cond_short1, cond_short2 = conds
+    stats = None
+    def vs():
+        nonlocal stats
+        if stats is None:
+            stats = get_vol_stats()
+        return stats
+    if cond_long1 and last_dir != "LONG_DIF_GT_DEA":
+        n, v1, v2, m20, m500 = vs()
+        if n >= 2 and v1 >= 2 * v2 and m20 > m500:
+            return ("LONG", "做多1")
+    if cond_long2 and last_dir != "LONG_DIF_GT_DEA":
+        n, v1, v2, m20, m500 = vs()
+        if n >= 500 and m20 > m500:
+            return ("LONG", "做多2")
+    if cond_short1 and last_dir != "SHORT_DIF_LT_DEA":
+        n, v1, v2, m20, m500 = vs()
+        if n >= 2 and v1 >= 2 * v2 and m20 < m500:
+            return ("SHORT", "做空1")
+    if cond_short2 and last_dir != "SHORT_DIF_LT_DEA":
+        n, v1, v2, m20, m500 = vs()
+        if n >= 500 and m20 < m500:
+            return ("SHORT", "做空2")
+    return None
+
+# 止盈/止损/平仓规则，实盘与回测共用
+TRAIL_ACTIVATION_PCT = 0.02
+TRAIL_CALLBACK_RATE = 0.5
+LIMIT_TP_PCT = 0.01
+PAIR_CLOSE_PCT = 0.02
+STAGNATION_WINDOW_SEC = 300.0
+STAGNATION_MIN_RANGE = 0.1
+
+def trailing_activation(entry: float, is_long: bool) -> float:
+    return entry * (1 + TRAIL_ACTIVATION_PCT) if is_long else entry * (1 - TRAIL_ACTIVATION_PCT)
+
+def limit_tp_target(entry: float, is_long: bool) -> float:
+    return entry * (1 + LIMIT_TP_PCT) if is_long else entry * (1 - LIMIT_TP_PCT)
+
+def stop_loss_price(entry: float, qty: float, is_long: bool) -> float:
+    per_coin = ORDER_STOP_NOTIONAL / max(qty, 1e-12)
+    return (entry - per_coin) if is_long else (entry + per_coin)
+
+def tp_mode(label: str, pos: list[dict]) -> str:
+    # 条件1 固定跟踪止盈；条件2 看当前全部持仓的浮盈是否大于浮亏
+    if label in ("做多1", "做空1"):
+        return "trailing"
+    gains = 0.0
+    losses = 0.0
+    for pit in pos:
+        try:
+            amt2 = float(str(pit.get("positionAmt", "0")) or 0)
+            if abs(amt2) <= 1e-12:
+                continue
+            u = float(str(pit.get("unRealizedProfit", "0")) or 0)
+            if u >= 0:
+                gains += u
+            else:
+                losses += -u
+        except Exception:
+            continue
+    return "trailing_dyn" if gains > losses else "limit_dyn"
+
+def pair_close_check(la: float, sa: float, lun: float, sun: float, lnot: float, snot: float) -> tuple[bool, float, float]:
+    base = max(lnot, snot)
+    net = lun + sun
+    if base > 0 and net >= PAIR_CLOSE_PCT * base:
+        return True, net, base
+    if abs(la - sa) <= 1e-12 and net > 0:
+        return True, net, base
+    return False, net, base
+
+def stagnation_check(unreal: float, age_sec: float, mxp: float, mnp: float) -> bool:
+    return unreal > 0 and age_sec >= STAGNATION_WINDOW_SEC and (mxp - mnp) < STAGNATION_MIN_RANGE
+
+def ema500_exit(side: str, cp: float, e500: float) -> bool:
+    return cp < e500 if side == "LONG" else cp > e500
+
+def get_account_info():
+    if USER_STREAM and account_book.ready():
+        return account_book.account_info()
+    j = api_get("/fapi/v3/account", signed=True, api_key=g_api_key, secret=g_secret)
+    return j if isinstance(j, dict) else {}
+
+def get_positions():
+    if USER_STREAM and account_book.ready():
+        return account_book.positions_list()
+    arr = api_get("/fapi/v3/positionRisk", signed=True, api_key=g_api_key, secret=g_secret)
+    if not isinstance(arr, list):
+        raise PositionsUnavailable(str(arr)[:200])
+    return arr
+
+def current_margin_ratio() -> float:
+    acc = get_account_info()
+    try:
+        tmm = float(acc.get("totalMaintMargin", 0) or 0)
+        tmb = float(acc.get("totalMarginBalance", 0) or 0)
+        if tmb <= 0:
+            return 0.0
+        return tmm / tmb * 100.0
+    except Exception:
+        return 0.0
+
+def adjust_qty(sym: str, qty: float) -> float:
+    flt = symbol_filters.get(sym, {})
+    step = float(flt.get("stepSize", 0) or 0)
+    min_qty = float(flt.get("minQty", 0) or 0)
+    if step and qty > 0:
+        qty = math.floor(qty / step) * step
+    if qty < min_qty:
+        return 0.0
+    # 避免科学计数法/浮点误差
+    qp = int(flt.get("quantityPrecision", 0) or 0)
+    qty = float(f"{qty:.{max(qp, 0)}f}")
+    return qty
+
+def adjust_price(sym: str, price: float) -> float:
+    flt = symbol_filters.get(sym, {})
+    tick = float(flt.get("tickSize", 0) or 0)
+    pp = int(flt.get("pricePrecision", 0) or 0)
+    if tick and price > 0:
+        price = round(price / tick) * tick
+    price = float(f"{price:.{max(pp, 0)}f}")
+    return price
+
+def fmt_price(sym: str, price: float) -> float:
+    pp = int(symbol_filters.get(sym, {}).get("pricePrecision", 0) or 0)
+    return float(f"{price:.{max(pp, 0)}f}")
+
+def post_order(p: dict) -> dict:
+    # 带 newClientOrderId 下单；请求异常时订单可能已被受理，先按 clientOrderId 查询，查不到再用同一 ID 重发一次
+    p = dict(p)
+    p.setdefault("newClientOrderId", new_client_order_id("o"))
+    try:
+        j = api_post("/fapi/v1/order", p, signed=True, api_key=g_api_key, secret=g_secret)
+    except requests.RequestException:
+        try:
+            j = query_order(p["symbol"], client_id=p["newClientOrderId"])
+        except requests.RequestException:
+            j = {}
+        if not j.get("orderId"):
+            j = api_post("/fapi/v1/order", p, signed=True, api_key=g_api_key, secret=g_secret)
+    if isinstance(j, dict) and j.get("code") == -4116:
+        # clientOrderId 重复：上一次请求已成功，直接取回该订单
+        j = query_order(p["symbol"], client_id=p["newClientOrderId"]) or j
+    return j if isinstance(j, dict) else {"error": j}
+
+def post_batch_orders(orders: list[dict]) -> list[dict]:
+    # /fapi/v1/batchOrders 每次最多 5 笔，结果与输入逐笔对应：成功为订单，失败为 {"code", "msg"}。
+    # 整批请求异常或结果条数对不上时，逐笔按 clientOrderId 查询，未受理的单独补发
+    out: list[dict] = []
+    for i in range(0, len(orders), 5):
+        chunk = [dict(o) for o in orders[i:i + 5]]
+        for o in chunk:
+            o.setdefault("newClientOrderId", new_client_order_id("b"))
+        payload = {"batchOrders": json.dumps([{k: str(v) for k, v in o.items()} for o in chunk], separators=(",", ":"))}
+        try:
+            j = api_post("/fapi/v1/batchOrders", payload, signed=True, api_key=g_api_key, secret=g_secret)
+        except requests.RequestException:
+            j = None
+        if isinstance(j, list) and len(j) == len(chunk):
+            out.extend(x if isinstance(x, dict) else {"error": x} for x in j)
+            continue
+        for o in chunk:
+            try:
+                r = query_order(o["symbol"], client_id=o["newClientOrderId"])
+            except requests.RequestException:
+                r = {}
+            out.append(r if r.get("orderId") else post_order(o))
+    return out
+
+def order_ok(j) -> bool:
+    return isinstance(j, dict) and (j.get("orderId") is not None or j.get("clientOrderId") is not None) and "code" not in j
+
+# 可重发的错误：未知/断线/超时/繁忙/限频/时间戳；其余错误码是交易所明确拒绝（如仓位已平），重发无意义
+RETRYABLE_ORDER_CODES = {-1000, -1001, -1003, -1006, -1007, -1008, -1021}
+
+def order_retryable(j) -> bool:
+    if not isinstance(j, dict) or "code" not in j:
+        return True
+    try:
+        return int(j["code"]) in RETRYABLE_ORDER_CODES
+    except Exception:
+        return True
+
+def market_order_params(sym: str, side: str, position_side: str, qty: float) -> dict:
+    # RESULT 响应直接带回成交均价，避免下单后再轮询订单
+    return {"symbol": sym, "side": side, "type": "MARKET", "positionSide": position_side, "quantity": qty, "newOrderRespType": "RESULT"}
+
+def place_market(sym: str, side: str, position_side: str, qty: float) -> dict:
+    return post_order(market_order_params(sym, side, position_side, qty))
+
+def query_order(sym: str, order_id: int | None = None, client_id: str | None = None) -> dict:
+    p = {"symbol": sym}
+    if order_id is not None:
+        p["orderId"] = order_id
+    if client_id:
+        p["origClientOrderId"] = client_id
+    j = api_get("/fapi/v1/order", p, signed=True, api_key=g_api_key, secret=g_secret)
+    return j if isinstance(j, dict) else {}
+
+# 成交通知：用户数据流的 ORDER_TRADE_UPDATE 成交事件唤醒等待中的下单线程；
+# 事件可能早于下单响应到达，因此最近的成交均价也会缓存一段时间
+_fill_lock = threading.Lock()
+_fill_waiters: dict[tuple[str, str], list[concurrent.futures.Future]] = {}
+_recent_fills: "OrderedDict[tuple[str, str], float]" = OrderedDict()
+
+def _fill_keys(sym: str, order_id, client_id) -> list[tuple[str, str]]:
+    keys = []
+    if order_id is not None:
+        keys.append((sym, f"i:{order_id}"))
+    if client_id:
+        keys.append((sym, f"c:{client_id}"))
+    return keys
+
+def on_order_fill_event(order: dict):
+    st = str(order.get("status", "")).upper()
+    if st not in ("FILLED", "EXPIRED", "CANCELED"):
+        return
+    try:
+        ap = float(order.get("avgPrice", 0) or 0)
+    except Exception:
+        ap = 0.0
+    if ap <= 0:
+        return
+    futs = []
+    with _fill_lock:
+        for key in _fill_keys(order.get("symbol"), order.get("orderId"), order.get("clientOrderId")):
+            _recent_fills[key] = ap
+            futs.extend(_fill_waiters.pop(key, []))
+        while len(_recent_fills) > 2000:
+            _recent_fills.popitem(last=False)
+    for f in futs:
+        if not f.done():
+            f.set_result(ap)
+
+def wait_fill_avg_price(sym: str, order_id: int | None, client_id: str | None, timeout: float | None = None) -> float:
+    timeout = FILL_WAIT_TIMEOUT if timeout is None else timeout
+    deadline = time.perf_counter() + timeout
+    keys = _fill_keys(sym, order_id, client_id)
+    if USER_STREAM and account_book.stream_ok:
+        fut: concurrent.futures.Future = concurrent.futures.Future()
+        with _fill_lock:
+            for key in keys:
+                ap = _recent_fills.get(key)
+                if ap:
+                    return ap
+            for key in keys:
+                _fill_waiters.setdefault(key, []).append(fut)
+        try:
+            return fut.result(timeout=min(FILL_EVENT_TIMEOUT, timeout))
+        except concurrent.futures.TimeoutError:
+            pass
+        finally:
+            with _fill_lock:
+                for key in keys:
+                    lst = _fill_waiters.get(key)
+                    if lst and fut in lst:
+                        lst.remove(fut)
+                        if not lst:
+                            _fill_waiters.pop(key, None)
+    # 回退为查询订单，间隔从 50ms 逐步加长
+    delay = 0.05
+    while True:
+        j = query_order(sym, order_id, client_id)
+        try:
+            ap = float(j.get("avgPrice", 0) or 0)
+        except Exception:
+            ap = 0.0
+        if ap > 0:
+            return ap
+        left = deadline - time.perf_counter()
+        if left <= 0:
+            return 0.0
+        time.sleep(min(delay, left))
+        delay = min(delay * 2, 1.0)
+
+def tp_trailing_params(sym: str, position_side: str, entry: float, qty: float, is_long: bool) -> dict:
+    side = "SELL" if is_long else "BUY"
+    activation = adjust_price(sym, trailing_activation(entry, is_long))
+    p = {
+        "symbol": sym,
+        "side": side,
+        "type": "TRAILING_STOP_MARKET",
+        "positionSide": position_side,
+        "quantity": qty,
+        "activationPrice": activation,
+        "callbackRate": TRAIL_CALLBACK_RATE,
+    }
+    return p
+
+def place_tp_trailing(sym: str, position_side: str, entry: float, qty: float, is_long: bool):
+    return post_order(tp_trailing_params(sym, position_side, entry, qty, is_long))
+
+def tp_limit_params(sym: str, position_side: str, entry: float, qty: float, is_long: bool, use_market: bool = True) -> dict:
+    side = "SELL" if is_long else "BUY"
+    target = adjust_price(sym, limit_tp_target(entry, is_long))
+    if use_market:
         p = {
             "symbol": sym,
             "side": side,
@@ -507,10 +2490,33 @@ def place_tp_limit_or_market(sym: str, position_side: str, entry: float, qty: fl
             "stopPrice": target,
             "quantity": qty,
         }
-    j = api_post("/fapi/v1/order", p, signed=True, api_key=g_api_key, secret=g_secret)
-    return j
+    return p
+
+def place_tp_limit_or_market(sym: str, position_side: str, entry: float, qty: float, is_long: bool, use_market: bool = True):
+    return post_order(tp_limit_params(sym, position_side, entry, qty, is_long, use_market))
+
+def stop_market_params(sym: str, position_side: str, entry: float, qty: float) -> dict:
+    # 双向持仓模式下不能带 reduceOnly，按 positionSide 平仓方向下单本身只减仓
+    is_long = position_side == "LONG"
+    return {
+        "symbol": sym,
+        "side": "SELL" if is_long else "BUY",
+        "type": "STOP_MARKET",
+        "positionSide": position_side,
+        "stopPrice": adjust_price(sym, stop_loss_price(entry, qty, is_long)),
+        "quantity": qty,
+        "workingType": "MARK_PRICE",
+    }
+
+def tp_order_params(sym: str, position_side: str, entry: float, qty: float, mode: str) -> dict:
+    is_long = position_side == "LONG"
+    if mode == "limit_dyn":
+        return tp_limit_params(sym, position_side, entry, qty, is_long, use_market=False)
+    return tp_trailing_params(sym, position_side, entry, qty, is_long)
 
 def list_open_orders(sym: str) -> list[dict]:
+    if USER_STREAM and account_book.ready() and (time.time() - account_book.orders_synced_at) <= ORDER_RECONCILE_SEC * 3:
+        return account_book.open_orders(sym)
     j = api_get("/fapi/v1/openOrders", {"symbol": sym}, signed=True, api_key=g_api_key, secret=g_secret)
     return j if isinstance(j, list) else []
 
@@ -535,7 +2541,10 @@ def cancel_open_orders_for_side(sym: str, position_side: str):
             if st not in ("NEW", "PARTIALLY_FILLED"):
                 continue
             ot = str(it.get("type", "")).upper()
-            if ot in ("TRAILING_STOP_MARKET", "TAKE_PROFIT", "TAKE_PROFIT_MARKET"):
+            # STOP_MARKET 只撤本程序挂的（SERVER_STOP），手动挂的止损单保留
+            if ot == "STOP_MARKET" and not str(it.get("clientOrderId") or "").startswith(CLIENT_ID_PREFIX):
+                continue
+            if ot in ("TRAILING_STOP_MARKET", "TAKE_PROFIT", "TAKE_PROFIT_MARKET", "STOP_MARKET"):
                 oid = it.get("orderId")
                 if oid is None:
                     ocid = it.get("clientOrderId")
@@ -549,7 +2558,14 @@ def cancel_open_orders_for_side(sym: str, position_side: str):
         cancel_orders(sym, ids)
 
 def cancel_open_orders_if_flat(sym: str, position_side: str):
-    arr = get_positions()
+    # 持仓查询失败或返回异常内容时状态未知，保留止盈/止损单
+    try:
+        arr = get_positions()
+    except Exception as e:
+        print(f"持仓查询失败，暂不撤单: {sym} {position_side} {e}")
+        return
+    if not isinstance(arr, list):
+        return
     flat = True
     for it in arr:
         if it.get("symbol") != sym:
@@ -566,160 +2582,966 @@ def cancel_open_orders_if_flat(sym: str, position_side: str):
     if flat:
         cancel_open_orders_for_side(sym, position_side)
 
-def latest_ohlc_1m(sym: str):
-    arr = api_get("/fapi/v1/klines", {"symbol": sym, "interval": "1m", "limit": 1})
-    if isinstance(arr, list) and arr:
-        it = arr[0]
+# 下单网关：下单/撤单统一投递到网关的优先级队列，由专用线程执行，发现信号的线程不再等待下单应答。
+# 风控平仓（PRIO_RISK）总是先出队，且保留一个只处理平仓的线程，不会排在开仓后面；
+# 同一意图与 (symbol, 方向) 的在途请求只保留一个，重复投递返回同一个 Future。
+# newClientOrderId 在投递时生成，网络异常时先按该 ID 查询再重发，交易所侧不会重复成交
+_client_seq = itertools.count(1)
+CLIENT_ID_PREFIX = "sc"
+
+def new_client_order_id(tag: str) -> str:
+    # 交易所限制 36 字符以内，字母数字与 ._-:/
+    return f"{CLIENT_ID_PREFIX}{tag}-{now_ms():x}-{next(_client_seq):x}"[:36]
+
+class OrderGateway:
+    def __init__(self, workers: int = ORDER_GATEWAY_WORKERS):
+        self.cv = threading.Condition()
+        self.queue: list[tuple[int, int, tuple | None, concurrent.futures.Future, object, tuple, dict]] = []
+        self.inflight: dict[tuple, concurrent.futures.Future] = {}
+        self.seq = itertools.count()
+        self.workers = max(2, workers)
+        self.started = False
+        self.busy = 0
+
+    def start(self):
+        with self.cv:
+            if self.started:
+                return
+            self.started = True
+        # 第 0 个线程只取风控任务，其余线程按优先级取任意任务
+        for i in range(self.workers):
+            threading.Thread(target=self._run, args=(i == 0,), daemon=True, name=f"order-gw-{i}").start()
+
+    def submit(self, prio: int, fn, *args, key: tuple | None = None, **kwargs) -> concurrent.futures.Future:
+        if not self.started:
+            self.start()
+        with self.cv:
+            if key is not None:
+                fut = self.inflight.get(key)
+                if fut is not None and not fut.done():
+                    return fut
+            fut = concurrent.futures.Future()
+            if key is not None:
+                self.inflight[key] = fut
+            heapq.heappush(self.queue, (prio, next(self.seq), key, fut, fn, args, kwargs))
+            self.cv.notify_all()
+        return fut
+
+    def depth(self) -> int:
+        with self.cv:
+            return len(self.queue)
+
+    def _take(self, risk_only: bool):
+        with self.cv:
+            while not self.queue or (risk_only and self.queue[0][0] != PRIO_RISK):
+                self.cv.wait()
+            self.busy += 1
+            return heapq.heappop(self.queue)
+
+    def _run(self, risk_only: bool):
+        while True:
+            prio, _, key, fut, fn, args, kwargs = self._take(risk_only)
+            try:
+                if fut.set_running_or_notify_cancel():
+                    with request_priority(prio):
+                        res = fn(*args, **kwargs)
+                    fut.set_result(res)
+            except BaseException as e:
+                fut.set_exception(e)
+            finally:
+                with self.cv:
+                    self.busy -= 1
+                    if key is not None and self.inflight.get(key) is fut:
+                        self.inflight.pop(key, None)
+
+order_gateway = OrderGateway()
+metrics.register(Gauge("scalping_order_queue_depth", "Orders waiting in the order gateway queue.", collect=lambda: [((), order_gateway.depth())]))
+
+def submit_open(sym: str, price: float, side_dir: str, label: str, trace: LatencyTrace | None = None) -> concurrent.futures.Future:
+    fut = order_gateway.submit(PRIO_ORDER, try_open, sym, price, side_dir, label, trace, key=("open", sym, side_dir))
+    def report(f: concurrent.futures.Future):
+        e = f.exception()
+        if e is not None:
+            print(f"下单失败: {sym} {side_dir} {e}")
+    fut.add_done_callback(report)
+    return fut
+
+def _close_and_cleanup(sym: str, side: str, position_side: str, qty: float, cancel: str | None):
+    j = place_market(sym, side, position_side, qty)
+    invalidate_risk_positions()
+    try:
+        if cancel == "flat":
+            cancel_open_orders_if_flat(sym, position_side)
+        elif cancel == "side":
+            cancel_open_orders_for_side(sym, position_side)
+    except Exception:
+        pass
+    return j
+
+def submit_close(sym: str, side: str, position_side: str, qty: float, cancel: str | None = None) -> concurrent.futures.Future:
+    # 平仓后按需撤掉该方向的止盈/止损单：cancel="flat" 仅在已无持仓时撤，"side" 直接撤；
+    # 挂了交易所止损单时每次平仓都要检查，避免留下孤立的止损单
+    if SERVER_STOP and cancel is None:
+        cancel = "flat"
+    return order_gateway.submit(PRIO_RISK, _close_and_cleanup, sym, side, position_side, qty, cancel, key=("close", sym, position_side))
+
+def _pair_close(sym: str, ql: float, qs: float) -> list[dict]:
+    # 多空两腿放在同一个批量请求里；因临时/未知错误失败的一腿用同一个 clientOrderId 单独补发一次
+    # （若其实已被受理，交易所返回 ID 重复，post_order 会取回原订单），明确被拒的不再重发
+    legs = []
+    if ql > 0:
+        legs.append(market_order_params(sym, "SELL", "LONG", ql))
+    if qs > 0:
+        legs.append(market_order_params(sym, "BUY", "SHORT", qs))
+    for leg in legs:
+        leg["newClientOrderId"] = new_client_order_id("p")
+    res = post_batch_orders(legs)
+    invalidate_risk_positions()
+    for i, (leg, j) in enumerate(zip(legs, res)):
+        if not order_ok(j):
+            if not order_retryable(j):
+                print(f"对冲平仓单腿被拒: {sym} {leg['positionSide']} {j}")
+                continue
+            print(f"对冲平仓单腿失败: {sym} {leg['positionSide']} {j}，单独重发")
+            res[i] = post_order(leg)
+    for ps in ("LONG", "SHORT"):
         try:
-            o = float(it[1]); h = float(it[2]); l = float(it[3]); c = float(it[4])
-            return o, h, l, c
+            cancel_open_orders_for_side(sym, ps)
         except Exception:
-            return None
-    return None
+            pass
+    return res
 
-def klines_1m_quote_vol(sym: str, limit: int = 1000) -> list[float]:
-    arr = api_get("/fapi/v1/klines", {"symbol": sym, "interval": "1m", "limit": limit})
-    out = []
-    if isinstance(arr, list):
-        for it in arr:
+def submit_pair_close(sym: str, ql: float, qs: float) -> concurrent.futures.Future:
+    return order_gateway.submit(PRIO_RISK, _pair_close, sym, ql, qs, key=("close", sym, "PAIR"))
+
+# 1m K 线缓存：每个交易对保留最近 KLINE_CACHE_BARS 根（含正在形成的一根），列式存储；
+# 过期后只按 startTime 拉取缺失的尾部，行情推送的 kline_1m 也直接写入缓存
+class KlineSeries:
+    FIELDS = ("o", "h", "l", "c", "v", "q")
+
+    def __init__(self, maxlen: int = KLINE_CACHE_BARS):
+        self.maxlen = maxlen
+        self.t = array("q")
+        self.o = array("d")
+        self.h = array("d")
+        self.l = array("d")
+        self.c = array("d")
+        self.v = array("d")
+        self.q = array("d")
+        self.full = False
+        self.updated_at = 0.0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.t)
+
+    def _cut(self, i: int):
+        del self.t[i:]
+        for f in self.FIELDS:
+            del getattr(self, f)[i:]
+
+    def _trim(self):
+        extra = len(self.t) - self.maxlen
+        if extra > 0:
+            del self.t[:extra]
+            for f in self.FIELDS:
+                del getattr(self, f)[:extra]
+
+    def upsert(self, t: int, o: float, h: float, l: float, c: float, v: float, q: float) -> bool:
+        n = len(self.t)
+        if n and t < self.t[-1]:
+            return False
+        if n and t == self.t[-1]:
+            i = n - 1
+            self.o[i] = o; self.h[i] = h; self.l[i] = l; self.c[i] = c; self.v[i] = v; self.q[i] = q
+            return True
+        self.t.append(t)
+        self.o.append(o); self.h.append(h); self.l.append(l); self.c.append(c); self.v.append(v); self.q.append(q)
+        self._trim()
+        return True
+
+    def merge_rest(self, rows: list):
+        parsed = []
+        for it in rows:
             try:
                 qv = float(it[7]) if len(it) > 7 else float(it[5])
+                parsed.append((int(it[0]), float(it[1]), float(it[2]), float(it[3]), float(it[4]), float(it[5]), qv))
             except Exception:
-                qv = 0.0
-            out.append(qv)
-    return out
+                continue
+        if not parsed:
+            return
+        self._cut(bisect.bisect_left(self.t, parsed[0][0]))
+        for row in parsed:
+            self.upsert(*row)
+
+    def tail(self, limit: int) -> dict:
+        out = {"t": self.t[-limit:]}
+        for f in self.FIELDS:
+            out[f] = getattr(self, f)[-limit:]
+        return out
+
+kline_cache: dict[str, KlineSeries] = {}
+kline_cache_lock = threading.Lock()
+
+def kline_series(sym: str) -> KlineSeries:
+    ks = kline_cache.get(sym)
+    if ks is None:
+        with kline_cache_lock:
+            ks = kline_cache.get(sym)
+            if ks is None:
+                ks = KlineSeries()
+                kline_cache[sym] = ks
+    return ks
+
+def apply_stream_kline(sym: str, t: int, o: float, h: float, l: float, c: float, v: float, q: float):
+    ks = kline_series(sym)
+    # 推送线程不能等待 REST 请求，拿不到锁就跳过，过期后由 REST 补齐
+    if not ks.lock.acquire(blocking=False):
+        return
+    try:
+        n = len(ks)
+        if n == 0 or t == ks.t[-1] or t == ks.t[-1] + 60_000:
+            if ks.upsert(t, o, h, l, c, v, q) and n:
+                ks.updated_at = time.time()
+    finally:
+        ks.lock.release()
+
+def klines_1m(sym: str, limit: int = 1000, max_age: float | None = None) -> dict:
+    ks = kline_series(sym)
+    max_age = KLINE_CACHE_TTL if max_age is None else max_age
+    with ks.lock:
+        have = len(ks)
+        if (have >= limit or ks.full) and (time.time() - ks.updated_at) <= max_age:
+            return ks.tail(limit)
+        need = 0
+        if have and (have >= limit or ks.full):
+            need = int((now_ms() - ks.t[-1]) // 60_000) + 2
+        try:
+            if 0 < need <= 1000:
+                arr = api_get("/fapi/v1/klines", {"symbol": sym, "interval": "1m", "startTime": ks.t[-1], "limit": need})
+                full = False
+            else:
+                arr = api_get("/fapi/v1/klines", {"symbol": sym, "interval": "1m", "limit": max(limit, ks.maxlen)})
+                full = True
+        except Exception:
+            arr = None
+        if isinstance(arr, list):
+            ks.merge_rest(arr)
+            if full:
+                ks.full = True
+            ks.updated_at = time.time()
+        return ks.tail(limit)
+
+def latest_ohlc_1m(sym: str):
+    bars = klines_1m(sym, 1)
+    if len(bars["t"]):
+        return bars["o"][-1], bars["h"][-1], bars["l"][-1], bars["c"][-1]
+    return None
+
+def klines_1m_quote_vol(sym: str, limit: int = 1000) -> list[float]:
+    return list(klines_1m(sym, limit)["q"])
 
 def fmt_time(ts: int | None = None) -> str:
     d = datetime.fromtimestamp(((ts or int(time.time() * 1000)))/1000.0)
     return d.strftime("%Y-%m-%d %H:%M:%S")
 
+# 行情推送：MARKET_FEED=ws 时最新价与标记价订阅全市场数组流（!miniTicker@arr、!markPrice@arr@1s），
+# 1m K 线按交易对订阅 kline_1m，分散到多条连接，每条不超过 STREAM_MAX_PER_CONN 个流。
+# 新鲜度按交易对记录：超过 STREAM_STALE_SEC 没有推送（数组流只推有变化的交易对，或推送中断）的交易对单独回退到 REST
+STREAM_ARRAYS = ("!miniTicker@arr", "!markPrice@arr@1s")
+stream_prices: dict[str, float] = {}
+stream_price_at: dict[str, float] = {}
+stream_mark_prices: dict[str, float] = {}
+stream_mark_at: dict[str, float] = {}
+rest_prices: dict[str, float] = {}
+rest_prices_at = 0.0
+
+def fresh_stream_prices() -> dict[str, float]:
+    if MARKET_FEED != "ws":
+        return {}
+    lim = time.time() - STREAM_STALE_SEC
+    at = stream_price_at
+    return {sym: p for sym, p in list(stream_prices.items()) if at.get(sym, 0.0) >= lim}
+
+def fetch_ticker_prices() -> dict[str, float]:
+    global rest_prices, rest_prices_at
+    j = api_get("/fapi/v2/ticker/price")
+    mp = {}
+    if isinstance(j, list):
+        for it in j:
+            sym = it.get("symbol")
+            if not sym:
+                continue
+            try:
+                mp[sym] = float(it.get("price", 0) or 0)
+            except Exception:
+                mp[sym] = 0.0
+        rest_prices = mp
+        rest_prices_at = time.time()
+    return mp
+
+def latest_prices(max_age: float = 2.0, syms=None) -> dict[str, float]:
+    # 推送新鲜的交易对用推送价，其余（syms 中缺失的）用 REST 补齐
+    out = fresh_stream_prices()
+    want = selected_symbols if syms is None else syms
+    if MARKET_FEED == "ws" and all(sym in out for sym in want):
+        return out
+    if rest_prices and (time.time() - rest_prices_at) <= max_age:
+        rest = rest_prices
+    else:
+        rest = fetch_ticker_prices()
+    merged = dict(rest)
+    merged.update(out)
+    return merged
+
+def stream_names(syms) -> list[str]:
+    # 价格与标记价的数组流数量固定，不随交易对增加；K 线只能按交易对订阅
+    return list(STREAM_ARRAYS) + [f"{sym.lower()}@kline_1m" for sym in sorted(syms)]
+
+def plan_stream_shards(names, shards: list[set[str]], cap: int) -> list[set[str]]:
+    # 已订阅的流留在原连接，不再需要的移除，新增的放进流最少的连接，都满了再新开连接
+    want = set(names)
+    out = [set(sh) & want for sh in shards]
+    placed = set().union(*out) if out else set()
+    for name in sorted(want - placed):
+        free = [i for i, sh in enumerate(out) if len(sh) < cap]
+        if free:
+            i = min(free, key=lambda k: len(out[k]))
+        else:
+            out.append(set())
+            i = len(out) - 1
+        out[i].add(name)
+    return out
+
+def _apply_ticker(data: dict, now: float, t_recv: float | None) -> bool:
+    sym = data.get("s")
+    if not sym:
+        return False
+    stream_prices[sym] = float(data.get("c", 0) or 0)
+    stream_price_at[sym] = now
+    if t_recv is not None:
+        tick_received_at[sym] = t_recv
+    return sym in risk_watch
+
+def _apply_mark(data: dict, now: float) -> bool:
+    sym = data.get("s")
+    if not sym:
+        return False
+    stream_mark_prices[sym] = float(data.get("p", 0) or 0)
+    stream_mark_at[sym] = now
+    return sym in risk_watch
+
+def handle_stream_message(raw):
+    # 返回订阅请求的应答（带 id、没有行情数据的消息），行情消息在此处理后返回 None
+    try:
+        msg = json.loads(raw)
+    except Exception:
+        return None
+    if not isinstance(msg, dict):
+        return None
+    if "id" in msg and "data" not in msg and "e" not in msg:
+        return msg
+    data = msg.get("data", msg)
+    now = time.time()
+    t_recv = time.perf_counter() if LATENCY_TRACE else None
+    wake = False
+    try:
+        if isinstance(data, list):
+            # 数组流：同一条消息里是多个交易对
+            for it in data:
+                if not isinstance(it, dict):
+                    continue
+                ev = it.get("e")
+                if ev == "24hrMiniTicker":
+                    wake = _apply_ticker(it, now, t_recv) or wake
+                elif ev == "markPriceUpdate":
+                    wake = _apply_mark(it, now) or wake
+        elif isinstance(data, dict):
+            ev = data.get("e")
+            if ev == "24hrMiniTicker":
+                wake = _apply_ticker(data, now, t_recv)
+            elif ev == "markPriceUpdate":
+                wake = _apply_mark(data, now)
+            elif ev == "kline" and data.get("s"):
+                k = data.get("k") or {}
+                apply_stream_kline(
+                    data["s"],
+                    int(k.get("t", 0) or 0),
+                    float(k.get("o", 0) or 0),
+                    float(k.get("h", 0) or 0),
+                    float(k.get("l", 0) or 0),
+                    float(k.get("c", 0) or 0),
+                    float(k.get("v", 0) or 0),
+                    float(k.get("q", 0) or 0),
+                )
+            else:
+                return None
+        else:
+            return None
+    except Exception:
+        return None
+    if wake:
+        risk_wakeup.set()
+    return None
+
+async def _stream_session(url: str, shard: int, wants: list[set[str]]):
+    # 一条连接：持续把本连接的订阅同步到 wants[shard]，只有服务端应答成功的请求才计入已订阅
+    import asyncio
+    loop = asyncio.get_running_loop()
+    async with websockets.connect(f"{url}/stream", ping_interval=20, max_queue=4096) as ws:
+        subscribed: set[str] = set()
+        pending: dict[int, asyncio.Future] = {}
+        req_id = 0
+
+        async def control(method: str, names: list[str]) -> bool:
+            nonlocal req_id
+            req_id += 1
+            fut = pending[req_id] = loop.create_future()
+            try:
+                await ws.send(json.dumps({"method": method, "params": names, "id": req_id}))
+                reply = await asyncio.wait_for(fut, 10.0)
+            except asyncio.TimeoutError:
+                print(f"行情推送 {method} 无应答（连接 {shard}，{len(names)} 个流）")
+                return False
+            finally:
+                pending.pop(req_id, None)
+            err = reply.get("error") or (reply.get("msg") if "code" in reply else None)
+            if err:
+                print(f"行情推送 {method} 失败（连接 {shard}）: {err}")
+                return False
+            return True
+
+        async def sync_subscriptions():
+            want = wants[shard] if shard < len(wants) else set()
+            changed = {"SUBSCRIBE": 0, "UNSUBSCRIBE": 0}
+            for method, names in (("UNSUBSCRIBE", sorted(subscribed - want)), ("SUBSCRIBE", sorted(want - subscribed))):
+                for i in range(0, len(names), STREAM_SUB_BATCH):
+                    part = names[i:i + STREAM_SUB_BATCH]
+                    if await control(method, part):
+                        if method == "SUBSCRIBE":
+                            subscribed.update(part)
+                        else:
+                            subscribed.difference_update(part)
+                        changed[method] += len(part)
+                    # 服务端限制每秒最多 10 条控制消息
+                    await asyncio.sleep(0.2)
+            if changed["SUBSCRIBE"] or changed["UNSUBSCRIBE"]:
+                print(f"✓ 行情推送订阅更新（连接 {shard}）: +{changed['SUBSCRIBE']} -{changed['UNSUBSCRIBE']} 共 {len(subscribed)} 个流")
+
+        async def watcher():
+            while True:
+                await sync_subscriptions()
+                await asyncio.sleep(1.0)
+
+        async def reader():
+            async for raw in ws:
+                reply = handle_stream_message(raw)
+                if reply is not None:
+                    fut = pending.get(reply.get("id"))
+                    if fut is not None and not fut.done():
+                        fut.set_result(reply)
+
+        tasks = [asyncio.create_task(reader()), asyncio.create_task(watcher())]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                t.result()
+        finally:
+            for t in tasks:
+                t.cancel()
+
+async def _stream_shard_main(url: str, shard: int, wants: list[set[str]]):
+    import asyncio
+    backoff = 1.0
+    while True:
+        if shard >= len(wants) or not wants[shard]:
+            await asyncio.sleep(1.0)
+            continue
+        started = time.time()
+        try:
+            await _stream_session(url, shard, wants)
+            print(f"行情推送连接 {shard} 关闭，准备重连")
+        except Exception as e:
+            print(f"行情推送连接 {shard} 异常: {e}")
+        if time.time() - started > 60:
+            backoff = 1.0
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, 30.0)
+
+async def stream_feed_main(url: str | None = None):
+    # 分配器每秒按 selected_symbols（及有持仓的交易对）重新规划各连接的流，连接数不够时新开
+    import asyncio
+    url = url or WS_URL
+    wants: list[set[str]] = []
+    tasks: list[asyncio.Task] = []
+    while True:
+        try:
+            syms = set(selected_symbols)
+            # 已有持仓的交易对即使被移出 selected_symbols 也继续订阅 K 线
+            syms |= account_book.symbols()
+            wants[:] = plan_stream_shards(stream_names(syms), wants, STREAM_MAX_PER_CONN)
+        except Exception:
+            pass
+        while len(tasks) < len(wants):
+            tasks.append(asyncio.create_task(_stream_shard_main(url, len(tasks), wants)))
+        await asyncio.sleep(1.0)
+
+def stream_feed_loop():
+    import asyncio
+    asyncio.run(stream_feed_main())
+
+# 账户/持仓/挂单簿：USER_STREAM=1 时由用户数据流 ACCOUNT_UPDATE / ORDER_TRADE_UPDATE 实时维护，
+# 后台定时用 REST 对账；未启用或推送中断时 get_positions / get_account_info / list_open_orders 仍走 REST
+def latest_mark_price(sym: str) -> float:
+    if MARKET_FEED == "ws":
+        lim = time.time() - STREAM_STALE_SEC
+        if stream_mark_at.get(sym, 0.0) >= lim and stream_mark_prices.get(sym):
+            return stream_mark_prices[sym]
+        if stream_price_at.get(sym, 0.0) >= lim and stream_prices.get(sym):
+            return stream_prices[sym]
+    ps = prices.get(sym)
+    if ps is not None:
+        last = ps.last()
+        if last and (int(time.time() * 1000) - last[0]) <= 5000:
+            return last[1]
+    return 0.0
+
+def apply_local_pnl(items: list[dict]) -> list[dict]:
+    # 用最新标记价（无推送时用最近成交价）与开仓均价、数量本地计算未实现盈亏与名义价值
+    for it in items:
+        mark = latest_mark_price(it.get("symbol"))
+        if mark <= 0:
+            continue
+        try:
+            amt = float(it.get("positionAmt", 0) or 0)
+            entry = float(it.get("entryPrice", 0) or 0)
+        except Exception:
+            continue
+        it["markPrice"] = str(mark)
+        it["unRealizedProfit"] = str((mark - entry) * amt)
+        it["notional"] = str(amt * mark)
+    return items
+
+class AccountBook:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.positions: dict[tuple[str, str], dict] = {}
+        self.closed_at: dict[tuple[str, str], int] = {}
+        self.account: dict = {}
+        self.orders: dict[tuple[str, int], dict] = {}
+        self.synced_at = 0.0
+        self.orders_synced_at = 0.0
+        self.stream_ok = False
+        self.listeners: list = []
+
+    def ready(self) -> bool:
+        return self.stream_ok and (time.time() - self.synced_at) <= ACCOUNT_RECONCILE_SEC * 3
+
+    def load_positions(self, arr: list):
+        with self.lock:
+            fresh = {}
+            for it in arr:
+                try:
+                    key = (it.get("symbol"), str(it.get("positionSide", "")).upper())
+                    amt = float(str(it.get("positionAmt", "0")) or 0)
+                    upd = int(float(str(it.get("updateTime", "0")) or 0))
+                except Exception:
+                    continue
+                old = self.positions.get(key)
+                # 推送的事件比 REST 快照更新时保留推送结果
+                if old is not None and int(old.get("updateTime", 0) or 0) > upd:
+                    fresh[key] = old
+                    continue
+                if old is None and self.closed_at.get(key, 0) > upd:
+                    continue
+                if abs(amt) > 1e-12:
+                    fresh[key] = dict(it)
+            for key, old in self.positions.items():
+                if key not in fresh and int(old.get("updateTime", 0) or 0) > int(time.time() * 1000) - 2000:
+                    fresh[key] = old
+            self.positions = fresh
+            self.synced_at = time.time()
+
+    def load_account(self, acc: dict):
+        with self.lock:
+            self.account = dict(acc)
+
+    def load_orders(self, arr: list):
+        with self.lock:
+            self.orders = {}
+            for it in arr:
+                try:
+                    self.orders[(it.get("symbol"), int(it.get("orderId")))] = dict(it)
+                except Exception:
+                    continue
+            self.orders_synced_at = time.time()
+
+    def on_account_update(self, data: dict):
+        a = data.get("a") or {}
+        ts = int(data.get("T") or data.get("E") or 0)
+        with self.lock:
+            for b in a.get("B", []) or []:
+                if str(b.get("a", "")).upper() == "USDT":
+                    try:
+                        self.account["totalWalletBalance"] = str(float(b.get("wb", 0) or 0))
+                    except Exception:
+                        pass
+            for p in a.get("P", []) or []:
+                try:
+                    sym = p.get("s")
+                    side = str(p.get("ps", "")).upper()
+                    amt = float(p.get("pa", 0) or 0)
+                    entry = float(p.get("ep", 0) or 0)
+                    up = float(p.get("up", 0) or 0)
+                except Exception:
+                    continue
+                key = (sym, side)
+                if abs(amt) <= 1e-12:
+                    self.positions.pop(key, None)
+                    self.closed_at[key] = ts
+                    continue
+                self.closed_at.pop(key, None)
+                mark = (entry + up / amt) if abs(amt) > 1e-12 else entry
+                self.positions[key] = {
+                    "symbol": sym,
+                    "positionSide": side,
+                    "positionAmt": str(amt),
+                    "entryPrice": str(entry),
+                    "unRealizedProfit": str(up),
+                    "markPrice": str(mark),
+                    "notional": str(amt * mark),
+                    "updateTime": ts,
+                }
+        risk_wakeup.set()
+
+    def on_order_update(self, data: dict):
+        o = data.get("o") or {}
+        try:
+            key = (o.get("s"), int(o.get("i")))
+        except Exception:
+            return
+        st = str(o.get("X", "")).upper()
+        order = {
+            "symbol": o.get("s"),
+            "orderId": key[1],
+            "clientOrderId": o.get("c"),
+            "side": o.get("S"),
+            "type": o.get("o"),
+            "positionSide": o.get("ps"),
+            "status": st,
+            "origQty": o.get("q"),
+            "executedQty": o.get("z"),
+            "avgPrice": o.get("ap"),
+            "stopPrice": o.get("sp"),
+            "reduceOnly": o.get("R"),
+            "updateTime": int(o.get("T") or data.get("T") or 0),
+        }
+        with self.lock:
+            if st in ("NEW", "PARTIALLY_FILLED"):
+                self.orders[key] = order
+            else:
+                self.orders.pop(key, None)
+            listeners = list(self.listeners)
+        for fn in listeners:
+            try:
+                fn(order)
+            except Exception:
+                pass
+
+    def positions_list(self) -> list[dict]:
+        with self.lock:
+            items = [dict(v) for v in self.positions.values()]
+        return apply_local_pnl(items)
+
+    def account_info(self) -> dict:
+        with self.lock:
+            acc = dict(self.account)
+        try:
+            wallet = float(acc.get("totalWalletBalance", 0) or 0)
+            unreal = sum(float(it.get("unRealizedProfit", 0) or 0) for it in self.positions_list())
+            acc["totalUnrealizedProfit"] = str(unreal)
+            acc["totalMarginBalance"] = str(wallet + unreal)
+        except Exception:
+            pass
+        return acc
+
+    def open_orders(self, sym: str) -> list[dict]:
+        with self.lock:
+            return [dict(v) for (s, _), v in self.orders.items() if s == sym]
+
+    def symbols(self) -> set[str]:
+        with self.lock:
+            return {s for s, _ in self.positions}
+
+account_book = AccountBook()
+account_book.listeners.append(on_order_fill_event)
+risk_wakeup = threading.Event()
+
+def reconcile_account(orders: bool = False):
+    arr = api_get("/fapi/v3/positionRisk", signed=True, api_key=g_api_key, secret=g_secret)
+    if isinstance(arr, list):
+        account_book.load_positions(arr)
+    acc = api_get("/fapi/v3/account", signed=True, api_key=g_api_key, secret=g_secret)
+    if isinstance(acc, dict) and "totalWalletBalance" in acc:
+        account_book.load_account(acc)
+    if orders:
+        oo = api_get("/fapi/v1/openOrders", signed=True, api_key=g_api_key, secret=g_secret)
+        if isinstance(oo, list):
+            account_book.load_orders(oo)
+
+def account_reconcile_loop():
+    while True:
+        try:
+            due_orders = (time.time() - account_book.orders_synced_at) >= ORDER_RECONCILE_SEC
+            reconcile_account(orders=due_orders)
+        except Exception:
+            pass
+        time.sleep(ACCOUNT_RECONCILE_SEC)
+
+def new_listen_key() -> str:
+    j = api_request("POST", "/fapi/v1/listenKey", api_key=g_api_key)
+    key = j.get("listenKey") if isinstance(j, dict) else None
+    if not key:
+        raise RuntimeError(f"获取 listenKey 失败: {j}")
+    return key
+
+def handle_user_event(raw) -> str | None:
+    try:
+        data = json.loads(raw)
+    except Exception:
+        return None
+    if not isinstance(data, dict):
+        return None
+    ev = data.get("e")
+    if ev == "ACCOUNT_UPDATE":
+        account_book.on_account_update(data)
+    elif ev == "ORDER_TRADE_UPDATE":
+        account_book.on_order_update(data)
+    elif ev == "listenKeyExpired":
+        return "expired"
+    return ev
+
+async def _user_stream_session(url: str, key: str):
+    import asyncio
+    async with websockets.connect(f"{url}/ws/{key}", ping_interval=20) as ws:
+        account_book.stream_ok = True
+        print("✓ 用户数据流已连接")
+        # 连接建立后立即对账，补上断线期间遗漏的事件
+        await asyncio.to_thread(reconcile_account, True)
+
+        async def keepalive():
+            while True:
+                await asyncio.sleep(LISTEN_KEY_KEEPALIVE_SEC)
+                await asyncio.to_thread(api_request, "PUT", "/fapi/v1/listenKey", None, False, g_api_key)
+
+        ka = asyncio.create_task(keepalive())
+        try:
+            async for raw in ws:
+                if handle_user_event(raw) == "expired":
+                    print("listenKey 已过期，重新连接用户数据流")
+                    break
+        finally:
+            ka.cancel()
+
+async def user_stream_main(url: str | None = None):
+    import asyncio
+    url = url or WS_URL
+    backoff = 1.0
+    while True:
+        started = time.time()
+        try:
+            key = await asyncio.to_thread(new_listen_key)
+            await _user_stream_session(url, key)
+        except Exception as e:
+            print(f"用户数据流异常: {e}")
+        account_book.stream_ok = False
+        if time.time() - started > 60:
+            backoff = 1.0
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, 30.0)
+
+def user_stream_loop():
+    import asyncio
+    asyncio.run(user_stream_main())
+
 def ticker_loop():
     next_tick = time.perf_counter()
     while True:
+        t_iter = time.perf_counter()
         try:
-            j = api_get("/fapi/v2/ticker/price")
-            mp = {}
-            if isinstance(j, list):
-                with lock:
-                    sel = set(selected_symbols)
-                for it in j:
-                    sym = it.get("symbol")
-                    if sym in sel:
-                        try:
-                            p = float(it.get("price", 0) or 0)
-                        except Exception:
-                            p = 0.0
-                        mp[sym] = p
+            sel = selected_symbols
+            # 推送新鲜的交易对用推送价；没有推送或已过期的交易对（REST 模式下即全部）用一次 REST 全量价格补齐
+            feed = fresh_stream_prices()
+            stale = [sym for sym in sel if sym not in feed]
+            if stale:
+                rest = fetch_ticker_prices()
+                t_recv = time.perf_counter()
+                for sym in stale:
+                    p = rest.get(sym)
+                    if p is None:
+                        continue
+                    feed[sym] = p
+                    if LATENCY_TRACE:
+                        tick_received_at[sym] = t_recv
+            apply_pending_installs()
+            series = prices
+            inds = indicators
+            mp = {sym: p for sym, p in list(feed.items()) if sym in sel}
             now = int(time.time() * 1000)
-            with lock:
-                for sym, price in mp.items():
-                    dq = prices.get(sym)
-                    if dq is None:
-                        dq = deque(maxlen=1500)
-                        prices[sym] = dq
-                    dq.append({"t": now, "p": price})
+            for sym, price in mp.items():
+                dq = series.get(sym)
+                ind = inds.get(sym)
+                if dq is None or ind is None:
+                    continue
+                dq.append(now, price)
+                ind.push(price)
+            if not risk_watch.isdisjoint(mp):
+                risk_wakeup.set()
+            if LATENCY_TRACE:
+                t_done = time.perf_counter()
+                for sym in mp:
+                    t0 = tick_received_at.get(sym)
+                    if t0 is not None:
+                        record_latency("1s", "indicators", "total", t_done - t0)
         except Exception:
             pass
+        m_loop_seconds.observe(time.perf_counter() - t_iter, "ticker")
         next_tick += 1.0
         delay = next_tick - time.perf_counter()
         if delay > 0:
             time.sleep(delay)
 
+_eval_threads: dict[str, concurrent.futures.ThreadPoolExecutor] = {}
+_eval_procs = None
+_eval_shm = None
+_eval_pool_lock = threading.Lock()
+_worker_shm: dict[str, object] = {}
+
+def eval_thread_pool(kind: str) -> concurrent.futures.ThreadPoolExecutor:
+    # 评估/下单线程池常驻，不再每轮新建；秒级与分钟级各用一个，互不排队
+    with _eval_pool_lock:
+        ex = _eval_threads.get(kind)
+        if ex is None:
+            ex = _eval_threads[kind] = concurrent.futures.ThreadPoolExecutor(max_workers=12, thread_name_prefix=f"eval-{kind}")
+        return ex
+
+def eval_process_pool() -> concurrent.futures.ProcessPoolExecutor | None:
+    global _eval_procs
+    if EVAL_WORKERS <= 0:
+        return None
+    with _eval_pool_lock:
+        if _eval_procs is None:
+            # spawn：父进程有大量线程和锁，fork 出的子进程可能继承被占用的锁
+            ctx = multiprocessing.get_context("spawn")
+            _eval_procs = concurrent.futures.ProcessPoolExecutor(max_workers=EVAL_WORKERS, mp_context=ctx)
+        return _eval_procs
+
+def _kline_shm(n_syms: int):
+    # 分钟 K 线共享内存：[o,h,l,c,q] x 交易对 x KLINE_CACHE_BARS，容量不够时整块重建
+    global _eval_shm
+    if _eval_shm is not None and _eval_shm[1][1] >= n_syms:
+        return _eval_shm
+    cap = max(64, 1 << max(0, n_syms - 1).bit_length())
+    shape = (5, cap, KLINE_CACHE_BARS)
+    shm = shared_memory.SharedMemory(create=True, size=8 * shape[0] * shape[1] * shape[2])
+    old = _eval_shm
+    _eval_shm = (shm, shape)
+    if old is not None:
+        _release_kline_shm(old)
+    else:
+        atexit.register(lambda: _release_kline_shm(_eval_shm))
+    return _eval_shm
+
+def _release_kline_shm(block):
+    try:
+        block[0].close()
+        block[0].unlink()
+    except Exception:
+        pass
+
+def _attach_kline_shm(name: str, shape: tuple):
+    shm = _worker_shm.get(name)
+    if shm is None:
+        for stale in list(_worker_shm):
+            _worker_shm.pop(stale).close()
+        shm = _worker_shm[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+
+def _eval_shard(task: tuple) -> list[tuple]:
+    # 子进程：从共享内存读 K 线，算指标和规则，只把信号返回给父进程
+    global INDICATOR_BACKEND
+    name, shape, backend, rows = task
+    INDICATOR_BACKEND = backend
+    arr = _attach_kline_shm(name, shape)
+    snaps = []
+    if use_np_backend():
+        closes = [arr[3, slot, :n] for slot, _, n, _ in rows]
+        inds = calc_indicators_batch(closes, SNAPSHOT_TAIL)
+        for (slot, _, n, _), ind in zip(rows, inds):
+            bars = {f: arr[i, slot, :n] for i, f in enumerate(("o", "h", "l", "c"))}
+            snaps.append(batch_snapshot(ind, bars, n - 1))
+    else:
+        for slot, _, n, _ in rows:
+            bars = {f: arr[i, slot, :n].tolist() for i, f in enumerate(("o", "h", "l", "c"))}
+            snaps.append(LazySnapshot(bars["c"], bars))
+    out = []
+    for (slot, sym, n, last_dir), snap in zip(rows, snaps):
+        q = arr[4, slot, :n]
+        conds, near = MINUTE_RULES.evaluate_progress(snap, last_dir)
+        signal = pick_signal(conds, last_dir, lambda: volume_stats(q.tolist()))
+        out.append((sym, near, (signal[0], signal[1], float(snap["cp"])) if signal else None))
+    return out
+
+def minute_signals_in_processes(fetched: list[tuple[str, dict]], deadline_ms: int | None = None) -> tuple[list[tuple], int]:
+    # 父进程把本轮 K 线写入共享内存，按交易对分片交给常驻进程池；
+    # 返回 (信号列表, 截止前未返回的交易对数)
+    pool = eval_process_pool()
+    shm, shape = _kline_shm(len(fetched))
+    arr = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    items = []
+    for slot, (sym, bars) in enumerate(fetched):
+        n = min(len(bars["c"]), shape[2])
+        for i, f in enumerate(("o", "h", "l", "c", "q")):
+            arr[i, slot, :n] = bars[f][-n:]
+        items.append((slot, sym, n, last_macd_dir.get(sym)))
+    shards = [items[i::EVAL_WORKERS] for i in range(EVAL_WORKERS)]
+    futs = {pool.submit(_eval_shard, (shm.name, shape, INDICATOR_BACKEND, s)): len(s) for s in shards if s}
+    timeout = None if deadline_ms is None else max(0.0, (deadline_ms - now_ms()) / 1000.0)
+    done, late = concurrent.futures.wait(futs, timeout=timeout)
+    out = []
+    for f in done:
+        for sym, near, signal in f.result():
+            minute_proximity[sym] = near
+            if signal:
+                out.append((sym,) + signal)
+    return out, sum(futs[f] for f in late)
+
 def second_eval_loop():
-    import concurrent.futures
     next_tick = time.perf_counter()
     while True:
         try:
-            with lock:
-                syms = list(selected_symbols)
+            syms = list(selected_symbols)
             def eval_symbol(sym: str):
-                dq = prices.get(sym, deque())
-                if len(dq) < 600:
+                ind = indicators.get(sym)
+                snap = ind.last if ind else None
+                if not snap or snap["n"] < 600:
                     return False
-                closes = [x["p"] for x in dq]
-                mid, up, down = boll(closes, 200, 1)
-                ema7 = ema(closes, 7)
-                ema25 = ema(closes, 25)
-                ema60 = ema(closes, 60)
-                ema100 = ema(closes, 100)
-                ema200 = ema(closes, 200)
-                ema500 = ema(closes, 500)
-                dif, dea = macd(closes, 60, 200, 60)
-                rsi80 = rsi(closes, 80)
-                rsi200 = rsi(closes, 200)
-                rsi500 = rsi(closes, 500)
-                k, d, jv = kdj_from_close(closes, 20, 80, 200)
-                idx = len(closes) - 1
-                cp = closes[idx]
-                cond_long1 = (
-                    cp > ema500[idx] and
-                    cp > up[idx] and
-                    (ema7[idx] > ema25[idx] > ema60[idx] > ema100[idx] > ema200[idx] > ema500[idx]) and
-                    any(ema7[idx - i] < ema500[idx - i] for i in range(1, min(10, idx)+1)) and
-                    dif[idx] > dea[idx] and
-                    (rsi80[idx] > rsi200[idx] and rsi80[idx] > rsi500[idx]) and
-                    ((k[idx] > d[idx] > jv[idx]) or all(k[idx - i] > k[idx - i - 1] and jv[idx - i] > jv[idx - i - 1] for i in range(1, min(3, idx))) )
-                )
-                cond_long2 = (
-                    cp > ema500[idx] and
-                    cp > up[idx] and
-                    (ema7[idx] > ema25[idx] > ema60[idx] > ema100[idx] > ema200[idx] > ema500[idx]) and
-                    any(ema7[idx - i] < ema25[idx - i] for i in range(1, min(3, idx)+1)) and
-                    dif[idx] > dea[idx] and
-                    (rsi80[idx] > rsi200[idx] and rsi80[idx] > rsi500[idx])
-                )
-                cond_short1 = (
-                    cp < ema500[idx] and
-                    cp < down[idx] and
-                    (ema7[idx] < ema25[idx] < ema60[idx] < ema100[idx] < ema200[idx] < ema500[idx]) and
-                    any(ema7[idx - i] > ema500[idx - i] for i in range(1, min(10, idx)+1)) and
-                    dif[idx] < dea[idx] and
-                    (rsi80[idx] < rsi200[idx] and rsi80[idx] < rsi500[idx]) and
-                    ((k[idx] < d[idx] < jv[idx]) or all(k[idx - i] < k[idx - i - 1] and jv[idx - i] < jv[idx - i - 1] for i in range(1, min(3, idx))) )
-                )
-                cond_short2 = (
-                    cp < ema500[idx] and
-                    cp < down[idx] and
-                    (ema7[idx] < ema25[idx] < ema60[idx] < ema100[idx] < ema200[idx] < ema500[idx]) and
-                    any(ema7[idx - i] > ema25[idx - i] for i in range(1, min(3, idx)+1)) and
-                    dif[idx] < dea[idx] and
-                    (rsi80[idx] < rsi200[idx] and rsi80[idx] < rsi500[idx])
-                )
-                def pass_macd_once(dir_flag: str) -> bool:
-                    last = last_macd_dir.get(sym)
-                    if last == dir_flag:
-                        return False
-                    return True
-                signal = None
-                if cond_long1 and pass_macd_once("LONG_DIF_GT_DEA"):
-                    vols = klines_1m_quote_vol(sym, 1000)
-                    if len(vols) >= 2:
-                        if vols[-1] >= 2 * vols[-2] and (sum(vols[-20:]) / 20.0) > (sum(vols[-500:]) / 500.0):
-                            signal = ("LONG", "做多1")
-                if signal is None and cond_long2 and pass_macd_once("LONG_DIF_GT_DEA"):
-                    vols = klines_1m_quote_vol(sym, 1000)
-                    if len(vols) >= 500:
-                        if (sum(vols[-20:]) / 20.0) > (sum(vols[-500:]) / 500.0):
-                            signal = ("LONG", "做多2")
-                if signal is None and cond_short1 and pass_macd_once("SHORT_DIF_LT_DEA"):
-                    vols = klines_1m_quote_vol(sym, 1000)
-                    if len(vols) >= 2:
-                        if vols[-1] >= 2 * vols[-2] and (sum(vols[-20:]) / 20.0) < (sum(vols[-500:]) / 500.0):
-                            signal = ("SHORT", "做空1")
-                if signal is None and cond_short2 and pass_macd_once("SHORT_DIF_LT_DEA"):
-                    vols = klines_1m_quote_vol(sym, 1000)
-                    if len(vols) >= 500:
-                        if (sum(vols[-20:]) / 20.0) < (sum(vols[-500:]) / 500.0):
-                            signal = ("SHORT", "做空2")
+                last_dir = last_macd_dir.get(sym)
+                conds = second_conditions(snap, last_dir)
+                trace = latency_trace("1s", tick_received_at.get(sym)) if any(conds) else None
+                if trace:
+                    trace.mark("condition")
+                signal = pick_signal(conds, last_dir, lambda: volume_stats(klines_1m_quote_vol(sym, 1000)))
+                if trace:
+                    trace.mark("volume")
                 if signal:
                     side_dir, label = signal
-                    try:
-                        try_open(sym, cp, side_dir, label)
-                    except Exception as e:
-                        print(f"下单失败: {sym} {side_dir} {e}")
+                    m_signals.inc(label, "1s")
+                    submit_open(sym, snap["cp"], side_dir, label, trace)
                 return True
-            with concurrent.futures.ThreadPoolExecutor(max_workers=12) as ex:
-                list(ex.map(eval_symbol, syms))
+            t_iter = time.perf_counter()
+            list(eval_thread_pool("second").map(eval_symbol, syms))
+            m_loop_seconds.observe(time.perf_counter() - t_iter, "second_eval")
         except Exception:
             pass
         next_tick += 1.0
@@ -727,120 +3549,135 @@ def second_eval_loop():
         if delay > 0:
             time.sleep(delay)
 
+minute_sweeps: deque = deque(maxlen=120)
+
+def minute_priority(syms) -> list[str]:
+    # 上一轮离触发最近的优先，其次按 24h 成交额
+    return sorted(syms, key=lambda s: (-minute_proximity.get(s, 0.0), -symbol_quote_volume.get(s, 0.0), s))
+
+def get_minute_sweep_stats() -> dict:
+    sweeps = list(minute_sweeps)
+    return {
+        "sweeps": len(sweeps),
+        "late_sweeps": sum(1 for s in sweeps if s["missed"] or s["stale"]),
+        "last": sweeps[-1] if sweeps else None,
+        "max_duration_ms": max((s["end"] - s["start"] for s in sweeps), default=0),
+        "missed_total": sum(s["missed"] for s in sweeps),
+    }
+
+def _sleep_until_ms(target: int):
+    time.sleep(max(0.0, (target - now_ms()) / 1000.0))
+
 def minute_eval_loop():
-    import concurrent.futures
     while True:
         try:
             now = now_ms()
-            target = ((now // 60000) * 60000) + 57_000
-            if now > target:
-                target += 60_000
-            time.sleep(max(0.0, (target - now) / 1000.0))
-            with lock:
-                syms = list(selected_symbols)
-            def process_symbol(sym: str):
-                kl = api_get("/fapi/v1/klines", {"symbol": sym, "interval": "1m", "limit": 1000})
-                if not isinstance(kl, list) or len(kl) < 600:
+            candle = (now // 60000) * 60000
+            if now > candle + MINUTE_EVAL_MS:
+                candle += 60_000
+            cutoff = candle + MINUTE_CUTOFF_MS
+            syms = minute_priority(selected_symbols)
+            ex = eval_thread_pool("minute")
+            if now_ms() < candle + MINUTE_PREWARM_MS:
+                # 预取：把缓存补到当前 K 线，57 秒时只需增量拉取
+                _sleep_until_ms(candle + MINUTE_PREWARM_MS)
+                warm = [ex.submit(klines_1m, s, 1000) for s in syms]
+                concurrent.futures.wait(warm, timeout=max(0.0, (candle + MINUTE_EVAL_MS - now_ms()) / 1000.0))
+            _sleep_until_ms(candle + MINUTE_EVAL_MS)
+            t_sweep = time.perf_counter()
+            sweep = {"candle": candle, "start": now_ms(), "symbols": len(syms), "evaluated": 0,
+                     "missed": 0, "stale": 0, "signals": 0, "fetched_at": 0, "end": 0}
+            def fetch_symbol(sym: str):
+                if now_ms() >= cutoff:
+                    return False
+                bars = klines_1m(sym, 1000)
+                if len(bars["t"]) < 600:
                     return None
-                closes = [float(it[4]) for it in kl]
-                highs = [float(it[2]) for it in kl]
-                lows = [float(it[3]) for it in kl]
-                opens = [float(it[1]) for it in kl]
-                mid, up, down = boll(closes, 200, 1)
-                ema7 = ema(closes, 7)
-                ema25 = ema(closes, 25)
-                ema60 = ema(closes, 60)
-                ema100 = ema(closes, 100)
-                ema200 = ema(closes, 200)
-                ema500 = ema(closes, 500)
-                dif, dea = macd(closes, 60, 200, 60)
-                rsi80 = rsi(closes, 80)
-                rsi200 = rsi(closes, 200)
-                rsi500 = rsi(closes, 500)
-                k, d, jv = kdj_from_close(closes, 20, 80, 200)
-                idx = len(closes) - 1
-                cp = closes[idx]
-                cond_long1 = (
-                    opens[idx] > ema500[idx] and closes[idx] > ema500[idx] and highs[idx] > ema500[idx] and lows[idx] > ema500[idx] and
-                    cp > up[idx] and
-                    (ema7[idx] > ema25[idx] > ema60[idx] > ema100[idx] > ema200[idx] > ema500[idx]) and
-                    any(ema7[idx - i] < ema500[idx - i] for i in range(1, min(10, idx)+1)) and
-                    dif[idx] > dea[idx] and
-                    (rsi80[idx] > rsi200[idx] and rsi80[idx] > rsi500[idx]) and
-                    ((k[idx] > d[idx] > jv[idx]) or all(k[idx - i] > k[idx - i - 1] and jv[idx - i] > jv[idx - i - 1] for i in range(1, min(3, idx))) )
-                )
-                cond_long2 = (
-                    opens[idx] > ema100[idx] and closes[idx] > ema100[idx] and highs[idx] > ema100[idx] and lows[idx] > ema100[idx] and
-                    cp > up[idx] and
-                    (ema7[idx] > ema25[idx] > ema60[idx] > ema100[idx] > ema200[idx] > ema500[idx]) and
-                    any(ema7[idx - i] < ema25[idx - i] for i in range(1, min(3, idx)+1)) and
-                    dif[idx] > dea[idx] and
-                    (rsi80[idx] > rsi200[idx] and rsi80[idx] > rsi500[idx])
-                )
-                cond_short1 = (
-                    opens[idx] < ema500[idx] and closes[idx] < ema500[idx] and highs[idx] < ema500[idx] and lows[idx] < ema500[idx] and
-                    cp < down[idx] and
-                    (ema7[idx] < ema25[idx] < ema60[idx] < ema100[idx] < ema200[idx] < ema500[idx]) and
-                    any(ema7[idx - i] > ema500[idx - i] for i in range(1, min(10, idx)+1)) and
-                    dif[idx] < dea[idx] and
-                    (rsi80[idx] < rsi200[idx] and rsi80[idx] < rsi500[idx]) and
-                    ((k[idx] < d[idx] < jv[idx]) or all(k[idx - i] < k[idx - i - 1] and jv[idx - i] < jv[idx - i - 1] for i in range(1, min(3, idx))) )
-                )
-                cond_short2 = (
-                    opens[idx] < ema100[idx] and closes[idx] < ema100[idx] and highs[idx] < ema100[idx] and lows[idx] < ema100[idx] and
-                    cp < down[idx] and
-                    (ema7[idx] < ema25[idx] < ema60[idx] < ema100[idx] < ema200[idx] < ema500[idx]) and
-                    any(ema7[idx - i] > ema25[idx - i] for i in range(1, min(3, idx)+1)) and
-                    dif[idx] < dea[idx] and
-                    (rsi80[idx] < rsi200[idx] and rsi80[idx] < rsi500[idx])
-                )
-                def pass_macd_once(dir_flag: str) -> bool:
-                    last = last_macd_dir.get(sym)
-                    if last == dir_flag:
-                        return False
-                    return True
-                signal = None
-                if cond_long1 and pass_macd_once("LONG_DIF_GT_DEA"):
-                    vols = klines_1m_quote_vol(sym, 1000)
-                    if len(vols) >= 2:
-                        if vols[-1] >= 2 * vols[-2] and (sum(vols[-20:]) / 20.0) > (sum(vols[-500:]) / 500.0):
-                            signal = ("LONG", "做多1")
-                if signal is None and cond_long2 and pass_macd_once("LONG_DIF_GT_DEA"):
-                    vols = klines_1m_quote_vol(sym, 1000)
-                    if len(vols) >= 500:
-                        if (sum(vols[-20:]) / 20.0) > (sum(vols[-500:]) / 500.0):
-                            signal = ("LONG", "做多2")
-                if signal is None and cond_short1 and pass_macd_once("SHORT_DIF_LT_DEA"):
-                    vols = klines_1m_quote_vol(sym, 1000)
-                    if len(vols) >= 2:
-                        if vols[-1] >= 2 * vols[-2] and (sum(vols[-20:]) / 20.0) < (sum(vols[-500:]) / 500.0):
-                            signal = ("SHORT", "做空1")
-                if signal is None and cond_short2 and pass_macd_once("SHORT_DIF_LT_DEA"):
-                    vols = klines_1m_quote_vol(sym, 1000)
-                    if len(vols) >= 500:
-                        if (sum(vols[-20:]) / 20.0) < (sum(vols[-500:]) / 500.0):
-                            signal = ("SHORT", "做空2")
+                return sym, bars
+            def process_symbol(sym: str, snap):
+                if now_ms() >= cutoff:
+                    return "missed"
+                cp = snap["cp"]
+                last_dir = last_macd_dir.get(sym)
+                conds, minute_proximity[sym] = MINUTE_RULES.evaluate_progress(snap, last_dir)
+                trace = latency_trace("1m", t_sweep) if any(conds) else None
+                if trace:
+                    trace.mark("condition")
+                signal = pick_signal(conds, last_dir, lambda: volume_stats(klines_1m_quote_vol(sym, 1000)))
+                if trace:
+                    trace.mark("volume")
                 if signal:
                     side_dir, label = signal
-                    try:
-                        try_open(sym, cp, side_dir, label)
-                    except Exception as e:
-                        print(f"下单失败: {sym} {side_dir} {e}")
-                return True
-            with concurrent.futures.ThreadPoolExecutor(max_workers=12) as ex:
-                list(ex.map(process_symbol, syms))
+                    m_signals.inc(label, "1m")
+                    submit_open(sym, cp, side_dir, label, trace)
+                    return "signal"
+                return "ok"
+            futs = [ex.submit(fetch_symbol, s) for s in syms]
+            done, late = concurrent.futures.wait(futs, timeout=max(0.0, (cutoff - now_ms()) / 1000.0))
+            for f in late:
+                f.cancel()
+            fetched = []
+            for f in futs:
+                res = f.result() if f in done else False
+                if not res:
+                    if res is False:
+                        sweep["missed"] += 1
+                    continue
+                # 最后一根必须是本轮要评估的 K 线，否则数据过期
+                if res[1]["t"][-1] != candle:
+                    sweep["stale"] += 1
+                    continue
+                fetched.append(res)
+            sweep["fetched_at"] = now_ms()
+            if EVAL_WORKERS > 0 and np is not None:
+                def open_signal(sig: tuple):
+                    sym, side_dir, label, cp = sig
+                    m_signals.inc(label, "1m")
+                    trace = latency_trace("1m", t_sweep)
+                    if trace:
+                        trace.mark("volume")
+                    submit_open(sym, cp, side_dir, label, trace)
+                signals, missed = minute_signals_in_processes(fetched, cutoff)
+                sweep["missed"] += missed
+                sweep["evaluated"] = len(fetched) - missed
+                sweep["signals"] = len(signals)
+                list(ex.map(open_signal, signals))
+            else:
+                if use_np_backend():
+                    inds = calc_indicators_batch([bars["c"] for _, bars in fetched], SNAPSHOT_TAIL)
+                    snaps = [batch_snapshot(ind, bars, len(bars["c"]) - 1) for (_, bars), ind in zip(fetched, inds)]
+                    if LATENCY_TRACE:
+                        record_latency("1m", "indicators", "total", time.perf_counter() - t_sweep)
+                else:
+                    # 列表版本按需计算：多数交易对在均线排列处就被淘汰，不必算 RSI/KDJ
+                    snaps = [LazySnapshot(list(bars["c"]), bars) for _, bars in fetched]
+                results = list(ex.map(process_symbol, [s for s, _ in fetched], snaps))
+                sweep["missed"] += results.count("missed")
+                sweep["evaluated"] = len(results) - results.count("missed")
+                sweep["signals"] = results.count("signal")
+            sweep["end"] = now_ms()
+            minute_sweeps.append(sweep)
+            m_loop_seconds.observe(time.perf_counter() - t_sweep, "minute_eval")
+            if sweep["missed"]:
+                m_sweep_missed.inc("deadline", amount=sweep["missed"])
+            if sweep["stale"]:
+                m_sweep_missed.inc("stale", amount=sweep["stale"])
+            if sweep["missed"] or sweep["stale"]:
+                print(f"分钟评估未完成: 超时 {sweep['missed']}  数据过期 {sweep['stale']}  用时 {sweep['end'] - sweep['start']}ms")
         except Exception:
             time.sleep(0.5)
 
-def try_open(sym: str, price: float, side_dir: str, label: str):
+def try_open(sym: str, price: float, side_dir: str, label: str, trace: LatencyTrace | None = None):
     key = (sym, side_dir)
     ts_now = time.time()
     if last_attempt_at.get(key, 0) and (ts_now - last_attempt_at[key]) < 30:
+        m_orders.inc("rejected", "cooldown")
         return
     last_attempt_at[key] = ts_now
     ratio = current_margin_ratio()
     if ratio > MAX_OPEN_MARGIN_RATIO:
         print(f"拒绝开单: 账户保证金率 {ratio:.2f}% 超过 {MAX_OPEN_MARGIN_RATIO}%")
+        m_orders.inc("rejected", "margin_ratio")
         return
     pos = get_positions()
     has_same = False
@@ -868,225 +3705,386 @@ def try_open(sym: str, price: float, side_dir: str, label: str):
             continue
     if has_same:
         print("拒绝开单: 已存在同方向持仓")
+        m_orders.inc("rejected", "same_side_position")
         return
     if wallet > 0 and total_nominal > wallet * 10.0:
         print("拒绝开单: 持仓名义价值超过钱包余额10倍")
+        m_orders.inc("rejected", "notional_cap")
         return
     qty_raw = ORDER_NOTIONAL / max(price, 1e-12)
     qty = adjust_qty(sym, qty_raw)
     if qty <= 0:
         flt = symbol_filters.get(sym, {})
         print(f"拒绝开单: 数量不满足最小/步长约束 qty_raw={qty_raw:.8f} minQty={flt.get('minQty',0)} stepSize={flt.get('stepSize',0)}")
+        m_orders.inc("rejected", "qty_filter")
         return
     side = "BUY" if side_dir == "LONG" else "SELL"
     position_side = "LONG" if side_dir == "LONG" else "SHORT"
-    j = place_market(sym, side, position_side, qty)
-    if not isinstance(j, dict) or (j.get("orderId") is None and j.get("clientOrderId") is None):
+    # 开仓市价单与按信号价计算的止盈单（及交易所止损单）合并为一个批量请求
+    mode = tp_mode(label, pos)
+    batch = [market_order_params(sym, side, position_side, qty), tp_order_params(sym, position_side, price, qty, mode)]
+    if SERVER_STOP:
+        batch.append(stop_market_params(sym, position_side, price, qty))
+    if trace:
+        trace.mark("risk")
+        # 权重排队之后、真正发出请求前由 api_request 记 order_sent
+        _http_local.trace = trace
+        try:
+            res = post_batch_orders(batch)
+        finally:
+            _http_local.trace = None
+        trace.mark("order_ack")
+    else:
+        res = post_batch_orders(batch)
+    j, tp = res[0], res[1]
+    sl = res[2] if SERVER_STOP else None
+    if not order_ok(j):
         print(f"下单失败: {sym} {side_dir} {j}")
+        code = j.get("code") if isinstance(j, dict) else None
+        m_orders.inc("rejected", f"exchange_{code}" if code is not None else "exchange")
+        ids = [int(x["orderId"]) for x in (tp, sl) if order_ok(x)]
+        if ids:
+            try:
+                cancel_orders(sym, ids)
+            except Exception as e:
+                print(f"撤销随开仓下的止盈/止损单失败: {sym} {ids} {e}")
         return
+    m_orders.inc("placed", label)
     oid = j.get("orderId")
     cid = j.get("clientOrderId")
-    avg = wait_fill_avg_price(sym, oid, cid)
+    try:
+        avg = float(j.get("avgPrice", 0) or 0)
+    except Exception:
+        avg = 0.0
+    if avg <= 0:
+        avg = wait_fill_avg_price(sym, oid, cid)
     if avg <= 0:
         avg = price
+    if trace:
+        trace.mark("fill")
     print(f"{fmt_time()}   {sym}   {position_side}  {avg:.8f}  策略：{label}")
     last_macd_dir[sym] = "LONG_DIF_GT_DEA" if side_dir == "LONG" else "SHORT_DIF_LT_DEA"
-    # 止损展示（不下单，轮询止损）
-    per_coin = ORDER_STOP_NOTIONAL / max(qty, 1e-12)
-    sl_price = (avg - per_coin) if position_side == "LONG" else (avg + per_coin)
-    print(f"  └─ 止损单: 止损价 {float(f'{sl_price:.2f}')}" )
-    if label in ("做多1", "做空1"):
-        place_tp_trailing(sym, position_side, avg, qty, is_long=(side_dir == "LONG"))
-        act = adjust_price(sym, avg * (1.02 if side_dir == "LONG" else 0.98))
-        print(f"  └─ 跟踪止盈: 激活价 {fmt_price(sym, act)}, 回调 0.5%")
-    else:
-        gains = 0.0
-        losses = 0.0
-        for pit in pos:
+    # 批量中的止盈/止损单以信号价为基准；被拒或成交均价偏离过大时撤掉，按成交均价重新下
+    basis = price
+    sl_basis = price
+    if abs(avg - price) > price * BATCH_TP_REPRICE_PCT:
+        ids = [int(x["orderId"]) for x in (tp, sl) if order_ok(x)]
+        if ids:
             try:
-                amt2 = float(str(pit.get("positionAmt", "0")) or 0)
-                if abs(amt2) <= 1e-12:
-                    continue
-                u = float(str(pit.get("unRealizedProfit", "0")) or 0)
-                if u >= 0:
-                    gains += u
-                else:
-                    losses += -u
+                cancel_orders(sym, ids)
             except Exception:
-                continue
-        if gains > losses:
-            place_tp_trailing(sym, position_side, avg, qty, is_long=(side_dir == "LONG"))
-            act = adjust_price(sym, avg * (1.02 if side_dir == "LONG" else 0.98))
-            print(f"  └─ 跟踪止盈(条件2动态): 激活价 {fmt_price(sym, act)}, 回调 0.5%  盈亏汇总 盈利>{'亏损' if gains>losses else '亏损'}")
+                pass
+        tp = sl = None
+    if not order_ok(tp):
+        basis = avg
+        post_order(tp_order_params(sym, position_side, avg, qty, mode))
+    if SERVER_STOP:
+        if not order_ok(sl):
+            sl_basis = avg
+            sl = post_order(stop_market_params(sym, position_side, avg, qty))
+        sl_price = adjust_price(sym, stop_loss_price(sl_basis, qty, position_side == "LONG"))
+        if order_ok(sl):
+            print(f"  └─ 止损单(交易所 STOP_MARKET): 止损价 {fmt_price(sym, sl_price)}")
+        else:
+            print(f"  └─ 交易所止损单下单失败，改由轮询止损: 止损价 {fmt_price(sym, sl_price)}  {sl}")
+    else:
+        # 止损展示（不下单，轮询止损）
+        sl_price = stop_loss_price(avg, qty, position_side == "LONG")
+        print(f"  └─ 止损单: 止损价 {float(f'{sl_price:.2f}')}" )
+    if mode == "trailing":
+        act = adjust_price(sym, trailing_activation(basis, side_dir == "LONG"))
+        print(f"  └─ 跟踪止盈: 激活价 {fmt_price(sym, act)}, 回调 {TRAIL_CALLBACK_RATE}%")
+    elif mode == "trailing_dyn":
+        act = adjust_price(sym, trailing_activation(basis, side_dir == "LONG"))
+        print(f"  └─ 跟踪止盈(条件2动态): 激活价 {fmt_price(sym, act)}, 回调 {TRAIL_CALLBACK_RATE}%  盈亏汇总 盈利>亏损")
+    else:
+        tgt = adjust_price(sym, limit_tp_target(basis, side_dir == "LONG"))
+        print(f"  └─ 限价止盈(条件2动态): 止盈价 {fmt_price(sym, tgt)}  盈亏汇总 盈利<=亏损")
+    if trace:
+        trace.mark("tp_placed")
+
+class PnlWindow:
+    # 持仓盈亏百分比的时间窗口：样本存放在 array 中，单调队列（存绝对下标）维护窗口内最大/最小值，
+    # 追加与查询均摊 O(1)；过期样本超过一半时整体前移，内存只与窗口内样本数有关
+    __slots__ = ("window", "t", "p", "base", "start", "qmax", "qmin", "first", "lock")
+
+    def __init__(self, window: float = STAGNATION_WINDOW_SEC):
+        self.window = window
+        self.t = array("d")
+        self.p = array("d")
+        self.base = 0
+        self.start = 0
+        self.qmax: deque = deque()
+        self.qmin: deque = deque()
+        self.first = math.inf
+        # 只在整体前移与 export 之间互斥，追加和查询仍由风控线程独占、不加锁
+        self.lock = threading.Lock()
+
+    def append(self, ts: float, pct: float):
+        if ts < self.first:
+            self.first = ts
+        self.t.append(ts)
+        self.p.append(pct)
+        i = self.base + len(self.t) - 1
+        p = self.p
+        b = self.base
+        qmax = self.qmax
+        qmin = self.qmin
+        while qmax and p[qmax[-1] - b] <= pct:
+            qmax.pop()
+        qmax.append(i)
+        while qmin and p[qmin[-1] - b] >= pct:
+            qmin.pop()
+        qmin.append(i)
+        self.evict(ts)
+
+    def evict(self, now: float):
+        t = self.t
+        s = self.start
+        n = len(t)
+        while s < n and now - t[s] > self.window:
+            s += 1
+        self.start = s
+        first = self.base + s
+        while self.qmax and self.qmax[0] < first:
+            self.qmax.popleft()
+        while self.qmin and self.qmin[0] < first:
+            self.qmin.popleft()
+        if s > 64 and s * 2 > n:
+            with self.lock:
+                del self.t[:s]
+                del self.p[:s]
+                self.base += s
+                self.start = 0
+
+    def __len__(self) -> int:
+        return len(self.t) - self.start
+
+    def last_t(self) -> float:
+        return self.t[-1] if len(self.t) else -math.inf
+
+    def range(self, now: float) -> float | None:
+        # 窗口 (now - window, now] 内的 最大值 - 最小值；样本还没覆盖满整个窗口（含刚恢复或刚建立）时返回 None
+        self.evict(now)
+        if not self.qmax or now - self.first < self.window:
+            return None
+        return self.p[self.qmax[0] - self.base] - self.p[self.qmin[0] - self.base]
+
+    def export(self) -> tuple[array, array]:
+        # 供快照线程调用：与整体前移互斥，start 和两列在同一把锁下读取；两列长度按较短的对齐
+        with self.lock:
+            s = self.start
+            ts = self.t[s:]
+            ps = self.p[s:]
+        n = min(len(ts), len(ps))
+        return ts[:n], ps[:n]
+
+# 风控批量评估：每轮把全部持仓收成列，盈利停滞、紧急止损、EMA500 穿越一次判定（有 numpy 时向量化）。
+# EMA500 直接取秒级指标引擎的增量结果；秒级序列不足时退回 1m K 线，已收盘部分的 EMA 按最后一根 K 线缓存，
+# 每轮只对正在形成的一根补一步，结果与 ema(closes, 500)[-1] 相同
+RISK_NONE = 0
+RISK_STAGNATION = 1
+RISK_STOP = 2
+RISK_EMA500 = 3
+_kline_ema500: dict[str, tuple[int, float]] = {}
+# 有持仓的交易对：这些交易对的新价格会唤醒 risk_loop
+risk_watch: frozenset[str] = frozenset()
+_risk_positions = {"at": 0.0, "items": []}
+
+def risk_positions() -> list[dict]:
+    if USER_STREAM and account_book.ready():
+        return account_book.positions_list()
+    now = time.time()
+    if now - _risk_positions["at"] >= RISK_POSITION_REFRESH_SEC:
+        arr = get_positions()
+        _risk_positions["items"] = [dict(x) for x in arr]
+        _risk_positions["at"] = now
+        return arr
+    return apply_local_pnl([dict(x) for x in _risk_positions["items"]])
+
+def invalidate_risk_positions():
+    # 平仓完成后下一轮重新拉取持仓，避免按旧快照重复平仓
+    _risk_positions["at"] = 0.0
+
+def risk_ema500(sym: str) -> tuple[float, float] | None:
+    ind = indicators.get(sym)
+    snap = ind.last if ind is not None else None
+    if snap and snap["n"] >= 500:
+        return snap["cp"], snap["ema500"]
+    bars = klines_1m(sym, 1000)
+    closes = bars["c"]
+    if len(closes) < 600:
+        return None
+    k = 2 / 501
+    t_last = int(bars["t"][-1])
+    hit = _kline_ema500.get(sym)
+    if hit is None or hit[0] != t_last:
+        e = closes[0]
+        for x in closes[:-1]:
+            e = x * k + e * (1 - k)
+        hit = (t_last, e)
+        _kline_ema500[sym] = hit
+    cp = closes[-1]
+    return cp, cp * k + hit[1] * (1 - k)
+
+def risk_decide(unreal: list[float], age: list[float], rng: list[float], is_long: list[bool], cp: list[float], e500: list[float]) -> list[int]:
+    # 缺失的波动区间/EMA 以 nan 表示，比较结果为 False；同时满足多条时按 停滞 > 止损 > EMA500 取第一条
+    if np is not None:
+        u = np.asarray(unreal, dtype=np.float64)
+        a = np.asarray(age, dtype=np.float64)
+        r = np.asarray(rng, dtype=np.float64)
+        c = np.asarray(cp, dtype=np.float64)
+        e = np.asarray(e500, dtype=np.float64)
+        lg = np.asarray(is_long, dtype=bool)
+        stag = (u > 0) & (a >= STAGNATION_WINDOW_SEC) & (r < STAGNATION_MIN_RANGE)
+        stop = np.maximum(-u, 0.0) >= ORDER_STOP_NOTIONAL
+        cross = np.where(lg, c < e, c > e)
+        return np.select([stag, stop, cross], [RISK_STAGNATION, RISK_STOP, RISK_EMA500], RISK_NONE).tolist()
+    out = []
+    for i in range(len(unreal)):
+        if stagnation_check(unreal[i], age[i], rng[i], 0.0):
+            out.append(RISK_STAGNATION)
+        elif max(0.0, -unreal[i]) >= ORDER_STOP_NOTIONAL:
+            out.append(RISK_STOP)
+        elif ema500_exit("LONG" if is_long[i] else "SHORT", cp[i], e500[i]):
+            out.append(RISK_EMA500)
         else:
-            place_tp_limit_or_market(sym, position_side, avg, qty, is_long=(side_dir == "LONG"), use_market=False)
-            tgt = adjust_price(sym, avg * (1.01 if side_dir == "LONG" else 0.99))
-            print(f"  └─ 限价止盈(条件2动态): 止盈价 {fmt_price(sym, tgt)}  盈亏汇总 盈利<={'亏损' if gains<=losses else '亏损'}")
+            out.append(RISK_NONE)
+    return out
 
 def risk_loop():
+    global risk_watch
+    set_thread_priority(PRIO_RISK)
+    nan = float("nan")
+    held_keys: set[tuple[str, str]] = set()
     while True:
+        t_iter = time.perf_counter()
         try:
-            pos = get_positions()
-            prices_map = {}
-            try:
-                tp = api_get("/fapi/v2/ticker/price")
-                if isinstance(tp, list):
-                    for it in tp:
-                        prices_map[it.get("symbol")] = float(it.get("price", 0) or 0)
-            except Exception:
-                pass
-            # 同币种多空同时持仓的联动平仓判断
-            sym_agg: dict[str, dict[str, dict]] = {}
+            pos_ok = False
+            pos = risk_positions()
+            pos_ok = isinstance(pos, list)
+            rows = []
             for it in pos:
                 try:
-                    sym = it.get("symbol")
-                    side = str(it.get("positionSide", "")).upper()
                     amt = float(str(it.get("positionAmt", "0")) or 0)
-                    unreal = float(str(it.get("unRealizedProfit", "0")) or 0)
-                    notional_val = abs(float(str(it.get("notional", "0")) or 0))
                     if abs(amt) <= 1e-12:
                         continue
-                    d = sym_agg.setdefault(sym, {})
-                    d[side] = {"amt": amt, "unreal": unreal, "notional": notional_val}
+                    rows.append((
+                        it.get("symbol"),
+                        str(it.get("positionSide", "")).upper(),
+                        amt,
+                        float(str(it.get("unRealizedProfit", "0")) or 0),
+                        float(str(it.get("notional", "0")) or 0),
+                        float(str(it.get("updateTime", "0")) or 0.0),
+                    ))
                 except Exception:
                     continue
+            risk_watch = frozenset(r[0] for r in rows)
+            keys = {(r[0], r[1]) for r in rows}
+            if SERVER_STOP and pos_ok:
+                # 持仓在交易所侧被止盈/止损平掉后，撤掉该方向剩下的条件单；只在本轮持仓查询成功时比较
+                for sym, side in held_keys - keys:
+                    order_gateway.submit(PRIO_RISK, cancel_open_orders_if_flat, sym, side, key=("cleanup", sym, side))
+            held_keys = keys
+            # 只有持仓查询成功（失败会在 risk_positions 抛出，跳过本轮）时才清理已平仓的键
+            for key in [k for k in pos_pnl_history if k not in keys]:
+                pos_pnl_history.pop(key, None)
+            for key in [k for k in pos_first_seen if k not in keys]:
+                pos_first_seen.pop(key, None)
+            # 同币种多空同时持仓的联动平仓判断
+            sym_agg: dict[str, dict[str, tuple]] = {}
+            for r in rows:
+                sym_agg.setdefault(r[0], {})[r[1]] = r
             pair_closed_syms = set()
             for sym, sides in sym_agg.items():
                 if "LONG" in sides and "SHORT" in sides:
-                    la = abs(sides["LONG"]["amt"])
-                    sa = abs(sides["SHORT"]["amt"])
-                    lun = float(sides["LONG"]["unreal"])
-                    sun = float(sides["SHORT"]["unreal"])
-                    lnot = float(sides["LONG"]["notional"]) or 0.0
-                    snot = float(sides["SHORT"]["notional"]) or 0.0
-                    base = max(lnot, snot)
-                    net = lun + sun
-                    trigger_pair = False
-                    if base > 0 and net >= 0.02 * base:
-                        trigger_pair = True
-                    elif abs(la - sa) <= 1e-12 and net > 0:
-                        trigger_pair = True
+                    lg, sh = sides["LONG"], sides["SHORT"]
+                    la, sa = abs(lg[2]), abs(sh[2])
+                    trigger_pair, net, base = pair_close_check(la, sa, lg[3], sh[3], abs(lg[4]), abs(sh[4]))
                     if trigger_pair:
                         ql = adjust_qty(sym, la)
                         qs = adjust_qty(sym, sa)
-                        if ql > 0:
-                            place_market(sym, "SELL", "LONG", ql)
-                        if qs > 0:
-                            place_market(sym, "BUY", "SHORT", qs)
-                        print(f"{fmt_time()}   {sym}   LONG/SHORT  对冲同时平仓  净盈亏 {float(f'{net:.4f}')}  基准名义 {float(f'{base:.4f}')}  阈值 2%")
-                        try:
-                            cancel_open_orders_for_side(sym, "LONG")
-                            cancel_open_orders_for_side(sym, "SHORT")
-                        except Exception:
-                            pass
-                        try:
-                            last_macd_dir.pop(sym, None)
-                        except Exception:
-                            pass
+                        if ql > 0 or qs > 0:
+                            submit_pair_close(sym, ql, qs)
+                        print(f"{fmt_time()}   {sym}   LONG/SHORT  对冲同时平仓  净盈亏 {float(f'{net:.4f}')}  基准名义 {float(f'{base:.4f}')}  阈值 {PAIR_CLOSE_PCT * 100:.0f}%")
+                        last_macd_dir.pop(sym, None)
                         pair_closed_syms.add(sym)
-            for it in pos:
+            rows = [r for r in rows if r[0] not in pair_closed_syms]
+            nowt = time.time()
+            ages, rngs, cps, e500s, pcts = [], [], [], [], []
+            for sym, side, amt, unreal, notional_val, upd in rows:
+                pnl_pct = (unreal / abs(notional_val) * 100.0) if abs(notional_val) > 1e-12 else 0.0
+                key = (sym, side)
+                w = pos_pnl_history.get(key)
+                if w is None:
+                    w = pos_pnl_history[key] = PnlWindow()
+                # 事件驱动下每秒可能检查多次，历史仍按固定间隔采样
+                if nowt - w.last_t() >= RISK_PNL_SAMPLE_SEC:
+                    w.append(nowt, pnl_pct)
+                if key not in pos_first_seen:
+                    pos_first_seen[key] = nowt
+                if upd > 0:
+                    age_sec = max(0.0, (nowt * 1000 - upd) / 1000.0)
+                else:
+                    age_sec = max(0.0, nowt - pos_first_seen.get(key, nowt))
+                rng = nan
+                if unreal > 0 and age_sec >= STAGNATION_WINDOW_SEC:
+                    span = w.range(nowt)
+                    if span is not None:
+                        rng = span
+                em = None
                 try:
-                    sym = it.get("symbol")
-                    if sym in pair_closed_syms:
-                        continue
-                    side = str(it.get("positionSide", "")).upper()
-                    amt = float(str(it.get("positionAmt", "0")) or 0)
-                    entry = float(str(it.get("entryPrice", "0")) or 0)
-                    if abs(amt) <= 1e-12:
-                        continue
-                    unreal = float(str(it.get("unRealizedProfit", "0")) or 0)
-                    notional_val = float(str(it.get("notional", "0")) or 0)
-                    loss = max(0.0, -unreal)
-                    pnl_pct = (unreal / abs(notional_val) * 100.0) if abs(notional_val) > 1e-12 else 0.0
-                    key = (sym, side)
-                    nowt = time.time()
-                    if key not in pos_pnl_history:
-                        pos_pnl_history[key] = deque(maxlen=600)
-                    pos_pnl_history[key].append({"t": nowt, "pct": pnl_pct})
-                    if key not in pos_first_seen and abs(amt) > 1e-12:
-                        pos_first_seen[key] = nowt
-                    upd = float(str(it.get("updateTime", "0")) or 0.0)
-                    age_sec = 0.0
-                    if upd > 0:
-                        age_sec = max(0.0, (time.time()*1000 - upd) / 1000.0)
-                    else:
-                        age_sec = max(0.0, nowt - pos_first_seen.get(key, nowt))
-                    if unreal > 0 and age_sec >= 300.0:
-                        wnd = [x for x in pos_pnl_history.get(key, deque()) if nowt - x.get("t", nowt) <= 300.0]
-                        if wnd:
-                            mxp = max(x["pct"] for x in wnd)
-                            mnp = min(x["pct"] for x in wnd)
-                            if (mxp - mnp) < 0.1:
-                                q = adjust_qty(sym, abs(amt))
-                                sd = "SELL" if side == "LONG" else "BUY"
-                                place_market(sym, sd, side, q)
-                                print(f"{fmt_time()}   {sym}   {side}  盈利停滞平仓  波动 {float(f'{(mxp-mnp):.4f}')}%  年龄 {float(f'{age_sec:.0f}')}s")
-                                try:
-                                    last_macd_dir.pop(sym, None)
-                                except Exception:
-                                    pass
-                                continue
-                    if loss >= ORDER_STOP_NOTIONAL:
-                        q = adjust_qty(sym, abs(amt))
-                        sd = "SELL" if side == "LONG" else "BUY"
-                        j = place_market(sym, sd, side, q)
-                        print(f"{fmt_time()}   {sym}   {side}  紧急止损平仓  未实现盈亏 {float(f'{unreal:.4f}')} ({float(f'{pnl_pct:.2f}')}%)")
-                        try:
-                            if abs(q) > 0:
-                                cancel_open_orders_if_flat(sym, side)
-                        except Exception:
-                            pass
-                        try:
-                            last_macd_dir.pop(sym, None)
-                        except Exception:
-                            pass
-                        continue
-                    closes = None
-                    dq = prices.get(sym)
-                    if dq and len(dq) >= 500:
-                        closes = [x["p"] for x in dq]
-                    else:
-                        kl = api_get("/fapi/v1/klines", {"symbol": sym, "interval": "1m", "limit": 1000})
-                        if isinstance(kl, list) and len(kl) >= 600:
-                            closes = [float(it[4]) for it in kl]
-                    if not closes:
-                        continue
-                    idx = len(closes) - 1
-                    ema500 = ema(closes, 500)
-                    cp = closes[idx]
-                    trigger = False
-                    if side == "LONG":
-                        if (cp < ema500[idx]):
-                            trigger = True
-                            sd = "SELL"
+                    em = risk_ema500(sym)
+                except Exception:
+                    pass
+                ages.append(age_sec)
+                rngs.append(rng)
+                cps.append(em[0] if em else nan)
+                e500s.append(em[1] if em else nan)
+                pcts.append(pnl_pct)
+            acts = risk_decide([r[3] for r in rows], ages, rngs, [r[1] == "LONG" for r in rows], cps, e500s) if rows else []
+            for i, act in enumerate(acts):
+                if act == RISK_NONE:
+                    continue
+                sym, side, amt, unreal = rows[i][:4]
+                q = adjust_qty(sym, abs(amt))
+                sd = "SELL" if side == "LONG" else "BUY"
+                try:
+                    if act == RISK_STAGNATION:
+                        submit_close(sym, sd, side, q)
+                        print(f"{fmt_time()}   {sym}   {side}  盈利停滞平仓  波动 {float(f'{rngs[i]:.4f}')}%  年龄 {float(f'{ages[i]:.0f}')}s")
+                    elif act == RISK_STOP:
+                        submit_close(sym, sd, side, q, cancel="flat" if abs(q) > 0 else None)
+                        print(f"{fmt_time()}   {sym}   {side}  紧急止损平仓  未实现盈亏 {float(f'{unreal:.4f}')} ({float(f'{pcts[i]:.2f}')}%)")
                     else:
-                        if (cp > ema500[idx]):
-                            trigger = True
-                            sd = "BUY"
-                    if trigger:
-                        q = adjust_qty(sym, abs(amt))
-                        j = place_market(sym, sd, side, q)
+                        submit_close(sym, sd, side, q, cancel="flat" if abs(q) > 0 else None)
                         print(f"{fmt_time()}   {sym}   {side}  策略平仓")
-                        try:
-                            if abs(q) > 0:
-                                cancel_open_orders_if_flat(sym, side)
-                        except Exception:
-                            pass
-                        try:
-                            last_macd_dir.pop(sym, None)
-                        except Exception:
-                            pass
                 except Exception:
                     continue
+                last_macd_dir.pop(sym, None)
         except Exception:
             pass
-        time.sleep(1)
+        m_loop_seconds.observe(time.perf_counter() - t_iter, "risk")
+        # 持仓交易对的新价格或用户数据流的持仓变化会提前唤醒下一轮，最长 1 秒；两轮之间至少间隔 RISK_MIN_INTERVAL_MS
+        risk_wakeup.wait(1)
+        risk_wakeup.clear()
+        left = RISK_MIN_INTERVAL_MS / 1000.0 - (time.perf_counter() - t_iter)
+        if left > 0:
+            time.sleep(left)
 
 def setup_once():
+    global INDICATOR_BACKEND
     print("========== 启动 ==========")
+    if use_np_backend():
+        if check_np_backend() > 1e-6:
+            INDICATOR_BACKEND = "python"
+        else:
+            print("✓ 分钟级指标使用 numpy 向量化计算")
     sync_time()
-    set_leverage_for_symbols()
     filter_symbols_once()
+    if WARM_START:
+        syms = sorted(selected_symbols)
+        threading.Thread(target=warm_start, args=(syms,), daemon=True).start()
 
 def main():
     parser = argparse.ArgumentParser()
@@ -1099,14 +4097,42 @@ def main():
         raise SystemExit("缺少密钥: 请在 config.json 的 binance.api_key/api_secret 填写或设置环境变量")
     global g_api_key, g_secret
     g_api_key, g_secret = api_key, secret
+    restore_state_snapshot()
     t4 = threading.Thread(target=countdown_loop, daemon=True)
     t1 = threading.Thread(target=symbol_filter_loop, daemon=True)
     t2 = threading.Thread(target=ticker_loop, daemon=True)
     t5 = threading.Thread(target=minute_eval_loop, daemon=True)
     t4.start(); t1.start(); t2.start(); t5.start()
+    global MARKET_FEED
+    if MARKET_FEED == "ws":
+        if websockets is None:
+            print("未安装 websockets，行情回退为 REST 轮询")
+            MARKET_FEED = "rest"
+        else:
+            t7 = threading.Thread(target=stream_feed_loop, daemon=True)
+            t7.start()
+    global USER_STREAM
+    if USER_STREAM:
+        if websockets is None:
+            print("未安装 websockets，持仓/订单状态回退为 REST 轮询")
+            USER_STREAM = False
+        else:
+            t8 = threading.Thread(target=user_stream_loop, daemon=True)
+            t9 = threading.Thread(target=account_reconcile_loop, daemon=True)
+            t8.start(); t9.start()
     t6 = threading.Thread(target=second_eval_loop, daemon=True)
     t6.start()
+    if LATENCY_TRACE:
+        t10 = threading.Thread(target=latency_dump_loop, daemon=True)
+        t10.start()
+    if METRICS_PORT > 0:
+        t11 = threading.Thread(target=metrics_server_loop, daemon=True)
+        t11.start()
+    t12 = threading.Thread(target=state_snapshot_loop, daemon=True)
+    t12.start()
+    atexit.register(save_state_snapshot)
     setup_once()
+    order_gateway.start()
     t3 = threading.Thread(target=risk_loop, daemon=True)
     t3.start()
     while True:
@@ -18,6 +18,7 @@ def _sign(params: dict, secret: str) -> str:
     return hmac.new(secret.encode(), query.encode(), hashlib.sha256).hexdigest()
 HISTORY_JSON = 'bn.json'
 HISTORY_TXT = 'bn.txt'
+LATENCY_JSON = 'latency.json'
 last_balance_json = None
 last_account_json = None
 
@@ -317,6 +318,18 @@ def api_status():
         "asset": cfg.get("asset")
     })
 
+@app.route("/api/latency")
+def api_latency():
+    # trading.py 开启 LATENCY_TRACE=1 时每 5 秒写入各阶段延迟直方图
+    try:
+        p = os.path.join(os.getcwd(), LATENCY_JSON)
+        if os.path.isfile(p):
+            with open(p, 'r', encoding='utf-8') as f:
+                return jsonify(json.load(f))
+    except Exception:
+        pass
+    return jsonify({"t": None, "stages": {}})
+
 @app.route("/api/positions_current")
 def api_positions_current():
     ts = int(time.time() * 1000)